@@ -1,37 +1,114 @@
+import os
+import json
 import time
 from http import HTTPStatus
 
 import requests
 from flask import current_app
-import dashscope
 from dashscope import MultiModalConversation, ImageSynthesis
 
+import http_pool
+from http_pool import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+from poller import get_poller
+from resilience import upstream, UpstreamError, is_connect_error, release_limit, time_left
+from jobs import report_progress
 from utils import (
     _get_modelscope_headers,
     _get_dashscope_openai_client,
     ApiKeyMissingError,
 )
 
+DS_PORTRAIT_REPAINT_ID = "wanx-style-repaint-v1"
+
+# 同步图像生成 (创意灵感、心情画) 的读超时：响应要等图片生成完毕才返回，需按生成耗时设置
+IMAGE_SYNC_READ_TIMEOUT = float(os.getenv("IMAGE_SYNC_READ_TIMEOUT", "300"))
+
+
+def _modelscope_limit(model_field):
+    """限流维度：ModelScope Key + config 中的模型"""
+    return lambda config, ms_key, **_: (ms_key, config[model_field])
+
+
+def _dashscope_limit(model_field):
+    """限流维度：百炼 Key + config 中的模型"""
+    return lambda config, **_: (config.get("bailian_api_key"), config[model_field])
+
+
+def _dashscope_app_limit(model_key):
+    """限流维度：百炼 Key + 应用配置中固定的模型"""
+    return lambda config, **_: (config.get("bailian_api_key"), current_app.config[model_key])
+
+
+def _wait_for_task(task_id, query_url, headers, parse, interval, label, model, timeout=180):
+    """交给后台轮询服务等待异步任务完成，并在 Job 进度中给出预计完成时间"""
+    # 任务已提交：归还限流并发名额，轮询期间不占用 (并发上限只约束提交)
+    release_limit()
+    poller = get_poller()
+    # 设置了请求截止时间时 (如创意灵感)，轮询不超过截止时间，被放弃的任务不再继续占用轮询与等待线程
+    future = poller.watch(
+        task_id, query_url, headers, parse,
+        interval=interval, timeout=time_left(timeout), label=label, model=model,
+    )
+    eta = poller.eta(model)
+    report_progress(
+        "polling",
+        task_id=task_id,
+        eta_seconds=round(eta, 1) if eta is not None else None,
+        expected_at=time.time() + eta if eta is not None else None,
+    )
+    return future.result()
+
 # ==============================================================================
 # === 1. ModelScope 平台“执行器”
 # ==============================================================================
+@upstream("modelscope_chat", limit_by=_modelscope_limit("ms_chat_model"))
 def run_llm_chat_modelscope(config, ms_key, messages, system_prompt):
     """ModelScope LLM 聊天执行器"""
     headers = _get_modelscope_headers(ms_key)
     base_url = current_app.config["MODEL_SCOPE_BASE_URL"]
     payload = {
         "model": config["ms_chat_model"],
-        "messages": [{"role": "system", "content": system_prompt}] + messages,
+        "messages": ([{"role": "system", "content": system_prompt}] if system_prompt else []) + messages,
         "max_tokens": 500,
         "temperature": 0.7,
     }
-    response = requests.post(
+    response = http_pool.post(
         f"{base_url}v1/chat/completions", headers=headers, json=payload
     )
     response.raise_for_status()
     return response.json()
 
 
+@upstream("modelscope_chat", limit_by=_modelscope_limit("ms_chat_model"))
+def stream_llm_chat_modelscope(config, ms_key, messages, system_prompt):
+    """ModelScope LLM 流式聊天执行器，逐段产出增量文本"""
+    headers = _get_modelscope_headers(ms_key)
+    base_url = current_app.config["MODEL_SCOPE_BASE_URL"]
+    payload = {
+        "model": config["ms_chat_model"],
+        "messages": ([{"role": "system", "content": system_prompt}] if system_prompt else []) + messages,
+        "max_tokens": 500,
+        "temperature": 0.7,
+        "stream": True,
+    }
+    with http_pool.post(
+        f"{base_url}v1/chat/completions", headers=headers, json=payload, stream=True
+    ) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            line = line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            choices = json.loads(data).get("choices") or []
+            delta = choices[0].get("delta", {}).get("content") if choices else None
+            if delta:
+                yield delta
+
+
+@upstream("modelscope_chat", limit_by=_modelscope_limit("ms_chat_model"))
 def run_llm_generation_modelscope(config, ms_key, prompt, max_tokens=800, temp=0.5):
     """ModelScope LLM 单轮生成执行器 (用于翻译、创意生成等)"""
     headers = _get_modelscope_headers(ms_key)
@@ -42,7 +119,7 @@ def run_llm_generation_modelscope(config, ms_key, prompt, max_tokens=800, temp=0
         "max_tokens": max_tokens,
         "temperature": temp,
     }
-    response = requests.post(
+    response = http_pool.post(
         f"{base_url}v1/chat/completions", headers=headers, json=payload
     )
     response.raise_for_status()
@@ -50,6 +127,7 @@ def run_llm_generation_modelscope(config, ms_key, prompt, max_tokens=800, temp=0
     return data["choices"][0]["message"]["content"]
 
 
+@upstream("modelscope_chat", limit_by=_modelscope_limit("ms_vl_model"))
 def run_vl_chat_modelscope(config, ms_key, system_prompt, messages_content):
     """ModelScope VL (识图) 执行器"""
     headers = _get_modelscope_headers(ms_key)
@@ -66,7 +144,7 @@ def run_vl_chat_modelscope(config, ms_key, system_prompt, messages_content):
         "max_tokens": 1000,
         "temperature": 0.6,
     }
-    response = requests.post(
+    response = http_pool.post(
         f"{base_url}v1/chat/completions", headers=headers, json=payload
     )
     response.raise_for_status()
@@ -77,14 +155,17 @@ def run_vl_chat_modelscope(config, ms_key, system_prompt, messages_content):
         raise Exception(f"Qwen-VL API Error: {data.get('message', 'Unknown error')}")
 
 
+@upstream("modelscope_image", limit_by=lambda ms_key, body, **_: (ms_key, body.get("model")), retry_if=is_connect_error)
 def run_image_gen_modelscope(config, ms_key, body, sync=False):
     """ModelScope 图像生成 执行器"""
     headers = _get_modelscope_headers(ms_key)
     base_url = current_app.config["MODEL_SCOPE_BASE_URL"]
 
     if sync:
-        response = requests.post(
-            f"{base_url}v1/images/generations", headers=headers, json=body
+        report_progress("submitted")
+        response = http_pool.post(
+            f"{base_url}v1/images/generations", headers=headers, json=body,
+            timeout=(HTTP_CONNECT_TIMEOUT, time_left(IMAGE_SYNC_READ_TIMEOUT)),
         )
         response.raise_for_status()
         data = response.json()
@@ -93,29 +174,37 @@ def run_image_gen_modelscope(config, ms_key, body, sync=False):
         raise Exception(f"API Error (Sync): {data.get('message', 'Unknown error')}")
     else:
         async_headers = {**headers, "X-ModelScope-Async-Mode": "true"}
-        response = requests.post(
+        response = http_pool.post(
             f"{base_url}v1/images/generations", headers=async_headers, json=body
         )
         response.raise_for_status()
         task_id = response.json()["task_id"]
+        report_progress("submitted", task_id=task_id)
         poll_headers = {**headers, "X-ModelScope-Task-Type": "image_generation"}
-        start_time = time.time()
-        timeout = 180
-        while time.time() - start_time < timeout:
-            result = requests.get(f"{base_url}v1/tasks/{task_id}", headers=poll_headers)
-            result.raise_for_status()
-            data = result.json()
-            if data["task_status"] == "SUCCEED":
-                return data["output_images"][0]
-            elif data["task_status"] == "FAILED":
-                raise Exception(f"ModelScope Task failed: {data.get('task_message', 'Unknown error')}")
-            time.sleep(3)
-        raise Exception(f"ModelScope Task polling timed out after {timeout} seconds.")
+        return _wait_for_task(
+            task_id,
+            f"{base_url}v1/tasks/{task_id}",
+            poll_headers,
+            _parse_modelscope_task,
+            interval=3,
+            label="ModelScope",
+            model=body.get("model"),
+        )
+
+
+def _parse_modelscope_task(data):
+    """ModelScope 任务查询结果解析：未完成返回 None"""
+    if data["task_status"] == "SUCCEED":
+        return data["output_images"][0]
+    elif data["task_status"] == "FAILED":
+        raise Exception(f"ModelScope Task failed: {data.get('task_message', 'Unknown error')}")
+    return None
 
 # ==============================================================================
 # === 2. 阿里云 DashScope 平台“执行器” (保持最新)
 # ==============================================================================
 
+@upstream("dashscope_llm", limit_by=_dashscope_limit("ds_llm_id"))
 def run_llm_chat_dashscope(config, messages, system_prompt):
     """DashScope LLM 聊天执行器 (OpenAI 兼容)"""
     client = _get_dashscope_openai_client(config)
@@ -129,6 +218,26 @@ def run_llm_chat_dashscope(config, messages, system_prompt):
     return completion.choices[0].message
 
 
+@upstream("dashscope_llm", limit_by=_dashscope_limit("ds_llm_id"))
+def stream_llm_chat_dashscope(config, messages, system_prompt):
+    """DashScope LLM 流式聊天执行器 (OpenAI 兼容)，逐段产出增量文本"""
+    client = _get_dashscope_openai_client(config)
+    all_messages = []
+    if system_prompt:
+        all_messages.append({"role": "system", "content": system_prompt})
+    all_messages.extend(messages)
+    stream = client.chat.completions.create(
+        model=config["ds_llm_id"], messages=all_messages, stream=True
+    )
+    try:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    finally:
+        stream.close()
+
+
+@upstream("dashscope_llm", limit_by=_dashscope_limit("ds_llm_id"))
 def run_llm_generation_dashscope(config, prompt, max_tokens=800, temp=0.5):
     """DashScope LLM 单轮生成执行器 (OpenAI 兼容)"""
     client = _get_dashscope_openai_client(config)
@@ -141,16 +250,19 @@ def run_llm_generation_dashscope(config, prompt, max_tokens=800, temp=0.5):
     return completion.choices[0].message.content
 
 
+@upstream("dashscope_vl", limit_by=_dashscope_limit("ds_vl_id"))
 def run_vl_chat_dashscope(config, messages_content):
     """DashScope VL (识图) 执行器 (qwen-vl-plus)"""
     api_key = config.get("bailian_api_key")
     if not api_key:
         raise ApiKeyMissingError("未在设置中配置阿里云百炼 API Key (Bailian API Key)")
-    dashscope.base_http_api_url = current_app.config["DASHSCOPE_API_BASE_URL"]
+    # base_address / api_key 按请求传入，不修改 dashscope 模块级全局状态
     response = MultiModalConversation.call(
         api_key=api_key,
+        base_address=current_app.config["DASHSCOPE_API_BASE_URL"],
         model=config["ds_vl_id"],
         messages=[{"role": "user", "content": messages_content}],
+        request_timeout=int(HTTP_READ_TIMEOUT),
     )
     if response.status_code == 200:
         try:
@@ -159,12 +271,15 @@ def run_vl_chat_dashscope(config, messages_content):
             print(f"DashScope VL returned unexpected content format: {response.output.choices[0].message.content}")
             return response.output.choices[0].message.content
     else:
-        raise Exception(f"DashScope VL API 错误 (HTTP {response.status_code}): {response.code} - {response.message}")
+        raise UpstreamError(
+            f"DashScope VL API 错误 (HTTP {response.status_code}): {response.code} - {response.message}",
+            status_code=response.status_code,
+        )
 
 
+@upstream("dashscope_image", limit_by=_dashscope_app_limit("DS_WANX21_IMAGE_EDIT_ID"), retry_if=is_connect_error)
 def run_image_edit_wanx21_dashscope(config, function, base_image_b64, prompt=None, is_sketch=None, strength=None, size="1024*1024"):
     """DashScope 通用图像编辑执行器 (wanx2.1-imageedit)。"""
-    dashscope.base_http_api_url = current_app.config["DASHSCOPE_API_BASE_URL"]
     api_key = config.get("bailian_api_key")
     if not api_key:
         raise ApiKeyMissingError("未在设置中配置阿里云百炼 API Key (Bailian API Key)")
@@ -175,11 +290,13 @@ def run_image_edit_wanx21_dashscope(config, function, base_image_b64, prompt=Non
 
     call_params = {
         "api_key": api_key,
+        "base_address": current_app.config["DASHSCOPE_API_BASE_URL"],
         "model": model_id,
         "function": function,
         "base_image_url": base_image_b64,
         "n": 1,
         "size": size,
+        "request_timeout": int(HTTP_READ_TIMEOUT),
     }
     if function in ["description_edit", "colorization", "doodle", "remove_watermark", "stylization_all"]:
         if not prompt: raise ValueError(f"'prompt' is required for function '{function}'.")
@@ -192,29 +309,39 @@ def run_image_edit_wanx21_dashscope(config, function, base_image_b64, prompt=Non
          call_params["strength"] = strength
          print(f"Parameter added for stylization_all: strength={strength}")
 
-    # 3. 调用 API (使用同步 call，传递 **kwargs)
+    # 3. 提交异步任务 (SDK 的同步 call 内部轮询时会读取全局 base_http_api_url，因此改为 async_call)
     try:
-        response = ImageSynthesis.call(**call_params)
+        task = ImageSynthesis.async_call(**call_params)
     except Exception as e:
         print(f"DashScope SDK call failed for {model_id}/{function}: {e}")
         raise e
 
-    # 4. 处理响应
-    if response and response.status_code == 200:
-        try:
-            image_url = response.output.results[0].url
-            print(f"DashScope {model_id}/{function} (SDK): Success, image URL: {image_url}")
-            return image_url
-        except (IndexError, KeyError, TypeError):
-             print(response)
-             raise Exception(f"DashScope {model_id}/{function} Error: Could not parse image URL from successful SDK response.")
-    elif response:
-        print(f"DashScope {model_id}/{function} Error: Code={response.code}, Message={response.message}")
-        raise Exception(f"DashScope {model_id}/{function} API 错误 (HTTP {response.status_code}): {response.code} - {response.message}")
+    # 4. 处理提交响应，交给后台轮询服务等待结果
+    if task and task.status_code == 200:
+        task_id = task.output.task_id
+        report_progress("submitted", task_id=task_id)
+        image_url = _wait_for_task(
+            task_id,
+            f"{current_app.config['DASHSCOPE_API_BASE_URL']}/tasks/{task_id}",
+            {"Authorization": f"Bearer {api_key}"},
+            _parse_dashscope_task,
+            interval=3,
+            label="DashScope",
+            model=f"{model_id}/{function}",
+        )
+        print(f"DashScope {model_id}/{function} (SDK): Success, image URL: {image_url}")
+        return image_url
+    elif task:
+        print(f"DashScope {model_id}/{function} Error: Code={task.code}, Message={task.message}")
+        raise UpstreamError(
+            f"DashScope {model_id}/{function} API 错误 (HTTP {task.status_code}): {task.code} - {task.message}",
+            status_code=task.status_code,
+        )
     else:
         raise Exception(f"DashScope {model_id}/{function}: Unknown error, SDK call returned None.")
 
 
+@upstream("dashscope_image", limit_by=_dashscope_app_limit("DS_T2I_TURBO_ID"), retry_if=is_connect_error)
 def run_text_to_image_dashscope(config, prompt, size="1024*1024"):
     """
     DashScope 文生图执行器 (wanx2.1-t2i-turbo)。
@@ -224,18 +351,19 @@ def run_text_to_image_dashscope(config, prompt, size="1024*1024"):
         raise ApiKeyMissingError("未在设置中配置阿里云百炼 API Key (Bailian API Key)")
 
     model_id = current_app.config["DS_T2I_TURBO_ID"]
-    dashscope.base_http_api_url = current_app.config["DASHSCOPE_API_BASE_URL"]
 
     print(f"DashScope: Submitting async task for {model_id}...")
 
     # 1. 准备异步调用参数
     async_call_params = {
       "api_key": api_key,
+      "base_address": current_app.config["DASHSCOPE_API_BASE_URL"],
       "model": model_id,
       "prompt": prompt,
       "n": 1,
       "size": size,
-      'prompt_extend': True
+      'prompt_extend': True,
+      "request_timeout": int(HTTP_READ_TIMEOUT),
     }
 
     # 2. 提交异步任务
@@ -244,43 +372,41 @@ def run_text_to_image_dashscope(config, prompt, size="1024*1024"):
 
         if task.status_code != HTTPStatus.OK:
             print(f"Failed to submit task. Response: {task}")
-            raise Exception(f"DashScope 任务提交失败: {task.code} - {task.message}")
+            raise UpstreamError(f"DashScope 任务提交失败: {task.code} - {task.message}", status_code=task.status_code)
 
         print(f"Task submitted successfully, task_id: {task.output.task_id}")
+        report_progress("submitted", task_id=task.output.task_id)
 
     except Exception as e:
         print(f"DashScope SDK async_call failed for {model_id}: {e}")
         raise e
 
-    try:
-        dashscope.api_key = api_key
-        response = ImageSynthesis.wait(task)
-
-        if response.status_code == HTTPStatus.OK:
-            for result in response.output.results:
-                if result and hasattr(result, 'url') and result.url:
-                    image_url = result.url
-                    break # 只需要第一张图片
-        if image_url:
-            return image_url
-    except Exception as e:
-        print(f"DashScope SDK wait failed for {model_id}: {e}")
-        raise e
-    finally:
-        dashscope.api_key = None
+    # 3. 交给后台轮询服务，等待任务完成
+    task_id = task.output.task_id
+    return _wait_for_task(
+        task_id,
+        f"{current_app.config['DASHSCOPE_API_BASE_URL']}/tasks/{task_id}",
+        {"Authorization": f"Bearer {api_key}"},
+        _parse_dashscope_task,
+        interval=3,
+        label="DashScope",
+        model=model_id,
+    )
+
 
+@upstream("dashscope_image", limit_by=lambda config, **_: (config.get("bailian_api_key"), DS_PORTRAIT_REPAINT_ID), retry_if=is_connect_error)
 def run_portrait_stylization_dashscope(config, base_image_b64, style_image_b64=None, style_index=None):
     """
     (重写 v2 - 适配官方异步 REST API 示例)
     DashScope 人像风格化执行器 (wanx-style-repaint-v1)。
-    使用 requests 提交异步任务并轮询结果。
+    使用 requests 提交异步任务，由后台轮询服务等待结果。
     """
     api_key = config.get("bailian_api_key")
     if not api_key:
         raise ApiKeyMissingError("未在设置中配置阿里云百炼 API Key (Bailian API Key)")
 
     # 使用官方示例的 API 端点和模型 ID
-    model_id = "wanx-style-repaint-v1"
+    model_id = DS_PORTRAIT_REPAINT_ID
     submit_url = f"{current_app.config['DASHSCOPE_API_BASE_URL']}/services/aigc/image-generation/generation"
 
     print(f"DashScope: Calling model {model_id} via REST API...")
@@ -307,67 +433,64 @@ def run_portrait_stylization_dashscope(config, base_image_b64, style_image_b64=N
         "input": input_data
     }
     try:
-        response = requests.post(submit_url, headers=headers, json=payload, timeout=30)
+        response = http_pool.post(submit_url, headers=headers, json=payload, timeout=30)
         response.raise_for_status()
         submit_data = response.json()
         task_id = submit_data.get('output', {}).get('task_id')
         if not task_id:
             raise Exception(f"Failed to submit task. Response: {submit_data}")
         print(f"Task submitted successfully, task_id: {task_id}")
+        report_progress("submitted", task_id=task_id)
 
     except requests.exceptions.RequestException as e:
         print(f"DashScope task submission failed: {e}")
         # 如果请求体有问题，API 可能直接返回 400 Bad Request
         if e.response is not None:
              print(f"Response status: {e.response.status_code}, Response body: {e.response.text}")
-             raise Exception(f"DashScope task submission failed with status {e.response.status_code}: {e.response.text}")
+             raise UpstreamError(
+                 f"DashScope task submission failed with status {e.response.status_code}: {e.response.text}",
+                 status_code=e.response.status_code,
+             ) from e
         else:
-             raise Exception(f"DashScope task submission failed: {e}")
+             raise UpstreamError(f"DashScope task submission failed: {e}") from e
     except Exception as e:
         # 捕获 JSON 解析等其他错误
          print(f"DashScope task submission processing failed: {e}")
          raise e
 
 
-    # 5. 轮询任务结果
-    query_url = f"{current_app.config['DASHSCOPE_API_BASE_URL']}/tasks/{task_id}"
-    query_headers = {"Authorization": f"Bearer {api_key}"}
-    start_time = time.time()
-    timeout = 180
+    # 5. 交给后台轮询服务，等待任务完成
     print("Polling task status...")
-    while time.time() - start_time < timeout:
-        try:
-            query_response = requests.get(query_url, headers=query_headers, timeout=10)
-            query_response.raise_for_status()
-            query_data = query_response.json()
-            task_status = query_data.get('output', {}).get('task_status')
-            if task_status == 'SUCCEEDED':
-                print("Task SUCCEEDED!")
-                results = query_data.get('output', {}).get('results', [])
-                if results and results[0].get('url'):
-                    image_url = results[0]['url']
-                    print(f"DashScope {model_id}: Success, image URL: {image_url}")
-                    return image_url
-                else:
-                    raise Exception(f"Task succeeded but no result URL found in response: {query_data}")
-            elif task_status == 'FAILED':
-                print(f"Task FAILED. Response: {query_data}")
-                error_msg = query_data.get('output', {}).get('message', 'Unknown error')
-                raise Exception(f"DashScope task {task_id} failed: {error_msg}")
-            elif task_status in ['PENDING', 'RUNNING']:
-                print(f"Task status: {task_status}, waiting...")
-                time.sleep(5) # 等待 5 秒
-            else:
-                # 处理未知的状态
-                print(f"Unknown task status: {task_status}. Response: {query_data}")
-                raise Exception(f"DashScope task {task_id} returned unknown status: {task_status}")
-
-        except requests.exceptions.RequestException as e:
-            print(f"Polling failed: {e}")
-            time.sleep(5)
-        except Exception as e:
-             print(f"Polling processing failed: {e}")
-             raise e
-
-    # 如果超时
-    raise Exception(f"DashScope task {task_id} polling timed out after {timeout} seconds.")
+    image_url = _wait_for_task(
+        task_id,
+        f"{current_app.config['DASHSCOPE_API_BASE_URL']}/tasks/{task_id}",
+        {"Authorization": f"Bearer {api_key}"},
+        _parse_dashscope_task,
+        interval=5,
+        label="DashScope",
+        model=model_id,
+    )
+    print(f"DashScope {model_id}: Success, image URL: {image_url}")
+    return image_url
+
+
+def _parse_dashscope_task(data):
+    """DashScope 异步任务查询结果解析：未完成返回 None"""
+    output = data.get('output', {})
+    task_status = output.get('task_status')
+    if task_status == 'SUCCEEDED':
+        results = output.get('results', [])
+        for result in results:
+            if result and result.get('url'):
+                return result['url']
+        raise Exception(f"Task succeeded but no result URL found in response: {data}")
+    elif task_status in ['FAILED', 'CANCELED', 'UNKNOWN']:
+        print(f"Task {task_status}. Response: {data}")
+        error_msg = output.get('message', 'Unknown error')
+        raise Exception(f"DashScope task {output.get('task_id')} failed: {error_msg}")
+    elif task_status in ['PENDING', 'RUNNING']:
+        return None
+    else:
+        # 处理未知的状态
+        print(f"Unknown task status: {task_status}. Response: {data}")
+        raise Exception(f"DashScope task {output.get('task_id')} returned unknown status: {task_status}")
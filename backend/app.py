@@ -1,28 +1,38 @@
 import os
+import hmac
 import requests # 确保导入 requests
 from io import BytesIO
-from flask import Flask, request, jsonify, send_file, send_from_directory, current_app
+from flask import Flask, Response, request, jsonify, send_file, send_from_directory, current_app, stream_with_context
 from dotenv import load_dotenv
 from flask_cors import CORS
 from itsdangerous import URLSafeTimedSerializer
 
 
 # --- 1. 导入本地模块 ---
+import http_pool
+import metrics
+from jobs import get_job_manager
+from gallery import search_page, build_search_params, decode_cursor, get_departments
+from media import ImageFile, ObjectImage, presign_upload, direct_upload_enabled
+from resilience import CircuitOpenError
 from utils import (
     get_api_key,
     handle_api_errors,
     get_ai_config,
+    format_sse,
 )
 from services import (
     validate_modelscope_key,
-    translate_text_tencent,
     generate_colorization,
     generate_creative_workshop,
     generate_portrait_workshop,
     run_chat_completion,
+    stream_chat_completion,
     generate_ideas,
     generate_mood_painting,
     generate_artwork_explanation,
+    stream_artwork_explanation,
+    translate_artwork_info,
     transcribe_audio_dashscope,
     critique_student_work
 )
@@ -42,6 +52,8 @@ CORS(
 app.config["SECRET_KEY"] = os.getenv("FLASK_SECRET_KEY")
 app.config["API_KEY_SALT"] = os.getenv("API_KEY_SALT")
 app.config["ts"] = URLSafeTimedSerializer(app.config["SECRET_KEY"])
+# /api/metrics 的访问令牌；未设置时该接口只接受本机请求
+app.config["METRICS_TOKEN"] = os.getenv("METRICS_TOKEN")
 
 # --- 2.2 模型和 API 配置 (最终版) ---
 # ModelScope
@@ -92,16 +104,34 @@ def check_key():
         return handle_api_errors(e)
 
 
+@app.route("/api/metrics", methods=["GET"])
+def get_metrics():
+    """
+    (新增) 进程内监控指标 (连接池、缓存命中等)。包含内部状态，不对外公开：
+    设置了 METRICS_TOKEN 时需携带 Authorization: Bearer <METRICS_TOKEN>，否则只接受来自本机的请求。
+    """
+    token = current_app.config["METRICS_TOKEN"]
+    if token:
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+        allowed = hmac.compare_digest(supplied.encode("utf-8"), token.encode("utf-8"))
+    else:
+        allowed = request.remote_addr in ("127.0.0.1", "::1")
+    if not allowed:
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(metrics.snapshot())
+
+
 @app.route("/api/proxy-download")
 def proxy_download():
     image_url = request.args.get("url")
     if not image_url:
         return jsonify({"error": "Image URL is required"}), 400
     try:
-        response = requests.get(image_url, stream=True)
-        response.raise_for_status()
-        image_data = BytesIO(response.content)
-        mime_type = response.headers.get('Content-Type', 'image/png')
+        # URL 由客户端提供，host 不可预期：使用一次性请求，不进入共享连接池 (避免任意 host 挤出上游会话)
+        with requests.get(image_url, stream=True, timeout=http_pool.DEFAULT_TIMEOUT) as response:
+            response.raise_for_status()
+            image_data = BytesIO(response.content)
+            mime_type = response.headers.get('Content-Type', 'image/png')
         return send_file(
             image_data,
             mimetype=mime_type,
@@ -130,24 +160,126 @@ def handle_audio_to_text():
     except Exception as e:
         return handle_api_errors(e)
 
+# --- 3.1 异步任务 (Job) 路由 ---
+
+def _wants_async(data):
+    """请求体 "async": true 或查询参数 ?async=1 时走异步 Job 模式"""
+    flag = request.args.get("async") or (data or {}).get("async")
+    return str(flag).lower() in ("1", "true", "yes")
+
+
+def _dispatch(ms_key, data, task):
+    """同步模式直接执行 task 并返回 JSON；异步模式提交 Job 并立即返回 202"""
+    if not _wants_async(data):
+        return jsonify(task())
+    job = get_job_manager().submit(current_app._get_current_object(), task, owner_key=ms_key)
+    return jsonify({
+        "jobId": job.id,
+        "status": job.status,
+        "statusUrl": f"/api/jobs/{job.id}",
+        "eventsUrl": f"/api/jobs/{job.id}/events",
+    }), 202
+
+
+def _get_owned_job(job_id):
+    ms_key = get_api_key()
+    job = get_job_manager().get(job_id)
+    if job is None or not job.owned_by(ms_key):
+        return None
+    return job
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """查询异步任务状态与结果"""
+    try:
+        job = _get_owned_job(job_id)
+        if job is None:
+            return jsonify({"error": "任务不存在或已过期"}), 404
+        return jsonify(job.to_dict())
+    except Exception as e:
+        return handle_api_errors(e)
+
+
+@app.route("/api/jobs/<job_id>/events", methods=["GET"])
+def stream_job_events(job_id):
+    """以 Server-Sent Events 推送异步任务进度"""
+    try:
+        job = _get_owned_job(job_id)
+        if job is None:
+            return jsonify({"error": "任务不存在或已过期"}), 404
+    except Exception as e:
+        return handle_api_errors(e)
+
+    def generate():
+        for event in job.iter_events():
+            if event is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield format_sse(event, event="progress")
+        yield format_sse(job.to_dict(), event="result")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # --- 4. AI 功能路由 ---
 
+@app.route("/api/uploads/presign", methods=["POST"])
+def handle_presign_upload():
+    """签发浏览器直传 R2 的预签名 PUT 地址"""
+    try:
+        ms_key = get_api_key()
+        if not direct_upload_enabled():
+            return jsonify({"error": "未配置对象存储，不支持直传"}), 501
+        data = request.json or {}
+        return jsonify(presign_upload(ms_key, data.get("content_type"), data.get("size")))
+    except Exception as e:
+        return handle_api_errors(e)
+
+
+def _image_request_data(ms_key, *image_fields):
+    """
+    图像接口同时支持两种请求格式：
+      - application/json：图片为 base64 data URL 字符串 (原有格式)
+      - multipart/form-data：图片为文件部分，其余字段为表单字段；文件以 ImageFile 形式传给 services
+    两种格式下都可以用 "<字段名>_key" 代替图片本身，引用浏览器已直传到 R2 的对象 (见 /api/uploads/presign)。
+    """
+    if request.mimetype != "multipart/form-data":
+        data = request.json
+    else:
+        data = request.form.to_dict()
+        for field in image_fields:
+            storage = request.files.get(field)
+            if storage is not None and storage.filename:
+                data[field] = ImageFile.from_file_storage(storage)
+    for field in image_fields:
+        object_key = data.get(f"{field}_key")
+        if object_key and not data.get(field):
+            data[field] = ObjectImage.from_key(object_key, owner_key=ms_key)
+    return data
+
+
 @app.route("/api/colorize-lineart", methods=["POST"])
 def handle_colorize_lineart():
     """AI 智能上色"""
     try:
         ms_key = get_api_key()
-        data = request.json
+        data = _image_request_data(ms_key, "base64_image")
         config = get_ai_config(data)
         base64_image = data.get("base64_image")
         prompt = data.get("prompt")
         if not base64_image or not prompt:
             return jsonify({"error": "线稿图片和风格提示是必需的"}), 400
 
-        image_url = generate_colorization(
-            config=config, ms_key=ms_key, base64_image=base64_image, chinese_prompt=prompt
-        )
-        return jsonify({"imageUrl": image_url})
+        return _dispatch(ms_key, data, lambda: {
+            "imageUrl": generate_colorization(
+                config=config, ms_key=ms_key, base64_image=base64_image, chinese_prompt=prompt
+            )
+        })
     except Exception as e:
         return handle_api_errors(e)
 
@@ -156,7 +288,7 @@ def handle_creative_workshop():
     """ 创意工坊 (非人像风格迁移)"""
     try:
         ms_key = get_api_key()
-        data = request.json
+        data = _image_request_data(ms_key, "content_image", "style_image")
         config = get_ai_config(data)
 
         base64_content_image = data.get("content_image") # 内容图 (必须)
@@ -168,16 +300,16 @@ def handle_creative_workshop():
         if not base64_style_image and not chinese_prompt:
              return jsonify({"error": "风格图片或文本指令至少需要一个"}), 400
 
-        image_url = generate_creative_workshop(
-            config=config,
-            ms_key=ms_key,
-            base64_content_image=base64_content_image,
-            base64_style_image=base64_style_image,
-            chinese_prompt=chinese_prompt
-        )
-
         # 风格描述暂时移除，因为输入可能是图片
-        return jsonify({"imageUrl": image_url})
+        return _dispatch(ms_key, data, lambda: {
+            "imageUrl": generate_creative_workshop(
+                config=config,
+                ms_key=ms_key,
+                base64_content_image=base64_content_image,
+                base64_style_image=base64_style_image,
+                chinese_prompt=chinese_prompt
+            )
+        })
     except Exception as e:
         return handle_api_errors(e)
 
@@ -187,26 +319,35 @@ def handle_portrait_workshop():
     """ 人像工坊"""
     try:
         ms_key = get_api_key()
-        data = request.json
+        data = _image_request_data(ms_key, "portrait_image", "style_image")
         config = get_ai_config(data)
         config["modelscope_key"] = ms_key
 
         base64_portrait_image = data.get("portrait_image")
         base64_style_image = data.get("style_image")
         preset_style_index = data.get("preset_style_index")
+        if isinstance(preset_style_index, str):
+            # multipart 表单字段都是字符串
+            preset_style_index = preset_style_index.strip() or None
+        if preset_style_index is not None:
+            try:
+                preset_style_index = int(preset_style_index)
+            except (TypeError, ValueError):
+                return jsonify({"error": "preset_style_index 必须为整数"}), 400
 
         if not base64_portrait_image:
             return jsonify({"error": "人像图片是必需的"}), 400
         if base64_style_image is None and preset_style_index is None:
              return jsonify({"error": "自定义风格图片或预设风格索引至少需要一个"}), 400
 
-        image_url = generate_portrait_workshop(
-            config=config,
-            base64_portrait_image=base64_portrait_image,
-            base64_style_image=base64_style_image,
-            preset_style_index=preset_style_index
-        )
-        return jsonify({"imageUrl": image_url})
+        return _dispatch(ms_key, data, lambda: {
+            "imageUrl": generate_portrait_workshop(
+                config=config,
+                base64_portrait_image=base64_portrait_image,
+                base64_style_image=base64_style_image,
+                preset_style_index=preset_style_index
+            )
+        })
     except Exception as e:
         return handle_api_errors(e)
 
@@ -230,6 +371,48 @@ def handle_ask_question():
         return handle_api_errors(e)
 
 
+def _stream_text_sse(chunks, on_done):
+    """
+    将增量文本以 SSE 推送：每段为一个 delta 事件，结束时发送 done 事件 (on_done(完整文本) 的结果)。
+    响应头已发出后的错误以 error 事件返回。
+    """
+    def generate():
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk)
+                yield format_sse({"content": chunk}, event="delta")
+            yield format_sse(on_done("".join(parts)), event="done")
+        except Exception as e:
+            response, status_code = handle_api_errors(e)
+            yield format_sse({**response.get_json(), "status": status_code}, event="error")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/ask-question/stream", methods=["POST"])
+def handle_ask_question_stream():
+    """艺术知识问答 (流式 SSE)"""
+    try:
+        ms_key = get_api_key()
+        data = request.json
+        config = get_ai_config(data)
+        messages = data.get("messages")
+        if not messages:
+            return jsonify({"error": "Messages are required"}), 400
+
+        chunks = stream_chat_completion(config=config, ms_key=ms_key, messages=messages)
+        return _stream_text_sse(chunks, lambda content: {
+            "choices": [{"message": {"role": "assistant", "content": content}}]
+        })
+    except Exception as e:
+        return handle_api_errors(e)
+
+
 @app.route("/api/generate-ideas", methods=["POST"])
 def handle_generate_ideas():
     """创意灵感生成"""
@@ -241,8 +424,9 @@ def handle_generate_ideas():
         if not theme:
             return jsonify({"error": "灵感主题是必需的"}), 400
 
-        processed_ideas = generate_ideas(config=config, ms_key=ms_key, theme=theme)
-        return jsonify(processed_ideas)
+        return _dispatch(ms_key, data, lambda: generate_ideas(
+            config=config, ms_key=ms_key, theme=theme
+        ))
     except Exception as e:
         return handle_api_errors(e)
 
@@ -252,7 +436,7 @@ def handle_critique_homework():
     try:
         # 复用现有的鉴权逻辑
         ms_key = get_api_key()
-        data = request.json
+        data = _image_request_data(ms_key, "student_image")
         config = get_ai_config(data)
 
         config['modelscope_key'] = ms_key
@@ -280,10 +464,9 @@ def handle_mood_painting():
         if not theme or not mood:
             return jsonify({"error": "心情和主题是必需的"}), 400
 
-        processed_idea = generate_mood_painting(
+        return _dispatch(ms_key, data, lambda: generate_mood_painting(
             config=config, ms_key=ms_key, mood=mood, theme=theme
-        )
-        return jsonify(processed_idea)
+        ))
     except Exception as e:
         return handle_api_errors(e)
 
@@ -294,64 +477,15 @@ def handle_gallery_search():
     try:
         data = request.json
         met_api_base = current_app.config["MET_API_BASE"]
-        search_params = {
-            "q": data.get("q", "*"), "hasImages": "true", "isPublicDomain": "true"
-        }
-        if data.get("departmentId"): search_params["departmentId"] = data.get("departmentId")
-        if data.get("isHighlight"): search_params["isHighlight"] = data.get("isHighlight")
-        if data.get("medium"): search_params["medium"] = data.get("medium")
-        if data.get("geoLocation"): search_params["geoLocation"] = data.get("geoLocation")
-        if data.get("dateBegin"): search_params["dateBegin"] = data.get("dateBegin")
-        if data.get("dateEnd"): search_params["dateEnd"] = data.get("dateEnd")
-
-        search_url = f"{met_api_base}/search"
-        search_res = requests.get(search_url, params=search_params, timeout=10)
-        search_res.raise_for_status()
-        search_data = search_res.json()
-        object_ids = search_data.get("objectIDs", [])
-        if not object_ids:
-            return jsonify({"artworks": [], "total": 0})
-
-        artworks_raw = []
-        for obj_id in object_ids[:20]: # 只获取前20个
+        if data.get("cursor"):
+            # 翻页：游标中带有首次搜索的筛选条件与偏移量
             try:
-                obj_url = f"{met_api_base}/objects/{obj_id}"
-                obj_res = requests.get(obj_url, timeout=5)
-                obj_res.raise_for_status()
-                obj_data = obj_res.json()
-                if obj_data.get("primaryImageSmall"):
-                    artworks_raw.append({
-                        "id": obj_data.get("objectID"),
-                        "title": obj_data.get("title", "N/A"),
-                        "artist": obj_data.get("artistDisplayName", "Unknown"),
-                        "date": obj_data.get("objectDate", "N/A"),
-                        "medium": obj_data.get("medium", "N/A"),
-                        "imageUrl": obj_data.get("primaryImageSmall"),
-                        "metUrl": obj_data.get("objectURL", "#"),
-                        "original_title": obj_data.get("title", "N/A"),
-                        "original_artist": obj_data.get("artistDisplayName", "Unknown"),
-                        "original_medium": obj_data.get("medium", "N/A"),
-                    })
-            except requests.exceptions.RequestException as e:
-                print(f"Failed to fetch object {obj_id}: {e}")
-                continue
-
-        # 批量翻译 (平台无关)
-        if artworks_raw:
-            titles_en = [art.get("original_title", "") for art in artworks_raw]
-            artists_en = [art.get("original_artist", "") for art in artworks_raw]
-            mediums_en = [art.get("original_medium", "") for art in artworks_raw]
-
-            titles_zh = translate_text_tencent(titles_en)
-            artists_zh = translate_text_tencent(artists_en)
-            mediums_zh = translate_text_tencent(mediums_en)
-
-            for i, art in enumerate(artworks_raw):
-                art["title"] = titles_zh[i] if i < len(titles_zh) else art["original_title"]
-                art["artist"] = artists_zh[i] if i < len(artists_zh) else art["original_artist"]
-                art["medium"] = mediums_zh[i] if i < len(mediums_zh) else art["original_medium"]
-
-        return jsonify({"artworks": artworks_raw, "total": search_data.get("total", 0)})
+                search_params, offset = decode_cursor(data["cursor"])
+            except ValueError:
+                return jsonify({"error": "无效的分页游标"}), 400
+            return jsonify(search_page(met_api_base, search_params, offset))
+
+        return jsonify(search_page(met_api_base, build_search_params(data)))
     except requests.exceptions.RequestException as http_err:
         return jsonify({"error": f"Met API 错误: {str(http_err)}"}), 502
     except Exception as e:
@@ -362,10 +496,9 @@ def handle_gallery_search():
 def handle_gallery_departments():
     try:
         met_api_base = current_app.config["MET_API_BASE"]
-        dept_url = f"{met_api_base}/departments"
-        dept_res = requests.get(dept_url, timeout=10)
-        dept_res.raise_for_status()
-        return jsonify(dept_res.json())
+        return jsonify(get_departments(met_api_base))
+    except CircuitOpenError as e:
+        return handle_api_errors(e)
     except Exception as e:
         return jsonify({"error": f"Met API 错误: {str(e)}"}), 502
 
@@ -393,6 +526,30 @@ def handle_gallery_explain():
         return handle_api_errors(e)
 
 
+@app.route("/api/gallery/explain/stream", methods=["POST"])
+def handle_gallery_explain_stream():
+    """名画鉴赏室 - AI 讲解 (流式 SSE)"""
+    try:
+        ms_key = get_api_key()
+        data = request.json
+        config = get_ai_config(data)
+
+        art_info_en = {
+            "title": data.get("title", "N/A"),
+            "artist": data.get("artist", "N/A"),
+            "medium": data.get("medium", "N/A"),
+            "date": data.get("date", "N/A"),
+        }
+
+        chunks = stream_artwork_explanation(config=config, ms_key=ms_key, art_info_en=art_info_en)
+        return _stream_text_sse(chunks, lambda content: {
+            "ai_explanation": {"role": "assistant", "content": content},
+            "original_description_zh": translate_artwork_info(art_info_en),
+        })
+    except Exception as e:
+        return handle_api_errors(e)
+
+
 # --- 6. 静态文件服务与启动 ---
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
@@ -0,0 +1,148 @@
+"""
+图像预处理基准：对比旧的缩放路径 (完整解码 + LANCZOS + 默认 PNG 压缩级别) 与现在的 image_pool.resize_image
+(JPEG draft 解码 + 大倍数缩小用 BICUBIC/reducing_gap + PNG compress_level 3)。
+每次运行在独立的子进程中进行，报告 CPU 时间与峰值 RSS 增量 (扣除载入输入后的基线)。
+
+    cd backend && python bench_image_preprocess.py                      # 生成 4032x3024 (12 MP) 的 JPEG 与 PNG 测试图
+    cd backend && python bench_image_preprocess.py photo.jpg --sizes 1536 2048 --repeat 5
+"""
+import os
+import sys
+import base64
+import argparse
+import resource
+import tempfile
+import statistics
+import multiprocessing
+from io import BytesIO
+
+from PIL import Image, ImageFilter
+
+import image_pool
+
+DEFAULT_WIDTH, DEFAULT_HEIGHT = 4032, 3024
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+def _old_resize(base64_string, max_dim):
+    """user-017 之前 _resize_image_for_dashscope 的缩放部分：完整解码后 LANCZOS 缩放，按原格式以默认参数重新编码"""
+    header, encoded = base64_string.split(",", 1)
+    with Image.open(BytesIO(base64.b64decode(encoded))) as img:
+        scale = min(max_dim / img.width, max_dim / img.height)
+        new_width, new_height = int(img.width * scale), int(img.height * scale)
+        img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+        output_bytes = BytesIO()
+        pil_format = img.format if img.format else "PNG"
+        if pil_format == "JPEG" and img_resized.mode != "RGB":
+            img_resized = img_resized.convert("RGB")
+        img_resized.save(output_bytes, format=pil_format, quality=95)
+    return f"{header},{base64.b64encode(output_bytes.getvalue()).decode('utf-8')}"
+
+
+def _new_resize(base64_string, max_dim):
+    """现在的路径：解码一次，直接交给 image_pool.resize_image (与进程池 worker 中执行的函数相同)"""
+    header, encoded = base64_string.split(",", 1)
+    data = base64.b64decode(encoded)
+    with Image.open(BytesIO(data)) as img:
+        width, height = img.size
+    scale = min(max_dim / width, max_dim / height)
+    output, _, _ = image_pool.resize_image(BytesIO(data), int(width * scale), int(height * scale))
+    return f"{header},{base64.b64encode(output).decode('utf-8')}"
+
+
+PATHS = {"old": _old_resize, "new": _new_resize}
+
+
+def _peak_rss_mb():
+    # Linux 上 ru_maxrss 会继承 fork 时父进程的峰值 (父进程生成测试图时已很大)，改读本进程地址空间的 VmHWM
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss 在 Linux 上以 KB 为单位，macOS 上以字节为单位
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _write_data_url(image_path, directory):
+    """预先把图片转成 Data URL 文件：子进程只需读取一次字符串，编码过程的临时内存不会计入基线"""
+    with open(image_path, "rb") as f:
+        data = f.read()
+    with Image.open(BytesIO(data)) as img:
+        mime_type = MIME_TYPES.get(img.format, "image/png")
+    url_path = os.path.join(directory, os.path.basename(image_path) + ".b64")
+    with open(url_path, "w") as f:
+        f.write(f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}")
+    return url_path
+
+
+def _run_once(path_name, url_path, max_dim, queue):
+    """子进程：载入输入后记录基线，执行一次缩放，回传 CPU 时间、峰值 RSS 增量与输出大小"""
+    with open(url_path) as f:
+        base64_string = f.read()
+    baseline = _peak_rss_mb()
+    started = resource.getrusage(resource.RUSAGE_SELF)
+    result = PATHS[path_name](base64_string, max_dim)
+    finished = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (finished.ru_utime - started.ru_utime) + (finished.ru_stime - started.ru_stime)
+    queue.put((cpu, _peak_rss_mb() - baseline, len(result) * 3 // 4))
+
+
+def measure(path_name, url_path, max_dim, repeat):
+    """重复 repeat 次 (每次一个新进程)，返回 CPU 时间中位数、峰值 RSS 增量中位数与输出字节数"""
+    ctx = multiprocessing.get_context("spawn")
+    samples = []
+    for _ in range(repeat):
+        queue = ctx.Queue()
+        process = ctx.Process(target=_run_once, args=(path_name, url_path, max_dim, queue))
+        process.start()
+        samples.append(queue.get())
+        process.join()
+    return (
+        statistics.median(s[0] for s in samples),
+        statistics.median(s[1] for s in samples),
+        samples[-1][2],
+    )
+
+
+def make_sample_images(directory, width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT):
+    """生成带渐变与细节纹理的 12 MP 测试图 (纯噪声或纯色图的编解码开销都不具代表性)"""
+    gradient = Image.linear_gradient("L").resize((width, height))
+    radial = Image.radial_gradient("L").resize((width, height))
+    texture = Image.effect_noise((width, height), 48).filter(ImageFilter.GaussianBlur(1.5))
+    img = Image.merge("RGB", (gradient, radial, texture))
+    paths = []
+    for pil_format, ext in (("JPEG", "jpg"), ("PNG", "png")):
+        path = os.path.join(directory, f"sample_{width}x{height}.{ext}")
+        img.save(path, format=pil_format, quality=92)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图像预处理基准：旧缩放路径 vs image_pool.resize_image")
+    parser.add_argument("images", nargs="*", help="测试图片 (JPEG/PNG)；不指定时生成 4032x3024 的 JPEG 与 PNG")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1536, 2048], help="目标最长边")
+    parser.add_argument("--repeat", type=int, default=3, help="每个组合运行的次数 (取中位数)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="artspark-bench-") as tmp_dir:
+        images = args.images or make_sample_images(tmp_dir)
+        print(f"{'image':<28} {'max_dim':>7} {'path':>4} {'cpu_s':>7} {'peak_mb':>8} {'out_kb':>8}")
+        for image_path in images:
+            url_path = _write_data_url(image_path, tmp_dir)
+            for max_dim in args.sizes:
+                for path_name in PATHS:
+                    cpu, peak, size = measure(path_name, url_path, max_dim, args.repeat)
+                    print(
+                        f"{os.path.basename(image_path):<28} {max_dim:>7} {path_name:>4} "
+                        f"{cpu:>7.2f} {peak:>8.1f} {size / 1024:>8.0f}"
+                    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
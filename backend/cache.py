@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# ==============================================================================
+# === 两级缓存：进程内 LRU + 磁盘 SQLite (同一台机器上的多个 gunicorn worker 共享)
+# ==============================================================================
+
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"))
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", os.path.join(CACHE_DIR, "cache.sqlite3"))
+# 每写入多少次检查一次磁盘层的过期与容量
+CACHE_EVICT_EVERY = int(os.getenv("CACHE_EVICT_EVERY", "50"))
+
+_local = threading.local()
+
+
+def _connect():
+    """每个线程一个 SQLite 连接 (WAL 模式允许多进程并发读写)"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(CACHE_DB_PATH), exist_ok=True)
+        conn = sqlite3.connect(CACHE_DB_PATH, timeout=5)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_cache_accessed ON cache (namespace, accessed_at)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS perceptual_index ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL,"
+            " hash TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        conn.commit()
+        _local.conn = conn
+    return conn
+
+
+def make_key(*parts):
+    """由任意可 JSON 序列化的部件生成定长缓存键"""
+    raw = json.dumps(parts, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    值必须可 JSON 序列化。
+    读：内存命中直接返回；否则查 SQLite，命中后回填内存。
+    写：同时写入两级。两级都按 ttl 过期，并各自按条目数上限淘汰最久未使用的条目。
+    磁盘层出错 (只读文件系统、锁超时等) 时自动退化为仅内存缓存。
+    """
+
+    def __init__(self, namespace, ttl, memory_size=1024, disk_size=50000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self._memory_size = memory_size
+        self._disk_size = disk_size
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        metrics.register_source(f"cache.{namespace}", self.stats)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, created_at = entry
+                if now - created_at < self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return value
+                del self._memory[key]
+
+        entry = self._disk_get(key, now)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._memory_put(key, entry[0], entry[1])
+        return entry[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._memory_put(key, value, now)
+            self._writes += 1
+            evict = self._writes % CACHE_EVICT_EVERY == 0
+        self._disk_set(key, value, now, evict)
+
+    def _memory_put(self, key, value, created_at):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key, now):
+        try:
+            conn = _connect()
+            row = conn.execute(
+                "SELECT value, created_at FROM cache WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None or now - row[1] >= self.ttl:
+                return None
+            conn.execute(
+                "UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?",
+                (now, self.namespace, key),
+            )
+            conn.commit()
+            return json.loads(row[0]), row[1]
+        except (sqlite3.Error, OSError, ValueError) as e:
+            print(f"Cache '{self.namespace}': disk read failed: {e}")
+            return None
+
+    def _disk_set(self, key, value, now, evict):
+        try:
+            conn = _connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, created_at, accessed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            if evict:
+                self._disk_evict(conn, now)
+            conn.commit()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Cache '{self.namespace}': disk write failed: {e}")
+
+    def _disk_evict(self, conn, now):
+        conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND created_at < ?",
+            (self.namespace, now - self.ttl),
+        )
+        conn.execute(
+            "DELETE FROM cache WHERE namespace = ? AND key IN ("
+            " SELECT key FROM cache WHERE namespace = ?"
+            " ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.namespace, self.namespace, self._disk_size),
+        )
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+class PerceptualIndex:
+    """
+    感知哈希近邻索引：按汉明距离查找“看起来相同”的图片 (重新编码、轻微缩放等) 对应的缓存值。
+    条目数量不大 (参考画作等)，查询时线性扫描内存中的全部条目；
+    内存未命中时增量加载其他 worker 写入 SQLite 的新条目后再查一次。
+    内存与磁盘各保留最新的 max_entries 条。
+    """
+
+    def __init__(self, namespace, ttl, max_distance, max_entries=5000):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self._max_entries = max_entries
+        self._entries = []  # (哈希, 值, 创建时间)
+        self._last_id = 0  # 已从磁盘加载到的最大行 id
+        self._own_ids = set()  # 本进程写入、尚未被同步跳过的行 id
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        metrics.register_source(f"cache.{namespace}", self.stats)
+
+    def _match(self, image_hash, now):
+        best = None
+        for entry_hash, value, created_at in self._entries:
+            if now - created_at >= self.ttl:
+                continue
+            distance = hamming_distance(image_hash, entry_hash)
+            if distance <= self.max_distance and (best is None or distance < best[0]):
+                best = (distance, value)
+        return best
+
+    def _sync_from_disk(self, now):
+        try:
+            rows = _connect().execute(
+                "SELECT id, hash, value, created_at FROM perceptual_index"
+                " WHERE namespace = ? AND id > ? AND created_at > ? ORDER BY id",
+                (self.namespace, self._last_id, now - self.ttl),
+            ).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Perceptual index '{self.namespace}': disk read failed: {e}")
+            return
+        for row_id, entry_hash, value, created_at in rows:
+            self._last_id = max(self._last_id, row_id)
+            # 自己写入的条目已在内存中，跳过以免重复
+            if row_id in self._own_ids:
+                self._own_ids.discard(row_id)
+                continue
+            self._entries.append((int(entry_hash, 16), json.loads(value), created_at))
+        del self._entries[:-self._max_entries]
+
+    def get(self, image_hash):
+        """返回汉明距离最近且不超过 max_distance 的缓存值，没有则返回 None"""
+        now = time.time()
+        with self._lock:
+            best = self._match(image_hash, now)
+            if best is None:
+                self._sync_from_disk(now)
+                best = self._match(image_hash, now)
+            if best is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            metrics.observe(f"cache.{self.namespace}.distance", best[0])
+            return best[1]
+
+    def add(self, image_hash, value):
+        now = time.time()
+        with self._lock:
+            self._entries.append((image_hash, value, now))
+            del self._entries[:-self._max_entries]
+            try:
+                conn = _connect()
+                cursor = conn.execute(
+                    "INSERT INTO perceptual_index (namespace, hash, value, created_at) VALUES (?, ?, ?, ?)",
+                    (self.namespace, f"{image_hash:016x}", json.dumps(value, ensure_ascii=False), now),
+                )
+                conn.execute(
+                    "DELETE FROM perceptual_index WHERE namespace = ? AND created_at < ?",
+                    (self.namespace, now - self.ttl),
+                )
+                conn.execute(
+                    "DELETE FROM perceptual_index WHERE namespace = ? AND id NOT IN ("
+                    " SELECT id FROM perceptual_index WHERE namespace = ? ORDER BY id DESC LIMIT ?)",
+                    (self.namespace, self.namespace, self._max_entries),
+                )
+                conn.commit()
+                # 不能直接把 _last_id 推进到本行：其他 worker 可能写入了 id 更小、尚未加载的条目
+                if cursor.lastrowid > self._last_id:
+                    self._own_ids.add(cursor.lastrowid)
+            except (sqlite3.Error, OSError) as e:
+                print(f"Perceptual index '{self.namespace}': disk write failed: {e}")
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
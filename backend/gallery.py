@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import base64
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+
+import http_pool
+import metrics
+import met_index
+from cache import TieredCache, make_key
+from resilience import call_upstream, CircuitOpenError
+from services import translate_text_tencent
+
+# ==============================================================================
+# === 名画鉴赏室：Met Collection API 访问
+# ==============================================================================
+
+# 并发获取作品详情的线程数 (所有请求共享，同时也是对 Met API 的并发上限)
+MET_FETCH_WORKERS = int(os.getenv("MET_FETCH_WORKERS", "8"))
+# 单个作品详情的超时，以及一次搜索获取全部作品详情的总期限 (秒)
+MET_OBJECT_TIMEOUT = float(os.getenv("MET_OBJECT_TIMEOUT", "5"))
+MET_FETCH_DEADLINE = float(os.getenv("MET_FETCH_DEADLINE", "8"))
+
+_met_executor = ThreadPoolExecutor(max_workers=MET_FETCH_WORKERS, thread_name_prefix="met-fetch")
+
+# 元数据缓存：作品详情与部门列表几乎不变。超过新鲜期后仍先返回旧值，同时在后台重新获取 (stale-while-revalidate)；
+# 超过新鲜期 + 最长过期时间后不再使用。没有图片 (或已下架) 的作品也缓存，避免反复请求。
+MET_CACHE_TTL = int(os.getenv("MET_CACHE_TTL", str(7 * 24 * 3600)))
+MET_CACHE_MAX_STALE = int(os.getenv("MET_CACHE_MAX_STALE", str(30 * 24 * 3600)))
+MET_NEGATIVE_CACHE_TTL = int(os.getenv("MET_NEGATIVE_CACHE_TTL", str(24 * 3600)))
+# 搜索结果 (objectIDs 列表) 会随馆藏更新变化，新鲜期较短
+MET_SEARCH_CACHE_TTL = int(os.getenv("MET_SEARCH_CACHE_TTL", str(24 * 3600)))
+
+_metadata_cache = TieredCache(
+    "met_metadata", ttl=MET_CACHE_TTL + MET_CACHE_MAX_STALE, memory_size=20000, disk_size=500000
+)
+# 宽泛查询的 objectIDs 列表可达数 MB，内存中只保留少量
+_search_cache = TieredCache(
+    "met_search", ttl=MET_SEARCH_CACHE_TTL + MET_CACHE_MAX_STALE, memory_size=64, disk_size=5000
+)
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+# 分页：每页作品数；用户浏览第 N 页时在后台预取 (获取详情并翻译) 第 N+1 页
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", "20"))
+GALLERY_PREFETCH_WORKERS = int(os.getenv("GALLERY_PREFETCH_WORKERS", "2"))
+
+# 预取任务内部还会向 _met_executor 提交请求，需使用独立线程池以免互相等待
+_prefetch_executor = ThreadPoolExecutor(max_workers=GALLERY_PREFETCH_WORKERS, thread_name_prefix="gallery-prefetch")
+_prefetching = {}  # 页面键 -> 进行中的预取任务
+_prefetching_lock = threading.Lock()
+
+# 作品详情只缓存页面用到的字段
+OBJECT_FIELDS = (
+    "objectID", "title", "artistDisplayName", "objectDate", "medium", "primaryImageSmall", "objectURL"
+)
+
+
+def met_get(url, retries=1, **kwargs):
+    """经熔断器请求 Met API 并返回 JSON"""
+    def fetch():
+        res = http_pool.get(url, **kwargs)
+        res.raise_for_status()
+        return res.json()
+    return call_upstream("met", fetch, retries=retries, limit=(None, None))
+
+
+def to_artwork(obj_data):
+    """Met 作品详情 -> 前端使用的作品字段 (title/artist/medium 稍后替换为译文)"""
+    return {
+        "id": obj_data.get("objectID"),
+        "title": obj_data.get("title", "N/A"),
+        "artist": obj_data.get("artistDisplayName", "Unknown"),
+        "date": obj_data.get("objectDate", "N/A"),
+        "medium": obj_data.get("medium", "N/A"),
+        "imageUrl": obj_data.get("primaryImageSmall"),
+        "metUrl": obj_data.get("objectURL", "#"),
+        "original_title": obj_data.get("title", "N/A"),
+        "original_artist": obj_data.get("artistDisplayName", "Unknown"),
+        "original_medium": obj_data.get("medium", "N/A"),
+    }
+
+
+def _store(cache, key, data):
+    cache.set(key, {"data": data, "fetched_at": time.time()})
+
+
+def _refresh(cache, key, fetch):
+    try:
+        _store(cache, key, fetch())
+        metrics.incr("met_cache.refreshes")
+    except Exception as e:
+        print(f"Met cache: background refresh failed: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+
+def _lookup(cache, key, fetch, fresh_ttl):
+    """
+    只查缓存，返回 (是否命中, 数据)。
+    过了新鲜期的条目照常返回，并在后台调用 fetch() 重新获取 (同一条目同时只刷新一次)。
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return False, None
+
+    ttl = fresh_ttl if entry["data"] is not None else min(fresh_ttl, MET_NEGATIVE_CACHE_TTL)
+    if time.time() - entry["fetched_at"] < ttl:
+        metrics.incr("met_cache.hits")
+        return True, entry["data"]
+
+    metrics.incr("met_cache.stale_hits")
+    with _refreshing_lock:
+        start = key not in _refreshing
+        _refreshing.add(key)
+    if start:
+        _met_executor.submit(_refresh, cache, key, fetch)
+    return True, entry["data"]
+
+
+def _cached(cache, key, fetch, fresh_ttl):
+    """读取缓存，未命中时同步调用 fetch() 并写入缓存 (fetch 抛出的异常不缓存，原样抛出)"""
+    hit, data = _lookup(cache, key, fetch, fresh_ttl)
+    if hit:
+        return data
+    metrics.incr("met_cache.misses")
+    data = fetch()
+    _store(cache, key, data)
+    return data
+
+
+def _fetch_object_record(met_api_base, obj_id):
+    """返回作品详情中页面用到的字段；没有图片或已下架 (404) 的作品返回 None"""
+    try:
+        # 单个作品失败直接跳过，不重试，避免拖慢整页
+        obj_data = met_get(f"{met_api_base}/objects/{obj_id}", retries=0, timeout=MET_OBJECT_TIMEOUT)
+    except requests.exceptions.HTTPError as e:
+        if e.response is not None and e.response.status_code == 404:
+            return None
+        raise
+    if not obj_data.get("primaryImageSmall"):
+        return None
+    return {field: obj_data.get(field) for field in OBJECT_FIELDS if field in obj_data}
+
+
+def _object_args(met_api_base, obj_id):
+    return (
+        _metadata_cache, make_key("object", obj_id),
+        lambda: _fetch_object_record(met_api_base, obj_id), MET_CACHE_TTL,
+    )
+
+
+def _fetch_object(met_api_base, obj_id):
+    return _cached(*_object_args(met_api_base, obj_id))
+
+
+def get_departments(met_api_base):
+    return _cached(
+        _metadata_cache, make_key("departments"),
+        lambda: met_get(f"{met_api_base}/departments", timeout=10), MET_CACHE_TTL,
+    )
+
+
+def search_objects(met_api_base, search_params):
+    """Met /search 的结果 (total 与 objectIDs)，按查询参数缓存"""
+    return _cached(
+        _search_cache, make_key("search", sorted(search_params.items())),
+        lambda: met_get(f"{met_api_base}/search", params=search_params, timeout=10), MET_SEARCH_CACHE_TTL,
+    )
+
+
+def _department_name(met_api_base, department_id):
+    for dept in get_departments(met_api_base).get("departments", []):
+        if str(dept.get("departmentId")) == str(department_id):
+            return dept.get("displayName")
+    return None
+
+
+def search_artwork_ids(met_api_base, search_params, limit=None, offset=0):
+    """
+    返回 Met /search 结构的 {"total", "objectIDs"}，objectIDs 只含从 offset 起的 limit 个。
+    已导入离线索引 (met_index.py) 时查本地索引；否则请求 Met /search，完整的 objectIDs 列表保存在缓存中，翻页时从中截取。
+    """
+    department = None
+    if met_index.available() and search_params.get("departmentId"):
+        department = _department_name(met_api_base, search_params["departmentId"])
+    # 部门编号无法换算为名称时交给 Met /search 处理
+    if met_index.available() and (department or not search_params.get("departmentId")):
+        try:
+            return met_index.search(search_params, department=department, limit=limit, offset=offset)
+        except sqlite3.Error as e:
+            print(f"Met index search failed, falling back to the live API: {e}")
+            metrics.incr("met_index.fallbacks")
+    search_data = search_objects(met_api_base, search_params)
+    object_ids = search_data.get("objectIDs") or []
+    end = None if limit is None else offset + limit
+    return {"total": search_data.get("total", len(object_ids)), "objectIDs": object_ids[offset:end]}
+
+
+def fetch_artworks(met_api_base, object_ids):
+    """
+    按 object_ids 的顺序 (即搜索结果的排序) 返回带图片的作品。
+    已缓存的作品直接使用，其余并发获取；失败或超过总期限的作品直接丢弃，不影响其余作品。
+    """
+    started = time.time()
+    records = {}
+    futures = {}
+    for obj_id in object_ids:
+        hit, record = _lookup(*_object_args(met_api_base, obj_id))
+        if hit:
+            records[obj_id] = record
+        elif obj_id not in futures:
+            futures[obj_id] = _met_executor.submit(_fetch_object, met_api_base, obj_id)
+    if futures:
+        wait(futures.values(), timeout=MET_FETCH_DEADLINE)
+
+    for obj_id, future in futures.items():
+        if not future.done():
+            # 尚未开始的任务直接取消；已在进行中的请求由单个作品的超时兜底
+            future.cancel()
+            metrics.incr("met.object_timeouts")
+            print(f"Object {obj_id} missed the {MET_FETCH_DEADLINE}s deadline.")
+            continue
+        error = future.exception()
+        if error is not None:
+            metrics.incr("met.object_failures")
+            # Met API 已熔断时每个作品都会快速失败，不逐条打印
+            if not isinstance(error, CircuitOpenError):
+                print(f"Failed to fetch object {obj_id}: {error}")
+            continue
+        records[obj_id] = future.result()
+
+    metrics.observe("met.fetch_artworks_seconds", time.time() - started)
+    return [to_artwork(records[obj_id]) for obj_id in object_ids if records.get(obj_id)]
+
+
+def translate_artworks(artworks):
+    """标题、艺术家、媒介合并为一次批量翻译 (平台无关)，再按顺序拆回"""
+    if not artworks:
+        return artworks
+    titles_en = [art.get("original_title", "") for art in artworks]
+    artists_en = [art.get("original_artist", "") for art in artworks]
+    mediums_en = [art.get("original_medium", "") for art in artworks]
+
+    translated = translate_text_tencent(titles_en + artists_en + mediums_en)
+    count = len(artworks)
+    titles_zh = translated[:count]
+    artists_zh = translated[count:2 * count]
+    mediums_zh = translated[2 * count:]
+
+    for i, art in enumerate(artworks):
+        art["title"] = titles_zh[i] if i < len(titles_zh) else art["original_title"]
+        art["artist"] = artists_zh[i] if i < len(artists_zh) else art["original_artist"]
+        art["medium"] = mediums_zh[i] if i < len(mediums_zh) else art["original_medium"]
+    return artworks
+
+
+# ==============================================================================
+# === 分页与预取
+# ==============================================================================
+
+# 客户端可以设置的筛选条件；其余条件由服务端固定 (游标翻页时同样重新套用)
+SEARCH_FILTER_KEYS = ("departmentId", "isHighlight", "medium", "geoLocation", "dateBegin", "dateEnd")
+FIXED_SEARCH_PARAMS = {"hasImages": "true", "isPublicDomain": "true"}
+
+
+def build_search_params(filters):
+    """由客户端提交的筛选条件生成 Met /search 参数 (首页请求与游标翻页共用)"""
+    search_params = {"q": filters.get("q", "*"), **FIXED_SEARCH_PARAMS}
+    for key in SEARCH_FILTER_KEYS:
+        if filters.get(key):
+            search_params[key] = filters[key]
+    return search_params
+
+
+def encode_cursor(search_params, offset):
+    raw = json.dumps({"params": search_params, "offset": offset}, ensure_ascii=False, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """游标 -> (search_params, offset)；格式无效时抛出 ValueError"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        search_params, offset = data["params"], int(data["offset"])
+    except (TypeError, KeyError, UnicodeError, ValueError) as e:
+        raise ValueError(f"Invalid gallery cursor: {e}") from e
+    if not isinstance(search_params, dict) or offset < 0:
+        raise ValueError("Invalid gallery cursor.")
+    # 游标由客户端回传：只接受首页请求会生成的键与标量值，并重新套用服务端固定的条件
+    allowed = {"q", *SEARCH_FILTER_KEYS, *FIXED_SEARCH_PARAMS}
+    unknown = set(search_params) - allowed
+    if unknown:
+        raise ValueError(f"Invalid gallery cursor: unexpected params {sorted(unknown)}")
+    if not all(isinstance(value, (str, int, float, bool)) for value in search_params.values()):
+        raise ValueError("Invalid gallery cursor: params must be scalars.")
+    return build_search_params(search_params), offset
+
+
+def _build_page(met_api_base, search_params, offset):
+    search_data = search_artwork_ids(met_api_base, search_params, limit=GALLERY_PAGE_SIZE, offset=offset)
+    total = search_data.get("total", 0)
+    artworks = translate_artworks(fetch_artworks(met_api_base, search_data.get("objectIDs", [])))
+    next_offset = offset + GALLERY_PAGE_SIZE
+    return {
+        "artworks": artworks,
+        "total": total,
+        "nextCursor": encode_cursor(search_params, next_offset) if next_offset < total else None,
+    }
+
+
+def _page_key(search_params, offset):
+    return make_key("page", sorted(search_params.items()), offset)
+
+
+def _prefetch(met_api_base, search_params, offset):
+    """后台构建下一页：作品详情与译文写入缓存，真正请求该页时直接命中"""
+    key = _page_key(search_params, offset)
+    with _prefetching_lock:
+        if key in _prefetching:
+            return
+        future = _prefetch_executor.submit(_build_page, met_api_base, search_params, offset)
+        _prefetching[key] = future
+
+    def done(f):
+        with _prefetching_lock:
+            _prefetching.pop(key, None)
+        if f.exception() is not None:
+            print(f"Gallery prefetch failed: {f.exception()}")
+    future.add_done_callback(done)
+
+
+def search_page(met_api_base, search_params, offset=0):
+    """返回一页作品 {"artworks", "total", "nextCursor"}，并在后台预取下一页"""
+    with _prefetching_lock:
+        pending = _prefetching.get(_page_key(search_params, offset))
+    if pending is not None:
+        # 该页正在预取：等待其完成，避免重复请求 Met 与翻译接口
+        metrics.incr("gallery.prefetch_waits")
+        wait([pending], timeout=MET_FETCH_DEADLINE)
+
+    started = time.time()
+    page = _build_page(met_api_base, search_params, offset)
+    metrics.observe("gallery.page_seconds", time.time() - started)
+    if page["nextCursor"]:
+        _prefetch(met_api_base, search_params, offset + GALLERY_PAGE_SIZE)
+    return page
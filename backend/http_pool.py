@@ -0,0 +1,117 @@
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# ==============================================================================
+# === 上游 HTTP 连接池 (按 host 复用 keep-alive 会话)
+# ==============================================================================
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "32"))
+# 最多保留多少个 host 的会话 (LRU)；被挤出的会话关闭其空闲连接
+HTTP_POOL_MAX_HOSTS = int(os.getenv("HTTP_POOL_MAX_HOSTS", "64"))
+
+DEFAULT_TIMEOUT = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def _host_key(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _build_session():
+    session = requests.Session()
+    # 连接复用由 urllib3 连接池负责；重试交给上层逻辑，这里不做自动重试
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=False,
+        max_retries=0,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(url):
+    """
+    返回 url 所属 host 的共享 Session (线程安全，首次使用时创建)。
+    超过 HTTP_POOL_MAX_HOSTS 时关闭最久未用的会话：关闭只清空其 urllib3 连接池，
+    仍持有该会话的线程下次请求会重新建立连接，正在读取的响应不受影响。
+    """
+    key = _host_key(url)
+    evicted = []
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            metrics.incr("http_pool.session_misses")
+            session = _build_session()
+            _sessions[key] = session
+            while len(_sessions) > HTTP_POOL_MAX_HOSTS:
+                evicted.append(_sessions.popitem(last=False)[1])
+        else:
+            metrics.incr("http_pool.session_hits")
+            _sessions.move_to_end(key)
+    for old in evicted:
+        metrics.incr("http_pool.session_evictions")
+        old.close()
+    return session
+
+
+def request(method, url, timeout=None, **kwargs):
+    """通过共享连接池发送请求；未指定 timeout 时使用 (connect, read) 默认超时"""
+    session = get_session(url)
+    return session.request(method, url, timeout=timeout or DEFAULT_TIMEOUT, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def head(url, **kwargs):
+    return request("HEAD", url, **kwargs)
+
+
+def pool_stats():
+    """
+    汇总各 host 的连接复用情况。
+    hits = 复用已有连接的请求数，misses = 新建连接数 (TCP+TLS 握手)。
+    """
+    with _sessions_lock:
+        sessions = dict(_sessions)
+
+    stats = {}
+    for key, session in sessions.items():
+        requests_total = 0
+        connections_opened = 0
+        adapter = session.get_adapter(key)
+        for pool_key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(pool_key)
+            if pool is None:
+                continue
+            requests_total += pool.num_requests
+            connections_opened += pool.num_connections
+        stats[key] = {
+            "requests": requests_total,
+            "hits": max(0, requests_total - connections_opened),
+            "misses": connections_opened,
+        }
+    return stats
+
+
+metrics.register_source("http_pool", pool_stats)
@@ -0,0 +1,188 @@
+import os
+import time
+import uuid
+import hashlib
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from utils import handle_api_errors, ServiceBusyError
+
+# ==============================================================================
+# === 异步任务 (Job) 子系统：提交即返回 job id，结果通过轮询或 SSE 获取
+# ==============================================================================
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "8"))
+JOB_QUEUE_LIMIT = int(os.getenv("JOB_QUEUE_LIMIT", "64"))
+JOB_TTL = int(os.getenv("JOB_TTL", "1800"))
+
+TERMINAL_STATUSES = ("succeeded", "failed")
+
+_current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def _owner_hash(owner_key):
+    return hashlib.sha256((owner_key or "").encode("utf-8")).hexdigest()
+
+
+class Job:
+    def __init__(self, owner_key):
+        self.id = uuid.uuid4().hex
+        self.owner = _owner_hash(owner_key)
+        self.status = "queued"
+        self.events = []
+        self.result = None
+        self.error = None
+        self.status_code = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self._cond = threading.Condition()
+        self.add_event("queued")
+
+    def owned_by(self, owner_key):
+        return self.owner == _owner_hash(owner_key)
+
+    def add_event(self, stage, **data):
+        with self._cond:
+            self.updated_at = time.time()
+            self.events.append({"stage": stage, "ts": self.updated_at, **data})
+            self._cond.notify_all()
+
+    def set_status(self, status, result=None, error=None, status_code=None):
+        with self._cond:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.status_code = status_code
+        self.add_event("done" if status == "succeeded" else status)
+
+    @property
+    def finished(self):
+        return self.status in TERMINAL_STATUSES
+
+    def to_dict(self):
+        with self._cond:
+            data = {
+                "jobId": self.id,
+                "status": self.status,
+                "stage": self.events[-1]["stage"] if self.events else None,
+                "events": list(self.events),
+                "createdAt": self.created_at,
+                "updatedAt": self.updated_at,
+            }
+            expected_at = next(
+                (e["expected_at"] for e in reversed(self.events) if e.get("expected_at")), None
+            )
+            if expected_at and not self.finished:
+                # 预计剩余秒数 (来自轮询服务按模型统计的历史耗时)
+                data["eta"] = round(max(0.0, expected_at - time.time()), 1)
+            if self.status == "succeeded":
+                data["result"] = self.result
+            elif self.status == "failed":
+                data["error"] = self.error
+                data["statusCode"] = self.status_code
+            return data
+
+    def iter_events(self, keepalive=15):
+        """逐个产出事件，直到任务结束；长时间无事件时产出 None 作为心跳"""
+        cursor = 0
+        while True:
+            with self._cond:
+                if cursor >= len(self.events) and not self.finished:
+                    self._cond.wait(timeout=keepalive)
+                pending = self.events[cursor:]
+                cursor = len(self.events)
+                finished = self.finished
+            if not pending and not finished:
+                yield None
+            for event in pending:
+                yield event
+            if finished and cursor >= len(self.events):
+                return
+
+
+class JobManager:
+    """在有界线程池中运行 services.py 的“管理器”函数"""
+
+    def __init__(self, max_workers=JOB_WORKERS, queue_limit=JOB_QUEUE_LIMIT, ttl=JOB_TTL):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._queue_limit = queue_limit
+        self._ttl = ttl
+        self._jobs = {}
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def submit(self, app, task, owner_key):
+        """提交任务；task 是无参函数，返回可 JSON 序列化的结果"""
+        self._prune()
+        with self._lock:
+            if self._active >= self._queue_limit:
+                metrics.incr("jobs.rejected")
+                raise ServiceBusyError("当前生成任务过多，请稍后再试。")
+            self._active += 1
+            job = Job(owner_key)
+            self._jobs[job.id] = job
+        metrics.incr("jobs.submitted")
+        self._executor.submit(self._run, app, job, task)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            return {"active": self._active, "tracked": len(self._jobs)}
+
+    def _run(self, app, job, task):
+        token = _current_job.set(job)
+        started = time.time()
+        metrics.observe("jobs.queue_seconds", started - job.created_at)
+        try:
+            with app.app_context():
+                job.set_status("running")
+                try:
+                    result = task()
+                    job.set_status("succeeded", result=result)
+                    metrics.incr("jobs.succeeded")
+                except Exception as e:
+                    response, status_code = handle_api_errors(e)
+                    job.set_status("failed", error=response.get_json().get("error"), status_code=status_code)
+                    metrics.incr("jobs.failed")
+        finally:
+            _current_job.reset(token)
+            metrics.observe("jobs.run_seconds", time.time() - started)
+            with self._lock:
+                self._active -= 1
+
+    def _prune(self):
+        cutoff = time.time() - self._ttl
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished and job.updated_at < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+
+def report_progress(stage, **data):
+    """在当前 Job 中记录一个进度事件；同步请求中调用时不做任何事"""
+    job = _current_job.get()
+    if job is not None:
+        job.add_event(stage, **data)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = JobManager()
+                metrics.register_source("jobs", _manager.stats)
+    return _manager
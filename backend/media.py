@@ -0,0 +1,407 @@
+import os
+import uuid
+import base64
+import shutil
+import hashlib
+import mimetypes
+import threading
+from tempfile import SpooledTemporaryFile
+from io import BytesIO
+from contextlib import contextmanager
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from PIL import Image
+
+import metrics
+import image_pool
+from cache import TieredCache
+from jobs import report_progress
+from utils import InvalidUploadError
+
+# ==============================================================================
+# === 图像上传 (R2) 与尺寸预处理
+# ==============================================================================
+
+# --- R2 S3 客户端配置 ---
+R2_ENDPOINT_URL = os.getenv("R2_ENDPOINT_URL")
+R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
+R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
+R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
+R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
+R2_PUBLIC_URL_BASE = os.getenv("R2_PUBLIC_URL_BASE")
+# 本地用 MinIO 等 S3 兼容服务代替 R2 时：R2_ADDRESSING_STYLE=path，R2_REGION=us-east-1
+R2_REGION = os.getenv("R2_REGION", "auto")
+R2_ADDRESSING_STYLE = os.getenv("R2_ADDRESSING_STYLE", "auto")
+
+s3_client = boto3.client(
+    "s3",
+    endpoint_url=R2_ENDPOINT_URL,
+    aws_access_key_id=R2_ACCESS_KEY_ID,
+    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
+    region_name=R2_REGION,
+    config=Config(signature_version="s3v4", s3={"addressing_style": R2_ADDRESSING_STYLE}),
+)
+
+
+# 已上传对象的本地索引：内容哈希 -> 公共 URL 与尺寸
+R2_INDEX_TTL = float(os.getenv("R2_INDEX_TTL", str(30 * 24 * 3600)))
+_upload_index = TieredCache("r2_uploads", ttl=R2_INDEX_TTL, memory_size=4096, disk_size=100000)
+
+
+def _r2_head(file_name):
+    """
+    查询 R2 中是否已有该对象，存在时返回其元数据 (含上传时记录的宽高)，否则返回 None。
+    HEAD 失败 (如只写权限的 Token 返回 403) 时按未命中处理，继续上传。
+    """
+    try:
+        return s3_client.head_object(Bucket=R2_BUCKET_NAME, Key=file_name).get("Metadata", {})
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+            print(f"R2 HEAD {file_name} failed, uploading anyway: {e}")
+            metrics.incr("r2.head_errors")
+        return None
+
+
+def upload_to_r2(image, max_dim=None):
+    """
+    将图像 (base64 字符串或 ImageFile) 上传到 R2 并返回公共 URL 和尺寸。
+    指定 max_dim 时先把图片缩小到最长边不超过 max_dim (只解码一次) 再上传。
+    对象按原图内容哈希命名：同一张图片只处理、上传一次，重复提交时直接复用 (先查本地索引，再 HEAD 确认)。
+    """
+    try:
+        image = as_image_file(image)
+        if isinstance(image, ObjectImage) and _fits(image, None, max_dim):
+            # 浏览器已直传到 R2：直接使用该对象，图片字节不经过本服务
+            metrics.incr("r2.direct_reuses")
+            report_progress("uploaded", deduplicated=True)
+            return image.public_url, image.width, image.height
+        extension = image.mime_type.split("/")[-1]
+        digest = image.digest()
+        suffix = f"_max{max_dim}" if max_dim else ""
+        file_name = f"uploads/{digest}{suffix}.{extension}"
+        public_url = f"{R2_PUBLIC_URL_BASE}/{file_name}"
+
+        # 1. 本地索引命中：无需上传，也无需解码图片
+        known = _upload_index.get(file_name)
+        if known is not None:
+            metrics.incr("r2.index_hits")
+            report_progress("uploaded", deduplicated=True)
+            return known["url"], known["width"], known["height"]
+
+        # 2. 其他 worker / 历史部署已上传过：HEAD 确认后复用
+        meta = _r2_head(file_name)
+        if meta and meta.get("width") and meta.get("height"):
+            width, height = int(meta["width"]), int(meta["height"])
+            metrics.incr("r2.head_hits")
+        else:
+            # 3. 新图片：预处理 (尺寸合适时只解析文件头) 并上传，尺寸写入对象元数据
+            prepared = prepare_image(image, max_dim=max_dim)
+            width, height = prepared.width, prepared.height
+            if meta is None:
+                with prepared.image.open() as f:
+                    s3_client.upload_fileobj(
+                        f,
+                        R2_BUCKET_NAME,
+                        file_name,
+                        ExtraArgs={
+                            "ContentType": image.mime_type,
+                            "ACL": "public-read",
+                            "Metadata": {"width": str(width), "height": str(height)},
+                        },
+                    )
+                metrics.incr("r2.uploads")
+            else:
+                metrics.incr("r2.head_hits")
+
+        _upload_index.set(file_name, {"url": public_url, "width": width, "height": height})
+        report_progress("uploaded")
+        return public_url, width, height
+    except Exception as e:
+        print(f"R2 Upload Error: {e}")
+        raise Exception(f"Failed to upload image to R2 OSS: {e}")
+
+
+# ==============================================================================
+# === 感知哈希 (dHash)：重新编码、缩放、轻微压缩后的同一张图得到相近的哈希
+# ==============================================================================
+def image_dhash(image, hash_size=8):
+    """返回 hash_size*hash_size 位的差值哈希 (int)，大图在图像进程池中计算"""
+    with as_image_file(image).open() as f:
+        return image_pool.run("dhash", f, hash_size)
+
+
+# ==============================================================================
+# === 图像预处理：只解码一次，同时得到上传用的字节与宽高
+# ==============================================================================
+
+# VL 识图输入的最长边 (识图模型内部会再缩小，传原图只会浪费解码、上传与传输时间)
+VL_IMAGE_MAX_DIM = int(os.getenv("VL_IMAGE_MAX_DIM", "1536"))
+# 上传给图生图模型作为参考图的最长边
+UPLOAD_IMAGE_MAX_DIM = int(os.getenv("UPLOAD_IMAGE_MAX_DIM", "2048"))
+
+
+class ImageFile:
+    """
+    文件形式的图片 (multipart 上传时 Werkzeug 已把文件部分写入 SpooledTemporaryFile：小文件在内存，大文件在磁盘)。
+    本模块的函数同时接受 base64 data URL 字符串与 ImageFile，读取时按需从文件流中获取，不复制整份数据。
+    """
+
+    def __init__(self, stream, mime_type, filename=None, data_url=None):
+        self.stream = stream
+        self.mime_type = mime_type
+        self.filename = filename
+        self.data_url = data_url
+        self._digest = None
+        # 同一张图片可能被流水线的不同阶段读取，文件位置是共享状态
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file_storage(cls, storage):
+        """
+        由 request.files 中的 FileStorage 创建。
+        接管其底层文件：请求结束时 Werkzeug 会关闭 request.files，而异步 Job 在请求结束后才读取图片。
+        """
+        stream = storage.stream
+        storage.stream = BytesIO()
+        mime_type = storage.mimetype or mimetypes.guess_type(storage.filename or "")[0] or "application/octet-stream"
+        return cls(stream, mime_type, filename=storage.filename)
+
+    @classmethod
+    def from_data_url(cls, base64_string):
+        header, encoded = base64_string.split(",", 1)
+        mime_type = header.split(";")[0].split(":")[-1]
+        return cls(BytesIO(base64.b64decode(encoded)), mime_type, data_url=base64_string)
+
+    @contextmanager
+    def open(self):
+        with self._lock:
+            self.stream.seek(0)
+            yield self.stream
+
+    def digest(self):
+        """内容的 sha256 (按块计算)"""
+        if self._digest is None:
+            sha = hashlib.sha256()
+            with self.open() as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def to_data_url(self):
+        if self.data_url is None:
+            with self.open() as f:
+                self.data_url = f"data:{self.mime_type};base64,{base64.b64encode(f.read()).decode('utf-8')}"
+        return self.data_url
+
+
+def as_image_file(image):
+    """base64 data URL 字符串只解码一次，转换为 ImageFile；ImageFile 原样返回"""
+    return image if isinstance(image, ImageFile) else ImageFile.from_data_url(image)
+
+
+def image_digest(image):
+    return as_image_file(image).digest()
+
+
+class PreparedImage:
+    """预处理后的图像：ImageFile + 宽高。resized 表示内容已被缩放并重新编码。"""
+
+    __slots__ = ("image", "width", "height", "resized")
+
+    def __init__(self, image, width, height, resized=False):
+        self.image = image
+        self.width = width
+        self.height = height
+        self.resized = resized
+
+    @property
+    def mime_type(self):
+        return self.image.mime_type
+
+    def to_data_url(self):
+        return self.image.to_data_url()
+
+
+def _fit_dimensions(width, height, min_dim, max_dim):
+    """返回保持宽高比、两个维度都在 [min_dim, max_dim] 内的尺寸 (不需要调整时原样返回)"""
+    new_width, new_height = width, height
+    # 1. 检查是否过大 (Oversized)：取较小的比例，确保两个边都装得下
+    if max_dim and (new_width > max_dim or new_height > max_dim):
+        scale = min(max_dim / new_width, max_dim / new_height)
+        new_width, new_height = int(new_width * scale), int(new_height * scale)
+    # 2. 检查是否过小 (Undersized)：取较大的比例，确保两个边都达标
+    if min_dim and (new_width < min_dim or new_height < min_dim):
+        scale = max(min_dim / new_width, min_dim / new_height)
+        new_width, new_height = int(new_width * scale), int(new_height * scale)
+    return new_width, new_height
+
+
+def _fits(image, min_dim, max_dim):
+    return _fit_dimensions(image.width, image.height, min_dim, max_dim) == (image.width, image.height)
+
+
+# ==============================================================================
+# === 浏览器直传 R2：签发预签名 PUT URL，生成接口按对象键引用已上传的图片
+# ==============================================================================
+
+DIRECT_UPLOAD_PREFIX = "direct"
+DIRECT_UPLOAD_EXPIRES = int(os.getenv("DIRECT_UPLOAD_EXPIRES", "600"))
+DIRECT_UPLOAD_MAX_BYTES = int(os.getenv("DIRECT_UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+DIRECT_UPLOAD_TYPES = {"image/png": "png", "image/jpeg": "jpeg", "image/webp": "webp"}
+# 读取宽高时 Range GET 的文件头字节数；JPEG 的 EXIF 缩略图较大时依次扩大范围
+HEADER_RANGES = (64 * 1024, 1024 * 1024)
+
+
+def direct_upload_enabled():
+    return bool(R2_BUCKET_NAME and R2_PUBLIC_URL_BASE)
+
+
+def _owner_prefix(owner_key):
+    """按用户 Key 的哈希划分对象前缀，生成接口只接受本人上传的对象"""
+    owner = hashlib.sha256((owner_key or "").encode("utf-8")).hexdigest()[:16]
+    return f"{DIRECT_UPLOAD_PREFIX}/{owner}/"
+
+
+def presign_upload(owner_key, content_type, size):
+    """
+    签发一次性上传地址，浏览器用 PUT 直接把图片上传到 R2。
+    文件大小 (Content-Length) 包含在签名中，存储端拒绝大小不符的上传。
+    """
+    extension = DIRECT_UPLOAD_TYPES.get(content_type)
+    if extension is None:
+        raise InvalidUploadError(f"不支持的图片类型: {content_type}")
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise InvalidUploadError("缺少图片大小 (size)。")
+    if size <= 0 or size > DIRECT_UPLOAD_MAX_BYTES:
+        raise InvalidUploadError(f"图片大小超出限制 ({DIRECT_UPLOAD_MAX_BYTES // (1024 * 1024)}MB)。")
+    key = f"{_owner_prefix(owner_key)}{uuid.uuid4().hex}.{extension}"
+    upload_url = s3_client.generate_presigned_url(
+        "put_object",
+        Params={"Bucket": R2_BUCKET_NAME, "Key": key, "ContentType": content_type, "ContentLength": size},
+        ExpiresIn=DIRECT_UPLOAD_EXPIRES,
+    )
+    metrics.incr("r2.presigned")
+    return {
+        "key": key,
+        "uploadUrl": upload_url,
+        "method": "PUT",
+        "headers": {"Content-Type": content_type},
+        "publicUrl": f"{R2_PUBLIC_URL_BASE}/{key}",
+        "expiresIn": DIRECT_UPLOAD_EXPIRES,
+        "maxBytes": DIRECT_UPLOAD_MAX_BYTES,
+    }
+
+
+def _get_object(key, **kwargs):
+    try:
+        return s3_client.get_object(Bucket=R2_BUCKET_NAME, Key=key, **kwargs)
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+            raise InvalidUploadError("上传的图片不存在或已过期，请重新上传。")
+        raise
+
+
+class ObjectImage(ImageFile):
+    """
+    浏览器已直传到 R2 的图片 (按对象键引用)。
+    宽高通过 Range GET 只读取文件头获得；只有需要像素 (缩放、感知哈希) 时才下载整个对象。
+    """
+
+    def __init__(self, key, mime_type, size, etag, width, height):
+        super().__init__(None, mime_type, filename=key)
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.width = width
+        self.height = height
+        self.public_url = f"{R2_PUBLIC_URL_BASE}/{key}"
+
+    @classmethod
+    def from_key(cls, key, owner_key):
+        if not isinstance(key, str) or not key.startswith(_owner_prefix(owner_key)) or ".." in key:
+            raise InvalidUploadError("无效的图片对象键。")
+
+        for limit in HEADER_RANGES:
+            response = _get_object(key, Range=f"bytes=0-{limit - 1}")
+            header = response["Body"].read()
+            content_range = response.get("ContentRange") or ""
+            size = int(content_range.rsplit("/", 1)[-1]) if "/" in content_range else response["ContentLength"]
+            if size > DIRECT_UPLOAD_MAX_BYTES:
+                raise InvalidUploadError("图片过大，请压缩后重新上传。")
+            try:
+                with Image.open(BytesIO(header)) as img:
+                    width, height = img.size
+                break
+            except Exception:
+                if len(header) >= size:
+                    raise InvalidUploadError("无法识别上传的图片。")
+        else:
+            # 文件头异常大：下载整个对象读取尺寸
+            image = cls(key, response.get("ContentType"), size, response.get("ETag"), 0, 0)
+            with image.open() as f, Image.open(f) as img:
+                image.width, image.height = img.size
+            return image
+
+        metrics.incr("r2.header_reads")
+        mime_type = response.get("ContentType") or mimetypes.guess_type(key)[0]
+        return cls(key, mime_type, size, response.get("ETag"), width, height)
+
+    @contextmanager
+    def open(self):
+        with self._lock:
+            if self.stream is None:
+                self.stream = SpooledTemporaryFile(max_size=1024 * 1024)
+                shutil.copyfileobj(_get_object(self.key)["Body"], self.stream)
+                metrics.incr("r2.direct_downloads")
+            self.stream.seek(0)
+            yield self.stream
+
+    def digest(self):
+        if self._digest is None:
+            self._digest = hashlib.sha256(f"{self.key}:{self.etag}".encode("utf-8")).hexdigest()
+        return self._digest
+
+
+def prepare_image(image, min_dim=None, max_dim=None):
+    """
+    返回尺寸在 [min_dim, max_dim] 内的 PreparedImage。
+    先只解析文件头读取宽高，尺寸已在范围内时直接沿用原始内容；
+    需要缩放时交给图像进程池解码、缩放并重新编码。
+    """
+    image = as_image_file(image)
+    with image.open() as f:
+        with Image.open(f) as img:
+            width, height = img.size
+        new_width, new_height = _fit_dimensions(width, height, min_dim, max_dim)
+        if (new_width, new_height) == (width, height):
+            return PreparedImage(image, width, height)
+        data, pil_format, decoded_size = image_pool.run("resize", f, new_width, new_height)
+
+    print(
+        f"Image preprocess: {width}x{height} -> {new_width}x{new_height} "
+        f"({pil_format}, decoded at {decoded_size[0]}x{decoded_size[1]})."
+    )
+    return PreparedImage(ImageFile(BytesIO(data), image.mime_type), new_width, new_height, resized=True)
+
+
+# ==============================================================================
+# === DashScope 图像尺寸调整辅助函数
+# ==============================================================================
+def _resize_image_for_dashscope(image, min_dim=512, max_dim=4096):
+    """
+    辅助函数：确保图像的 *两个维度* 都在 [min_dim, max_dim] 范围内，并保持宽高比。
+    返回 DashScope 接口使用的 base64 data URL (传入字符串且尺寸合适时返回原字符串)。
+    """
+    try:
+        if isinstance(image, ObjectImage) and _fits(image, min_dim, max_dim):
+            # 已在 R2 上且尺寸合适：DashScope 接口直接接收公共 URL
+            return image.public_url
+        return prepare_image(image, min_dim=min_dim, max_dim=max_dim).to_data_url()
+    except Exception as e:
+        print(f"Error during image resize for DashScope: {e}")
+        raise Exception(f"图像调整失败: {e}")
@@ -0,0 +1,234 @@
+import os
+import re
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+import threading
+
+import metrics
+from cache import CACHE_DIR
+
+# ==============================================================================
+# === Met 馆藏离线索引
+# === 由 Met Open Access 的 MetObjects.csv (https://github.com/metmuseum/openaccess) 导入 SQLite FTS5 全文索引，
+# === 画廊搜索直接查本地索引，不再请求 Met /search。CSV 中没有图片地址，图片仍由作品详情接口 (带缓存) 获取。
+# ===   python met_index.py ingest MetObjects.csv
+# ==============================================================================
+
+MET_INDEX_PATH = os.getenv("MET_INDEX_PATH", os.path.join(CACHE_DIR, "met_index.sqlite3"))
+
+# 全文索引的列及 bm25 权重 (标题命中最重要)
+FTS_COLUMNS = ("title", "artist", "medium", "department", "culture", "object_date")
+FTS_WEIGHTS = (10.0, 6.0, 2.0, 1.0, 2.0, 1.0)
+
+INGEST_BATCH_SIZE = 5000
+
+_local = threading.local()
+
+
+def _connect():
+    """每个线程一个只读连接；索引文件被重新导入 (替换) 后自动重新打开"""
+    mtime = os.stat(MET_INDEX_PATH).st_mtime
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.mtime != mtime:
+        if conn is not None:
+            conn.close()
+        conn = sqlite3.connect(f"file:{MET_INDEX_PATH}?mode=ro", uri=True)
+        _local.conn = conn
+        _local.mtime = mtime
+    return conn
+
+
+def available():
+    return os.path.exists(MET_INDEX_PATH)
+
+
+# ==============================================================================
+# === 导入
+# ==============================================================================
+
+def _flag(value):
+    return 1 if (value or "").strip().lower() == "true" else 0
+
+
+def _year(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _rows(csv_path):
+    # 官方 CSV 带 BOM；多位艺术家以 "|" 分隔
+    with open(csv_path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            object_id = _year(row.get("Object ID"))
+            if object_id is None:
+                continue
+            culture = row.get("Culture", "")
+            geography = " | ".join(
+                value for value in (
+                    row.get("City"), row.get("State"), row.get("County"), row.get("Country"),
+                    row.get("Region"), row.get("Subregion"), culture,
+                ) if value
+            )
+            yield (
+                object_id,
+                row.get("Title", ""),
+                row.get("Artist Display Name", "").replace("|", ", "),
+                row.get("Medium", ""),
+                row.get("Department", ""),
+                culture,
+                row.get("Object Date", ""),
+                _year(row.get("Object Begin Date")),
+                _year(row.get("Object End Date")),
+                row.get("Classification", ""),
+                row.get("Object Name", ""),
+                geography,
+                _flag(row.get("Is Highlight")),
+                _flag(row.get("Is Public Domain")),
+                row.get("Link Resource", ""),
+            )
+
+
+def ingest(csv_path, index_path=MET_INDEX_PATH):
+    """导入 CSV 到临时文件，完成后原子替换旧索引 (导入期间搜索照常使用旧索引)"""
+    started = time.time()
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+    tmp_path = f"{index_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute(
+            "CREATE TABLE objects ("
+            " object_id INTEGER PRIMARY KEY, title TEXT, artist TEXT, medium TEXT, department TEXT,"
+            " culture TEXT, object_date TEXT, date_begin INTEGER, date_end INTEGER,"
+            " classification TEXT, object_name TEXT, geography TEXT,"
+            " is_highlight INTEGER NOT NULL, is_public_domain INTEGER NOT NULL, object_url TEXT)"
+        )
+        conn.execute(
+            f"CREATE VIRTUAL TABLE objects_fts USING fts5({', '.join(FTS_COLUMNS)},"
+            " content='objects', content_rowid='object_id', tokenize='unicode61 remove_diacritics 2')"
+        )
+
+        count = 0
+        batch = []
+        for row in _rows(csv_path):
+            batch.append(row)
+            if len(batch) >= INGEST_BATCH_SIZE:
+                conn.executemany(f"INSERT OR REPLACE INTO objects VALUES ({', '.join('?' * 15)})", batch)
+                count += len(batch)
+                batch = []
+                print(f"Met index: {count} objects loaded...")
+        if batch:
+            conn.executemany(f"INSERT OR REPLACE INTO objects VALUES ({', '.join('?' * 15)})", batch)
+            count += len(batch)
+
+        conn.execute("CREATE INDEX idx_objects_filters ON objects (is_public_domain, is_highlight, department)")
+        conn.execute("INSERT INTO objects_fts (objects_fts) VALUES ('rebuild')")
+        conn.execute("INSERT INTO objects_fts (objects_fts) VALUES ('optimize')")
+        conn.commit()
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, index_path)
+    print(f"Met index: {count} objects indexed into {index_path} in {time.time() - started:.1f}s.")
+    return count
+
+
+# ==============================================================================
+# === 搜索
+# ==============================================================================
+
+def _fts_query(q):
+    """用户输入 -> FTS5 查询：每个词作为短语 (避免 FTS5 语法字符报错)，词与词之间为 AND；'*' 或空查询返回 None"""
+    words = re.findall(r"\w+", q or "")
+    if not words:
+        return None
+    return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+
+def search(search_params, department=None, limit=None, offset=0):
+    """
+    参数与 Met /search 相同 (q, isHighlight, isPublicDomain, medium, geoLocation, dateBegin, dateEnd)，
+    部门由调用方换算为名称后通过 department 传入。返回与 Met /search 相同结构的 {"total", "objectIDs"}。
+    有查询词时按相关度排序，否则馆藏精选在前。
+    hasImages 无法在本地判断 (CSV 不含图片信息)，由获取作品详情时过滤。
+    """
+    started = time.time()
+    where, args = [], []
+    match = _fts_query(search_params.get("q"))
+    if match:
+        where.append("objects_fts MATCH ?")
+        args.append(match)
+    if str(search_params.get("isPublicDomain", "")).lower() == "true":
+        where.append("o.is_public_domain = 1")
+    if str(search_params.get("isHighlight", "")).lower() == "true":
+        where.append("o.is_highlight = 1")
+    if department:
+        where.append("o.department = ?")
+        args.append(department)
+    if search_params.get("medium"):
+        # Met 的 medium 参数按作品类别匹配 (Paintings、Ceramics 等)
+        where.append("(o.classification LIKE ? OR o.object_name LIKE ? OR o.medium LIKE ?)")
+        args.extend([f"%{search_params['medium']}%"] * 3)
+    if search_params.get("geoLocation"):
+        where.append("o.geography LIKE ?")
+        args.append(f"%{search_params['geoLocation']}%")
+    if _year(search_params.get("dateBegin")) is not None:
+        where.append("o.date_begin >= ?")
+        args.append(_year(search_params["dateBegin"]))
+    if _year(search_params.get("dateEnd")) is not None:
+        where.append("o.date_end <= ?")
+        args.append(_year(search_params["dateEnd"]))
+
+    if match:
+        # CROSS JOIN 固定先查全文索引再回表；否则 SQLite 可能先按过滤条件扫描 objects，再逐行做 MATCH
+        source = "objects_fts CROSS JOIN objects o ON o.object_id = objects_fts.rowid"
+        # 附加 object_id 使相关度相同的作品顺序固定，翻页结果不重复、不遗漏
+        order = f"bm25(objects_fts, {', '.join(str(w) for w in FTS_WEIGHTS)}), o.object_id"
+    else:
+        source = "objects o"
+        order = "o.is_highlight DESC, o.object_id"
+    where_sql = f" WHERE {' AND '.join(where)}" if where else ""
+
+    conn = _connect()
+    total = conn.execute(f"SELECT COUNT(*) FROM {source}{where_sql}", args).fetchone()[0]
+    page_sql = f"SELECT o.object_id FROM {source}{where_sql} ORDER BY {order}"
+    page_args = list(args)
+    if limit is not None:
+        page_sql += " LIMIT ? OFFSET ?"
+        page_args.extend([limit, offset])
+    object_ids = [row[0] for row in conn.execute(page_sql, page_args)]
+
+    metrics.observe("met_index.search_seconds", time.time() - started)
+    return {"total": total, "objectIDs": object_ids}
+
+
+def _stats():
+    return {"available": available(), "path": MET_INDEX_PATH}
+
+
+metrics.register_source("met_index", _stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Met 馆藏离线索引")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = subparsers.add_parser("ingest", help="导入 Met Open Access 的 MetObjects.csv")
+    ingest_parser.add_argument("csv_path")
+    ingest_parser.add_argument("--index-path", default=MET_INDEX_PATH)
+    args = parser.parse_args(argv)
+    if args.command == "ingest":
+        ingest(args.csv_path, args.index_path)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
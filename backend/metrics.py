@@ -0,0 +1,51 @@
+import threading
+
+# ==============================================================================
+# === 进程内监控指标 (计数器 / 耗时统计 / 动态数据源)
+# ==============================================================================
+
+_lock = threading.Lock()
+_counters = {}
+_timings = {}
+_sources = {}
+
+
+def incr(name, value=1):
+    """计数器自增"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """记录一次观测值 (如耗时秒数)，保存 count / sum / max"""
+    with _lock:
+        stat = _timings.setdefault(name, {"count": 0, "sum": 0.0, "max": 0.0})
+        stat["count"] += 1
+        stat["sum"] += value
+        if value > stat["max"]:
+            stat["max"] = value
+
+
+def register_source(name, fn):
+    """注册一个动态指标来源，fn() 在快照时被调用并返回可 JSON 序列化的字典"""
+    with _lock:
+        _sources[name] = fn
+
+
+def snapshot():
+    """返回所有指标的快照 (用于 /api/metrics)"""
+    with _lock:
+        counters = dict(_counters)
+        timings = {
+            name: {**stat, "avg": stat["sum"] / stat["count"] if stat["count"] else 0.0}
+            for name, stat in _timings.items()
+        }
+        sources = dict(_sources)
+
+    data = {"counters": counters, "timings": timings}
+    for name, fn in sources.items():
+        try:
+            data[name] = fn()
+        except Exception as e:
+            data[name] = {"error": str(e)}
+    return data
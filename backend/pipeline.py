@@ -0,0 +1,97 @@
+import os
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from flask import current_app
+
+import metrics
+
+# ==============================================================================
+# === 管理器流水线：按依赖关系执行各阶段，互不依赖的阶段并发执行
+# ==============================================================================
+
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="pipeline")
+
+
+def submit_in_context(executor, fn, *args):
+    """在线程池中执行 fn，并带上当前的 Flask 应用上下文与 Job 进度上下文"""
+    app = current_app._get_current_object()
+    ctx = contextvars.copy_context()
+
+    def run():
+        with app.app_context():
+            return fn(*args)
+
+    return executor.submit(ctx.run, run)
+
+
+class Pipeline:
+    """
+    用法：
+        pipe = Pipeline("modelscope.colorize")
+        pipe.stage("upload", lambda r: upload_to_r2(image))
+        pipe.stage("translate", lambda r: translate(prompt))
+        pipe.stage("generate", lambda r: generate(r["upload"], r["translate"]), after=("upload", "translate"))
+        results = pipe.run()
+    每个阶段函数接收已完成阶段的结果字典。任一阶段失败时取消尚未开始的阶段并抛出该异常。
+    各阶段耗时记录到 metrics (pipeline.<名称>.<阶段>)。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._stages = {}
+        self.timings = {}
+
+    def stage(self, name, fn, after=()):
+        for dep in after:
+            if dep not in self._stages:
+                raise ValueError(f"Pipeline '{self.name}': stage '{name}' depends on unknown stage '{dep}'.")
+        self._stages[name] = (fn, tuple(after))
+        return self
+
+    def _timed(self, name, fn, results):
+        started = time.time()
+        try:
+            return fn(results)
+        finally:
+            elapsed = time.time() - started
+            self.timings[name] = elapsed
+            metrics.observe(f"pipeline.{self.name}.{name}", elapsed)
+
+    def run(self):
+        started = time.time()
+        results = {}
+        pending = dict(self._stages)
+        running = {}
+        try:
+            while pending or running:
+                ready = [
+                    name for name, (_, after) in pending.items()
+                    if all(dep in results for dep in after)
+                ]
+                if len(ready) == 1 and not running:
+                    # 只有一个可执行阶段时直接在当前线程执行，不占用线程池
+                    name = ready[0]
+                    fn, _ = pending.pop(name)
+                    results[name] = self._timed(name, fn, dict(results))
+                    continue
+                for name in ready:
+                    fn, _ = pending.pop(name)
+                    running[submit_in_context(_executor, self._timed, name, fn, dict(results))] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+        except Exception:
+            for future in running:
+                future.cancel()
+            raise
+        finally:
+            total = time.time() - started
+            metrics.observe(f"pipeline.{self.name}.total", total)
+            summary = " ".join(f"{name}={seconds:.2f}s" for name, seconds in self.timings.items())
+            print(f"Pipeline {self.name}: {summary} (total {total:.2f}s)")
+        return results
@@ -0,0 +1,246 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+import http_pool
+import metrics
+
+# ==============================================================================
+# === 后台任务轮询服务 (所有异步图像任务共享少量线程)
+# ==============================================================================
+
+POLLER_TICK = float(os.getenv("POLLER_TICK", "0.5"))
+POLLER_WORKERS = int(os.getenv("POLLER_WORKERS", "4"))
+# 自适应轮询：预计完成前的紧密轮询间隔，以及开始预测所需的最少样本数
+POLLER_TIGHT_INTERVAL = float(os.getenv("POLLER_TIGHT_INTERVAL", "1"))
+POLLER_MIN_SAMPLES = int(os.getenv("POLLER_MIN_SAMPLES", "3"))
+POLLER_HISTORY_SIZE = int(os.getenv("POLLER_HISTORY_SIZE", "50"))
+
+
+class TaskTimeoutError(Exception):
+    """异步任务在规定时间内未完成"""
+
+    pass
+
+
+class LatencyModel:
+    """
+    按模型记录最近的任务耗时，用于预测完成时间 (ETA) 和安排轮询时机。
+    样本不足时退回固定间隔轮询。
+    """
+
+    def __init__(self, history_size=POLLER_HISTORY_SIZE, min_samples=POLLER_MIN_SAMPLES,
+                 tight_interval=POLLER_TIGHT_INTERVAL):
+        self._history = {}
+        self._history_size = history_size
+        self._min_samples = min_samples
+        self._tight_interval = tight_interval
+        self._lock = threading.Lock()
+
+    def record(self, model, seconds):
+        with self._lock:
+            history = self._history.setdefault(model, deque(maxlen=self._history_size))
+            history.append(seconds)
+
+    def estimate(self, model):
+        """返回 (p50, p90) 秒数；样本不足时返回 None"""
+        with self._lock:
+            samples = sorted(self._history.get(model, ()))
+        if len(samples) < self._min_samples:
+            return None
+        p50 = samples[len(samples) // 2]
+        p90 = samples[min(len(samples) - 1, int(len(samples) * 0.9))]
+        return p50, p90
+
+    def next_delay(self, model, elapsed, base_interval):
+        """
+        计算距下一次轮询的等待秒数：
+        预计完成前一直休眠到 p50 附近；p50~p90 (及少量余量) 之间紧密轮询；
+        超出预期后逐步退避回基础间隔。
+        """
+        estimate = self.estimate(model)
+        if estimate is None:
+            return base_interval
+        p50, p90 = estimate
+        wake_at = p50 * 0.9
+        if elapsed < wake_at:
+            return max(self._tight_interval, wake_at - elapsed)
+        tight_until = p90 * 1.2 + self._tight_interval
+        if elapsed < tight_until:
+            return self._tight_interval
+        overrun = (elapsed - tight_until) / max(p90, 1.0)
+        return min(base_interval, self._tight_interval * (1 + overrun * 2))
+
+    def snapshot(self):
+        with self._lock:
+            models = list(self._history.keys())
+        data = {}
+        for model in models:
+            estimate = self.estimate(model)
+            with self._lock:
+                count = len(self._history.get(model, ()))
+            data[model] = {
+                "samples": count,
+                "p50": estimate[0] if estimate else None,
+                "p90": estimate[1] if estimate else None,
+            }
+        return data
+
+
+class _PolledTask:
+    def __init__(self, task_id, query_url, headers, parse, interval, timeout, label, model, first_delay):
+        self.task_id = task_id
+        self.query_url = query_url
+        self.headers = headers
+        self.parse = parse
+        self.interval = interval
+        self.label = label
+        self.model = model
+        self.future = Future()
+        self.started_at = time.time()
+        self.deadline = self.started_at + timeout
+        self.next_poll = self.started_at + first_delay
+        self.polls = 0
+        # 查询进行中：调度线程不会重复提交同一任务
+        self.in_flight = False
+
+
+class TaskPoller:
+    """
+    统一跟踪所有未完成的 ModelScope / DashScope 任务。
+    单个调度线程按共享节拍挑出到期的任务交给小线程池查询 (提交后不等待结果)，
+    每次查询结束时自行安排该任务的下一次轮询；任务结束时通过 Future 唤醒等待中的请求。
+    """
+
+    def __init__(self, tick=POLLER_TICK, max_workers=POLLER_WORKERS):
+        self._tick = tick
+        self.latency = LatencyModel()
+        self._tasks = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="task-poller"
+        )
+        self._thread = threading.Thread(
+            target=self._run, name="task-poller-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def watch(self, task_id, query_url, headers, parse, interval=3, timeout=180, label="", model=None):
+        """
+        登记一个待轮询任务，返回 Future。
+        parse(data) 在任务未完成时返回 None，成功时返回结果，失败时抛出异常。
+        model 用于按模型累计耗时并自适应安排轮询；interval 为无历史数据时的固定间隔。
+        """
+        model = model or label or "default"
+        first_delay = self.latency.next_delay(model, 0.0, interval)
+        task = _PolledTask(task_id, query_url, headers, parse, interval, timeout, label, model, first_delay)
+        with self._cond:
+            self._tasks[id(task)] = task
+            self._cond.notify()
+        metrics.incr("poller.tasks_watched")
+        return task.future
+
+    def eta(self, model):
+        """返回模型的预计耗时 (p50 秒数)，无历史数据时返回 None"""
+        estimate = self.latency.estimate(model)
+        return estimate[0] if estimate else None
+
+    def outstanding(self):
+        with self._cond:
+            return len(self._tasks)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                idle = [t for t in self._tasks.values() if not t.in_flight]
+                due = [t for t in idle if t.next_poll <= now]
+                if not due:
+                    next_due = min((t.next_poll for t in idle), default=None)
+                    wait_for = self._tick if next_due is None else max(0.0, min(self._tick, next_due - now))
+                    self._cond.wait(timeout=wait_for)
+                    continue
+                for task in due:
+                    task.in_flight = True
+
+            # 只提交不等待：某个查询变慢 (最长到其超时) 不会推迟其他任务的轮询
+            for task in due:
+                self._executor.submit(self._poll_one, task)
+
+    def _finish(self, task, result=None, error=None):
+        with self._cond:
+            self._tasks.pop(id(task), None)
+        metrics.observe("poller.task_seconds", time.time() - task.started_at)
+        if error is not None:
+            metrics.incr("poller.tasks_failed")
+            task.future.set_exception(error)
+        else:
+            metrics.incr("poller.tasks_succeeded")
+            self.latency.record(task.model, time.time() - task.started_at)
+            task.future.set_result(result)
+
+    def _poll_one(self, task):
+        try:
+            self._poll(task)
+        finally:
+            with self._cond:
+                task.in_flight = False
+                self._cond.notify()
+
+    def _poll(self, task):
+        task.polls += 1
+        metrics.incr("poller.polls")
+        try:
+            response = http_pool.get(task.query_url, headers=task.headers, timeout=10)
+            response.raise_for_status()
+            result = task.parse(response.json())
+        except requests.exceptions.HTTPError as e:
+            # 4xx 视为不可恢复 (如 Key 失效)，5xx 视为暂时性错误，下个周期重试
+            if e.response is not None and e.response.status_code < 500:
+                self._finish(task, error=e)
+                return
+            print(f"Poller: transient error for task {task.task_id}: {e}")
+            result = None
+        except requests.exceptions.RequestException as e:
+            print(f"Poller: transient error for task {task.task_id}: {e}")
+            result = None
+        except Exception as e:
+            self._finish(task, error=e)
+            return
+
+        if result is not None:
+            self._finish(task, result=result)
+            return
+
+        now = time.time()
+        if now >= task.deadline:
+            self._finish(
+                task,
+                error=TaskTimeoutError(
+                    f"{task.label or 'Async'} task {task.task_id} polling timed out after {int(now - task.started_at)} seconds."
+                ),
+            )
+            return
+        task.next_poll = now + self.latency.next_delay(task.model, now - task.started_at, task.interval)
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    """返回进程内唯一的 TaskPoller (首次使用时启动，兼容 gunicorn fork)"""
+    global _poller
+    if _poller is None:
+        with _poller_lock:
+            if _poller is None:
+                _poller = TaskPoller()
+                metrics.register_source("poller", lambda: {
+                    "outstanding": _poller.outstanding(),
+                    "models": _poller.latency.snapshot(),
+                })
+    return _poller
@@ -0,0 +1,615 @@
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import unicodedata
+from abc import ABC, abstractmethod
+
+from prompt import PROMPTS
+from utils import calculate_adaptive_size, ApiKeyMissingError
+import api as executors
+from jobs import report_progress
+from media import (
+    upload_to_r2, _resize_image_for_dashscope, image_dhash, image_digest,
+    VL_IMAGE_MAX_DIM, UPLOAD_IMAGE_MAX_DIM,
+)
+from cache import TieredCache, PerceptualIndex, make_key
+import metrics
+from pipeline import Pipeline
+
+# ==============================================================================
+# === 平台提供方 (Provider) 注册表
+# === 每个平台实现同一组能力：聊天、单轮生成、识图 (VL)、文生图、图像编辑。
+# === services.py 的“管理器”按 config["api_platform"] 选择提供方。
+# ==============================================================================
+
+# 人像工坊预设风格 (wanx-style-repaint 的 style_index 与中文名称对应)
+PORTRAIT_STYLE_MAP = {
+    0: "复古漫画", 1: "3D童话", 2: "二次元", 3: "小清新", 4: "未来科技",
+    5: "国画古风", 6: "将军百战", 7: "炫彩卡通", 8: "清雅国风",
+    9: "喜迎新年", 14: "国风工笔", 15: "恭贺新禧", 30: "童话世界",
+    31: "黏土世界", 32: "像素世界", 33: "冒险世界", 34: "日漫世界",
+    35: "3D世界", 36: "二次元世界", 37: "手绘世界", 38: "蜡笔世界",
+    39: "冰箱贴世界", 40: "吧唧世界"
+}
+
+
+class Provider(ABC):
+    """
+    平台提供方接口。子类必须实现全部抽象方法，否则实例化 (注册) 时即报错，而不是等到请求时才失败。
+    image_edit 的 mode:
+      - "colorize": 线稿上色 (prompt_cn 为风格提示)
+      - "stylize":  创意工坊风格迁移 (style_image_b64 或 prompt_cn 二选一)
+      - "portrait": 人像风格化 (style_image_b64 或 style_index 二选一)
+    """
+
+    name = None
+
+    @abstractmethod
+    def chat(self, config, ms_key, messages, system_prompt):
+        """多轮对话，返回 {"role": ..., "content": ...}"""
+
+    @abstractmethod
+    def stream_chat(self, config, ms_key, messages, system_prompt):
+        """多轮对话 (流式)，逐段产出增量文本"""
+
+    @abstractmethod
+    def generate(self, config, ms_key, prompt, max_tokens=800, temp=0.5):
+        """单轮生成，返回文本"""
+
+    @abstractmethod
+    def vl_chat(self, config, ms_key, image_b64, text, system_prompt=None):
+        """识图，返回文本"""
+
+    def prepare_image_prompt(self, config, ms_key, prompt_cn, context):
+        """将中文图像描述转换为该平台图像模型使用的提示词"""
+        return prompt_cn
+
+    def prepare_image_prompts(self, config, ms_key, prompts_cn):
+        """
+        批量版 prepare_image_prompt，返回与输入等长的列表。
+        无法批量处理的条目为 None，由调用方逐条回退到 prepare_image_prompt。
+        """
+        return [None] * len(prompts_cn)
+
+    @abstractmethod
+    def image_gen(self, config, ms_key, prompt, negative_prompt=None):
+        """文生图 (prompt 来自 prepare_image_prompt)，返回图片 URL"""
+
+    @abstractmethod
+    def image_edit(self, config, ms_key, mode, image_b64, prompt_cn=None, style_image_b64=None, style_index=None):
+        """图像编辑，返回图片 URL"""
+
+
+# 提示词翻译缓存：相同的 (中文描述, 上下文, 模型) 直接复用之前的英文提示词
+PROMPT_CACHE_TTL = float(os.getenv("PROMPT_CACHE_TTL", str(30 * 24 * 3600)))
+PROMPT_CACHE_MEMORY_SIZE = int(os.getenv("PROMPT_CACHE_MEMORY_SIZE", "1024"))
+PROMPT_CACHE_DISK_SIZE = int(os.getenv("PROMPT_CACHE_DISK_SIZE", "50000"))
+# 批量翻译不带上下文，使用独立的上下文标记，避免与单条翻译结果混用
+BATCH_TRANSLATION_CONTEXT = "<batch>"
+
+_prompt_cache = TieredCache(
+    "prompt_translation",
+    ttl=PROMPT_CACHE_TTL,
+    memory_size=PROMPT_CACHE_MEMORY_SIZE,
+    disk_size=PROMPT_CACHE_DISK_SIZE,
+)
+
+
+# 风格分析缓存：感知哈希相近 (汉明距离 <= STYLE_CACHE_MAX_DISTANCE，共 64 位) 的风格图复用之前的分析结果
+STYLE_CACHE_TTL = float(os.getenv("STYLE_CACHE_TTL", str(30 * 24 * 3600)))
+STYLE_CACHE_MAX_DISTANCE = int(os.getenv("STYLE_CACHE_MAX_DISTANCE", "6"))
+STYLE_CACHE_SIZE = int(os.getenv("STYLE_CACHE_SIZE", "5000"))
+
+_style_indexes = {}
+
+
+def _style_index(variant):
+    """每种 (平台, VL 模型, 描述语言) 一个独立索引，不同模型/语言的描述互不混用"""
+    index = _style_indexes.get(variant)
+    if index is None:
+        index = _style_indexes.setdefault(variant, PerceptualIndex(
+            f"style_analysis/{variant}",
+            ttl=STYLE_CACHE_TTL,
+            max_distance=STYLE_CACHE_MAX_DISTANCE,
+            max_entries=STYLE_CACHE_SIZE,
+        ))
+    return index
+
+
+def cached_style_analysis(variant, style_image_b64, analyze):
+    """按风格图的感知哈希查找缓存的风格描述；未命中时调用 analyze() 并写入缓存"""
+    try:
+        image_hash = image_dhash(style_image_b64)
+    except Exception as e:
+        # 无法解码的图片交给上游处理 (上游会给出更明确的错误)
+        print(f"Style cache: failed to hash style image ({e}). Skipping cache.")
+        return analyze()
+
+    index = _style_index(variant)
+    description = index.get(image_hash)
+    if description is not None:
+        print(f"Style cache hit ({variant}, dHash {image_hash:016x}).")
+        metrics.incr("style_cache.hits")
+        return description
+
+    metrics.incr("style_cache.misses")
+    description = analyze()
+    if description and description.strip():
+        index.add(image_hash, description)
+    return description
+
+
+def _normalize_description(text):
+    """统一全角/半角与空白，使仅有格式差异的描述命中同一缓存条目"""
+    return " ".join(unicodedata.normalize("NFKC", text or "").split())
+
+
+def _prompt_cache_key(config, chinese_description, context):
+    return make_key(_normalize_description(chinese_description), context, config["ms_chat_model"])
+
+
+def translate_prompt_modelscope(config, ms_key, chinese_description, context):
+    """使用 PROMPT_TRANSLATOR 将中文描述翻译为英文图像提示词 (ModelScope LLM，带缓存)"""
+    cache_key = _prompt_cache_key(config, chinese_description, context)
+    english_prompt = _prompt_cache.get(cache_key)
+    if english_prompt is None:
+        translator_prompt = PROMPTS["PROMPT_TRANSLATOR"].format(
+            context=context, chinese_description=chinese_description
+        )
+        english_prompt = executors.run_llm_generation_modelscope(
+            config, ms_key, translator_prompt
+        )
+        if english_prompt and english_prompt.strip():
+            _prompt_cache.set(cache_key, english_prompt)
+    report_progress("translated")
+    return english_prompt
+
+
+_JSON_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+
+def _parse_translation_list(content, expected):
+    """
+    解析批量翻译返回的 JSON 字符串列表，返回长度为 expected 的列表，无效条目为 None。
+    先按 JSON 解析；失败时 (如多余文字、缺少逗号) 退而逐个提取字符串字面量。
+    条目数量对不上时无法确定对应关系，全部视为无效。
+    """
+    cleaned = content.replace("```json", "").replace("```", "").strip()
+    start, end = cleaned.find("["), cleaned.rfind("]")
+    body = cleaned[start:end + 1] if start != -1 and end > start else cleaned
+    try:
+        items = json.loads(body)
+        if not isinstance(items, list):
+            items = None
+    except ValueError:
+        items = None
+    if items is None:
+        items = []
+        for literal in _JSON_STRING_RE.findall(body):
+            try:
+                items.append(json.loads(literal))
+            except ValueError:
+                items.append(None)
+    if len(items) != expected:
+        print(f"Batch translation returned {len(items)} items for {expected} inputs.")
+        return [None] * expected
+    return [item.strip() if isinstance(item, str) and item.strip() else None for item in items]
+
+
+def translate_prompts_batch_modelscope(config, ms_key, chinese_descriptions):
+    """使用 BATCH_PROMPT_TRANSLATOR 一次翻译多条中文描述，无效条目为 None"""
+    cache_keys = [
+        _prompt_cache_key(config, description, BATCH_TRANSLATION_CONTEXT)
+        for description in chinese_descriptions
+    ]
+    translated = [_prompt_cache.get(key) for key in cache_keys]
+    # 只把缓存未命中的条目发给 LLM
+    missing = [i for i, text in enumerate(translated) if text is None]
+    if missing:
+        translator_prompt = PROMPTS["BATCH_PROMPT_TRANSLATOR"].format(
+            json_input_list=json.dumps([chinese_descriptions[i] for i in missing], ensure_ascii=False)
+        )
+        content = executors.run_llm_generation_modelscope(
+            config, ms_key, translator_prompt, max_tokens=400 * len(missing)
+        )
+        for i, text in zip(missing, _parse_translation_list(content, len(missing))):
+            translated[i] = text
+            if text is not None:
+                _prompt_cache.set(cache_keys[i], text)
+    report_progress("translated", count=sum(1 for t in translated if t))
+    return translated
+
+
+class ModelScopeProvider(Provider):
+    """ModelScope：图片先上传 R2，中文提示词翻译为英文后交给 FLUX"""
+
+    name = "modelscope"
+
+    def chat(self, config, ms_key, messages, system_prompt):
+        response_json = executors.run_llm_chat_modelscope(config, ms_key, messages, system_prompt)
+        return response_json["choices"][0]["message"]
+
+    def stream_chat(self, config, ms_key, messages, system_prompt):
+        return executors.stream_llm_chat_modelscope(config, ms_key, messages, system_prompt)
+
+    def generate(self, config, ms_key, prompt, max_tokens=800, temp=0.5):
+        return executors.run_llm_generation_modelscope(config, ms_key, prompt, max_tokens, temp)
+
+    def vl_chat(self, config, ms_key, image_b64, text, system_prompt=None):
+        public_url, _, _ = upload_to_r2(image_b64, max_dim=VL_IMAGE_MAX_DIM)
+        content = [
+            {"type": "image_url", "image_url": {"url": public_url}},
+            {"type": "text", "text": text}
+        ]
+        return executors.run_vl_chat_modelscope(config, ms_key, system_prompt, content)
+
+    def prepare_image_prompt(self, config, ms_key, prompt_cn, context):
+        return translate_prompt_modelscope(config, ms_key, prompt_cn, context=context)
+
+    def prepare_image_prompts(self, config, ms_key, prompts_cn):
+        try:
+            return translate_prompts_batch_modelscope(config, ms_key, prompts_cn)
+        except Exception as e:
+            print(f"ModelScope batch translation failed, falling back to per-item: {e}")
+            return [None] * len(prompts_cn)
+
+    def image_gen(self, config, ms_key, prompt, negative_prompt=None):
+        img_body = {
+            "model": config["ms_image_model"],
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+            "size": "1024x1024",
+        }
+        return executors.run_image_gen_modelscope(config, ms_key, img_body, sync=True)
+
+    def _analyze_style(self, config, ms_key, style_image_b64):
+        return cached_style_analysis(
+            f"modelscope/{config['ms_vl_model']}/en", style_image_b64,
+            lambda: self.vl_chat(
+                config, ms_key, style_image_b64, PROMPTS["STYLE_ANALYSIS_USER"],
+                system_prompt=PROMPTS["STYLE_ANALYSIS_SYSTEM"]
+            )
+        )
+
+    def image_edit(self, config, ms_key, mode, image_b64, prompt_cn=None, style_image_b64=None, style_index=None):
+        if mode == "colorize":
+            print("ModelScope Manager: Uploading to R2 and calling LLM/ImageGen for colorization.")
+            full_chinese_prompt_for_translator = PROMPTS["COLORIZE_PROMPT_CN"].format(
+                prompt=prompt_cn, age_range=config["age_range"]
+            )
+            ms_negative_prompt = "text, watermark, signature, blurry, low quality, worst quality, deformed, ugly, grayscale, monochrome, sketch, unfinished, lineart"
+
+            def generate(r):
+                public_url, w, h = r["upload"]
+                body = {
+                    "model": config["ms_image_model"],
+                    "prompt": r["translate"],
+                    "negative_prompt": ms_negative_prompt,
+                    "image_url": public_url,
+                    "size": calculate_adaptive_size(w, h),
+                }
+                return executors.run_image_gen_modelscope(config, ms_key, body)
+
+            # 上传与翻译互不依赖，并发执行
+            pipe = Pipeline("modelscope.colorize")
+            pipe.stage("upload", lambda r: upload_to_r2(image_b64, max_dim=UPLOAD_IMAGE_MAX_DIM))
+            pipe.stage("translate", lambda r: translate_prompt_modelscope(
+                config, ms_key, full_chinese_prompt_for_translator,
+                context="Coloring a lineart image."
+            ))
+            pipe.stage("generate", generate, after=("upload", "translate"))
+            return pipe.run()["generate"]
+
+        if mode == "stylize":
+            print("ModelScope Manager: Calling LLM/VL/ImageGen for creative workshop.")
+            pipe = Pipeline("modelscope.stylize")
+            if image_b64:
+                pipe.stage("upload", lambda r: upload_to_r2(image_b64, max_dim=UPLOAD_IMAGE_MAX_DIM))
+
+            if style_image_b64:
+                # --- 模式二: 图像风格  ---
+                print("ModelScope Creative Workshop: Image Style Mode")
+                pipe.stage("prompt", lambda r: PROMPTS["ART_FUSION_PROMPT_EN"].format(
+                    style_description=self._analyze_style(config, ms_key, style_image_b64)
+                ))
+            elif prompt_cn:
+                # --- 模式一: 文本指令 ---
+                print("ModelScope Creative Workshop: Text Instruction Mode")
+                pipe.stage("prompt", lambda r: translate_prompt_modelscope(
+                    config, ms_key, prompt_cn,
+                    context="Applying creative style based on user instruction."
+                ))
+            else:
+                raise ValueError("Creative workshop requires either a style image or a text prompt.")
+
+            ms_negative_prompt = "text, watermark, signature, blurry, low quality, worst quality, deformed, ugly, bad anatomy"
+
+            def generate(r):
+                public_content_url, w, h = r.get("upload", (None, 0, 0))
+                body = {
+                    "model": config["ms_image_model"],
+                    "prompt": r["prompt"],
+                    "negative_prompt": ms_negative_prompt,
+                    "size": calculate_adaptive_size(w, h) if w > 0 else "1024x1024",
+                }
+                if public_content_url:
+                    body["image_url"] = public_content_url
+                    body["strength"] = 0.6
+                return executors.run_image_gen_modelscope(config, ms_key, body)
+
+            pipe.stage("generate", generate, after=("upload", "prompt") if image_b64 else ("prompt",))
+            return pipe.run()["generate"]
+
+        if mode == "portrait":
+            print("ModelScope Manager: Simulating portrait workshop using LLM/ImageGen.")
+            if not ms_key:
+                raise ApiKeyMissingError("ModelScope Key not found in config for portrait workshop.")
+
+            pipe = Pipeline("modelscope.portrait")
+            if style_index is not None:
+                style_name = PORTRAIT_STYLE_MAP.get(style_index, f"预设风格{style_index}")
+                chinese_prompt = PROMPTS["SELF_PORTRAIT_PROMPT_CN"].format(style_prompt=style_name)
+                pipe.stage("prompt", lambda r: translate_prompt_modelscope(
+                    config, ms_key, chinese_prompt,
+                    context=f"Stylizing a portrait into preset style {style_name}."
+                ))
+            elif style_image_b64:
+                pipe.stage("prompt", lambda r: (
+                    f"A portrait in the style of [{self._analyze_style(config, ms_key, style_image_b64)}], "
+                    "masterpiece, best quality. Must preserve face features."
+                ))
+            else:
+                raise ValueError("Portrait workshop requires either a style image or a preset style index.")
+
+            pipe.stage("upload", lambda r: upload_to_r2(image_b64, max_dim=UPLOAD_IMAGE_MAX_DIM))
+            ms_negative_prompt = "text, watermark, signature, blurry, ugly, deformed, disfigured, worst quality, low quality, multiple heads, bad anatomy, extra limbs, mutation, gender swap"
+
+            def generate(r):
+                public_portrait_url, w, h = r["upload"]
+                body = {
+                    "model": config["ms_image_model"],
+                    "prompt": r["prompt"],
+                    "negative_prompt": ms_negative_prompt,
+                    "image_url": public_portrait_url,
+                    "size": calculate_adaptive_size(w, h),
+                    "strength": 0.65
+                }
+                return executors.run_image_gen_modelscope(config, ms_key, body)
+
+            pipe.stage("generate", generate, after=("upload", "prompt"))
+            return pipe.run()["generate"]
+
+        raise ValueError(f"Unsupported image edit mode: {mode}")
+
+
+class DashScopeProvider(Provider):
+    """阿里云百炼 (DashScope)：图片调整尺寸后直接以 base64 传入，中文提示词直接使用"""
+
+    name = "bailian"
+
+    def chat(self, config, ms_key, messages, system_prompt):
+        message_obj = executors.run_llm_chat_dashscope(config, messages, system_prompt)
+        return {"role": message_obj.role, "content": message_obj.content}
+
+    def stream_chat(self, config, ms_key, messages, system_prompt):
+        return executors.stream_llm_chat_dashscope(config, messages, system_prompt)
+
+    def generate(self, config, ms_key, prompt, max_tokens=800, temp=0.5):
+        return executors.run_llm_generation_dashscope(config, prompt, max_tokens, temp)
+
+    def vl_chat(self, config, ms_key, image_b64, text, system_prompt=None):
+        resized_image = _resize_image_for_dashscope(image_b64, max_dim=VL_IMAGE_MAX_DIM)
+        content = [
+            {"image": resized_image},
+            {"text": text}
+        ]
+        return executors.run_vl_chat_dashscope(config, content)
+
+    def image_gen(self, config, ms_key, prompt, negative_prompt=None):
+        return executors.run_text_to_image_dashscope(config, prompt=prompt)
+
+    def _analyze_style(self, config, ms_key, style_image_b64):
+        return cached_style_analysis(
+            f"bailian/{config['ds_vl_id']}/zh", style_image_b64,
+            lambda: self.vl_chat(
+                config, ms_key, style_image_b64, PROMPTS["STYLE_ANALYSIS_USER"] + " 请用中文描述风格。"
+            )
+        )
+
+    def image_edit(self, config, ms_key, mode, image_b64, prompt_cn=None, style_image_b64=None, style_index=None):
+        if mode == "colorize":
+            print("DashScope Manager: Calling wanx2.1-imageedit (doodle) for colorization.")
+            doodle_prompt = f"{prompt_cn}风格。"
+            if config["age_range"] in ["6-8岁", "9-10岁"]:
+                doodle_prompt += " 色彩明亮, 卡通风格。"
+            elif config["age_range"] in ["13-15岁", "16-18岁"]:
+                doodle_prompt += " 细节丰富, 写实光影。"
+            return executors.run_image_edit_wanx21_dashscope(
+                config=config,
+                function="doodle",
+                base_image_b64=_resize_image_for_dashscope(image_b64),
+                prompt=doodle_prompt,
+                is_sketch='false'
+            )
+
+        if mode == "stylize":
+            if style_image_b64:
+                # --- 模式二: 图像风格 ---
+                print("DashScope Manager: Simulating style transfer using VL and wanx2.1-imageedit (stylization_all).")
+                pipe = Pipeline("bailian.stylize")
+                # 1. 调整内容图尺寸，同时调用 VL 分析风格图 (获取文本描述)
+                pipe.stage("resize", lambda r: _resize_image_for_dashscope(image_b64))
+                pipe.stage("analyze", lambda r: self._analyze_style(config, ms_key, style_image_b64))
+                # 2. 调用 stylization_all
+                pipe.stage("edit", lambda r: executors.run_image_edit_wanx21_dashscope(
+                    config=config,
+                    function="stylization_all",
+                    base_image_b64=r["resize"],
+                    prompt=f"转换成 [{r['analyze']}] 风格",
+                    strength=0.6
+                ), after=("resize", "analyze"))
+                return pipe.run()["edit"]
+            elif prompt_cn:
+                # --- 模式一: 文本指令 ---
+                return executors.run_image_edit_wanx21_dashscope(
+                    config=config,
+                    function="stylization_all",
+                    base_image_b64=_resize_image_for_dashscope(image_b64),
+                    prompt=prompt_cn
+                )
+            raise ValueError("Creative workshop requires either a style image or a text prompt.")
+
+        if mode == "portrait":
+            print("DashScope Manager: Calling wanx-style-repaint for portrait workshop.")
+            resized_portrait_image = _resize_image_for_dashscope(image_b64)
+            if style_image_b64 is not None:
+                # --- 自定义风格模式 ---
+                print("DashScope Manager: Custom style mode selected.")
+                return executors.run_portrait_stylization_dashscope(
+                    config=config,
+                    base_image_b64=resized_portrait_image,
+                    style_image_b64=_resize_image_for_dashscope(style_image_b64),
+                    style_index=-1
+                )
+            elif style_index is not None:
+                # --- 预设风格模式 ---
+                print(f"DashScope Manager: Preset style mode selected (Index: {style_index}).")
+                return executors.run_portrait_stylization_dashscope(
+                    config=config,
+                    base_image_b64=resized_portrait_image,
+                    style_image_b64=None,
+                    style_index=style_index
+                )
+            raise ValueError("Portrait workshop requires either a style image or a preset style index.")
+
+        raise ValueError(f"Unsupported image edit mode: {mode}")
+
+
+# ==============================================================================
+# === 本地模拟提供方 (用于离线压测)
+# ==============================================================================
+
+MOCK_PROVIDER_ENABLED = os.getenv("MOCK_PROVIDER_ENABLED", "").lower() in ("1", "true", "yes")
+MOCK_TEXT_LATENCY_MS = float(os.getenv("MOCK_TEXT_LATENCY_MS", "300"))
+MOCK_IMAGE_LATENCY_MS = float(os.getenv("MOCK_IMAGE_LATENCY_MS", "3000"))
+MOCK_LATENCY_SIGMA = float(os.getenv("MOCK_LATENCY_SIGMA", "0.3"))
+MOCK_FAILURE_RATE = float(os.getenv("MOCK_FAILURE_RATE", "0"))
+MOCK_SEED = os.getenv("MOCK_SEED", "artspark")
+
+# 前端自带的示例图片，保证模拟结果在页面上可以正常显示
+MOCK_IMAGE_URLS = [
+    "/img/cloud-boy.png",
+    "/img/line-color.png",
+    "/img/lineart.png",
+    "/img/moodpainting-a.png",
+    "/img/style-pic.png",
+]
+
+
+class MockProviderError(Exception):
+    """模拟提供方按配置的失败率注入的错误"""
+
+    pass
+
+
+class MockProvider(Provider):
+    """
+    确定性的模拟提供方：相同输入总是得到相同输出与相同延迟。
+    延迟服从以 MOCK_*_LATENCY_MS 为中位数、MOCK_LATENCY_SIGMA 为参数的对数正态分布，
+    并按 MOCK_FAILURE_RATE 注入失败。
+    """
+
+    name = "mock"
+
+    def __init__(self, text_latency_ms=MOCK_TEXT_LATENCY_MS, image_latency_ms=MOCK_IMAGE_LATENCY_MS,
+                 sigma=MOCK_LATENCY_SIGMA, failure_rate=MOCK_FAILURE_RATE, seed=MOCK_SEED):
+        self.text_latency_ms = text_latency_ms
+        self.image_latency_ms = image_latency_ms
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.seed = seed
+
+    def _simulate(self, op, latency_ms, *parts):
+        digest = hashlib.sha256(
+            "\x1f".join([self.seed, op] + [str(p) for p in parts]).encode("utf-8")
+        ).hexdigest()
+        rng = random.Random(digest)
+        time.sleep(latency_ms * rng.lognormvariate(0, self.sigma) / 1000.0)
+        if rng.random() < self.failure_rate:
+            raise MockProviderError(f"Mock provider injected failure ({op})")
+        return digest
+
+    def _text(self, op, *parts):
+        digest = self._simulate(op, self.text_latency_ms, *parts)
+        return f"[mock {op} {digest[:8]}]"
+
+    def _image(self, op, *parts):
+        digest = self._simulate(op, self.image_latency_ms, *parts)
+        return MOCK_IMAGE_URLS[int(digest, 16) % len(MOCK_IMAGE_URLS)]
+
+    def chat(self, config, ms_key, messages, system_prompt):
+        return {"role": "assistant", "content": self._text("chat", system_prompt, json.dumps(messages, ensure_ascii=False))}
+
+    def stream_chat(self, config, ms_key, messages, system_prompt):
+        content = self.chat(config, ms_key, messages, system_prompt)["content"]
+        for word in content.split(" "):
+            yield word + " "
+
+    def generate(self, config, ms_key, prompt, max_tokens=800, temp=0.5):
+        text = self._text("generate", prompt)
+        if "JSON" not in prompt:
+            return text
+        # 同时满足“创意列表”与“单个创意”两种解析方式
+        idea = {"name": text, "description": text, "elements": "mock, idea, sketch"}
+        ideas = [{**idea, "name": f"{text} #{i + 1}"} for i in range(3)]
+        return json.dumps({**idea, "ideas": ideas}, ensure_ascii=False)
+
+    @staticmethod
+    def _fingerprint(image):
+        """按图片内容取指纹：同一张图片以 JSON (base64) 或 multipart 提交时结果相同"""
+        if image:
+            try:
+                return image_digest(image)
+            except (ValueError, TypeError):
+                pass
+        return hashlib.sha256((image or "").encode("utf-8")).hexdigest()
+
+    def vl_chat(self, config, ms_key, image_b64, text, system_prompt=None):
+        return self._text("vl", text, self._fingerprint(image_b64))
+
+    def image_gen(self, config, ms_key, prompt, negative_prompt=None):
+        report_progress("submitted")
+        return self._image("image_gen", prompt)
+
+    def image_edit(self, config, ms_key, mode, image_b64, prompt_cn=None, style_image_b64=None, style_index=None):
+        report_progress("submitted")
+        return self._image(
+            f"image_edit.{mode}",
+            self._fingerprint(image_b64), prompt_cn, style_index, self._fingerprint(style_image_b64),
+        )
+
+
+_PROVIDERS = {}
+DEFAULT_PROVIDER = "modelscope"
+
+
+def register_provider(provider):
+    """注册 (或替换) 一个提供方，名称即 config["api_platform"] 的取值"""
+    if not isinstance(provider, Provider) or not provider.name:
+        raise TypeError(f"Provider must be a named Provider instance, got {provider!r}.")
+    _PROVIDERS[provider.name] = provider
+
+
+def get_provider(config):
+    """按 config["api_platform"] 选择提供方；未知平台回退到 ModelScope"""
+    platform = config.get("api_platform", DEFAULT_PROVIDER)
+    return _PROVIDERS.get(platform) or _PROVIDERS[DEFAULT_PROVIDER]
+
+
+register_provider(ModelScopeProvider())
+register_provider(DashScopeProvider())
+if MOCK_PROVIDER_ENABLED:
+    register_provider(MockProvider())
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import deque
+
+import metrics
+from utils import ServiceBusyError
+
+# ==============================================================================
+# === 上游客户端限流 (令牌桶 + 并发上限 + 有界等待队列)
+# === 按 (上游, API Key, 模型) 分别限流；超出限额的调用排队等待而不是直接触发上游 429。
+# ==============================================================================
+
+RATE_LIMIT_QUEUE_SIZE = int(os.getenv("RATE_LIMIT_QUEUE_SIZE", "64"))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+RATE_LIMIT_IDLE_TTL = float(os.getenv("RATE_LIMIT_IDLE_TTL", "600"))
+
+# 默认限额 (qps: 每秒请求数, concurrency: 同时进行中的调用数, max_wait: 排队等待上限，默认 RATE_LIMIT_MAX_WAIT)
+# 异步图像任务提交后即归还并发名额，轮询期间不占用；
+# 同步图像生成 (创意灵感、心情画) 的一次请求就是整个生成过程，期间一直占用名额，
+# 因此 modelscope_image 的等待上限按生成耗时设置，排在前面的生成完成后即可轮到，而不是 30 秒后直接失败
+DEFAULT_RATE_LIMITS = {
+    "modelscope_chat": {"qps": 5, "concurrency": 8},
+    "modelscope_image": {"qps": 1, "concurrency": 4, "max_wait": 180},
+    "dashscope_llm": {"qps": 10, "concurrency": 16},
+    "dashscope_vl": {"qps": 5, "concurrency": 8},
+    "dashscope_image": {"qps": 2, "concurrency": 4},
+    "tencent_tmt": {"qps": 5, "concurrency": 5},
+    "met": {"qps": 20, "concurrency": 16},
+}
+
+
+def _load_rate_limits():
+    """
+    RATE_LIMITS 环境变量 (JSON) 覆盖默认限额，键为 "上游" 或 "上游/模型 ID"，例如：
+    {"dashscope_image/wanx2.1-t2i-turbo": {"qps": 1, "concurrency": 1}}
+    """
+    limits = {name: dict(cfg) for name, cfg in DEFAULT_RATE_LIMITS.items()}
+    raw = os.getenv("RATE_LIMITS")
+    if raw:
+        try:
+            for key, cfg in json.loads(raw).items():
+                limits.setdefault(key, {}).update(cfg)
+        except (ValueError, AttributeError) as e:
+            print(f"Warning: invalid RATE_LIMITS ({e}). Using defaults.")
+    return limits
+
+
+RATE_LIMITS = _load_rate_limits()
+
+
+class RateLimitTimeoutError(ServiceBusyError):
+    """排队等待上游配额超时，或等待队列已满 (返回 503)"""
+
+    pass
+
+
+class RateLimiter:
+    """
+    单个 (上游, Key, 模型) 的限流器。
+    令牌桶控制速率 (容量为 1 秒的配额)，并发计数控制同时进行的调用数；
+    等待者按到达顺序 (FIFO) 获取配额。
+    """
+
+    def __init__(self, name, qps, concurrency, max_wait=RATE_LIMIT_MAX_WAIT, queue_size=RATE_LIMIT_QUEUE_SIZE):
+        self.name = name
+        self.qps = float(qps)
+        self.concurrency = int(concurrency)
+        self.max_wait = float(max_wait)
+        self.capacity = max(1.0, self.qps)
+        self._queue_size = queue_size
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._active = 0
+        self._waiters = deque()
+        self._cond = threading.Condition()
+        self.last_used = time.time()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.qps)
+        self._refilled_at = now
+
+    def acquire(self, max_wait=None):
+        """获取一次调用配额，返回排队等待的秒数；超时或队列已满时抛出 RateLimitTimeoutError"""
+        started = time.monotonic()
+        deadline = started + (self.max_wait if max_wait is None else max_wait)
+        ticket = object()
+        with self._cond:
+            if len(self._waiters) >= self._queue_size:
+                metrics.incr(f"ratelimit.{self.name}.rejected")
+                raise RateLimitTimeoutError("请求排队人数过多，请稍后再试。")
+            self._waiters.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if self._waiters[0] is ticket and self._active < self.concurrency and self._tokens >= 1:
+                        self._tokens -= 1
+                        self._active += 1
+                        break
+                    if now >= deadline:
+                        metrics.incr(f"ratelimit.{self.name}.timeouts")
+                        raise RateLimitTimeoutError("排队等待时间过长，请稍后再试。")
+                    # 只差令牌时精确等待到下一个令牌产生；否则等待 release 唤醒
+                    wait_for = deadline - now
+                    if self._waiters[0] is ticket and self._active < self.concurrency:
+                        wait_for = min(wait_for, (1 - self._tokens) / self.qps)
+                    self._cond.wait(timeout=wait_for)
+            finally:
+                self._waiters.remove(ticket)
+                self._cond.notify_all()
+            self.last_used = time.time()
+        waited = time.monotonic() - started
+        metrics.observe(f"ratelimit.wait_seconds.{self.name}", waited)
+        return waited
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self.last_used = time.time()
+            self._cond.notify_all()
+
+    @property
+    def idle(self):
+        with self._cond:
+            return self._active == 0 and not self._waiters
+
+    def snapshot(self):
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "queue_depth": len(self._waiters),
+                "active": self._active,
+                "tokens": round(self._tokens, 2),
+                "qps": self.qps,
+                "concurrency": self.concurrency,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _limits_for(upstream, model):
+    cfg = RATE_LIMITS.get(f"{upstream}/{model}") or RATE_LIMITS.get(upstream)
+    return cfg if cfg and cfg.get("qps") else None
+
+
+def get_limiter(upstream, api_key, model):
+    """返回 (上游, Key, 模型) 对应的限流器；未配置限额时返回 None"""
+    cfg = _limits_for(upstream, model)
+    if cfg is None:
+        return None
+    key_hash = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+    key = (upstream, key_hash, model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            _prune_idle()
+            limiter = RateLimiter(
+                f"{upstream}/{model}" if model else upstream,
+                qps=cfg["qps"],
+                concurrency=cfg.get("concurrency", 1000),
+                max_wait=cfg.get("max_wait", RATE_LIMIT_MAX_WAIT),
+            )
+            _limiters[key] = limiter
+        return limiter
+
+
+def _prune_idle():
+    cutoff = time.time() - RATE_LIMIT_IDLE_TTL
+    for key in [k for k, l in _limiters.items() if l.last_used < cutoff and l.idle]:
+        del _limiters[key]
+
+
+def _stats():
+    """按 (上游, 模型) 汇总各 Key 的限流器 (不导出 Key 的哈希)"""
+    with _limiters_lock:
+        items = list(_limiters.items())
+    data = {}
+    for (upstream, _, model), limiter in items:
+        snap = limiter.snapshot()
+        entry = data.setdefault(f"{upstream}/{model or '-'}", {
+            "keys": 0, "queue_depth": 0, "active": 0, "qps": snap["qps"], "concurrency": snap["concurrency"],
+        })
+        entry["keys"] += 1
+        entry["queue_depth"] += snap["queue_depth"]
+        entry["active"] += snap["active"]
+    return data
+
+
+metrics.register_source("ratelimit", _stats)
@@ -0,0 +1,474 @@
+import os
+import time
+import random
+import inspect
+import functools
+import threading
+import contextlib
+import contextvars
+from collections import deque
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+import metrics
+from utils import ServiceBusyError
+from ratelimit import get_limiter
+
+# ==============================================================================
+# === 上游熔断器与全局重试预算
+# === 每个上游一个熔断器：滑动窗口内错误率或慢调用率超过阈值即熔断 (快速失败 503)，
+# === 冷却后放行少量探测请求 (半开)，探测成功则恢复。
+# ==============================================================================
+
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_RATE = float(os.getenv("BREAKER_SLOW_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("BREAKER_HALF_OPEN_PROBES", "1"))
+
+# 重试预算：窗口内重试次数不超过 (请求数 x 比例 + 保底次数)，避免故障时重试放大流量
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))
+RETRY_BUDGET_MIN = int(os.getenv("RETRY_BUDGET_MIN", "10"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "5"))
+
+# 各上游的慢调用阈值 (秒)；图像类执行器包含等待任务完成的时间
+UPSTREAMS = {
+    "modelscope_chat": {"label": "ModelScope 对话", "slow_seconds": 30},
+    "modelscope_image": {"label": "ModelScope 图像", "slow_seconds": 150},
+    "dashscope_llm": {"label": "百炼 LLM", "slow_seconds": 30},
+    "dashscope_vl": {"label": "百炼识图", "slow_seconds": 45},
+    "dashscope_image": {"label": "百炼图像", "slow_seconds": 150},
+    "tencent_tmt": {"label": "腾讯云翻译", "slow_seconds": 5},
+    "met": {"label": "大都会博物馆 API", "slow_seconds": 10},
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpenError(ServiceBusyError):
+    """上游已熔断，请求被快速拒绝 (返回 503)"""
+
+    def __init__(self, upstream, retry_after):
+        self.upstream = upstream
+        self.retry_after = retry_after
+        label = UPSTREAMS.get(upstream, {}).get("label", upstream)
+        super().__init__(f"{label} 服务暂时不可用，请约 {int(retry_after) + 1} 秒后再试。")
+
+
+class UpstreamError(Exception):
+    """SDK 以响应对象 (而非异常) 返回的上游错误，携带 HTTP 状态码以便判断是否可重试"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _status_code(e):
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code
+    return getattr(e, "status_code", None)
+
+
+def is_transient(e):
+    """网络错误、超时、429 与 5xx 视为暂时性故障：计入熔断统计，且可以重试"""
+    if e.__cause__ is not None and is_transient(e.__cause__):
+        return True
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    status = _status_code(e)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    try:
+        from openai import APIConnectionError
+
+        if isinstance(e, APIConnectionError):  # 包括 APITimeoutError
+            return True
+    except ImportError:
+        pass
+    try:
+        from tencentcloud.common.exception.tencent_cloud_sdk_exception import (
+            TencentCloudSDKException,
+        )
+
+        if isinstance(e, TencentCloudSDKException):
+            code = e.get_code() or ""
+            return "Network" in code or code.startswith(("InternalError", "RequestLimitExceeded"))
+    except ImportError:
+        pass
+    return False
+
+
+def is_connect_error(e):
+    """
+    连接阶段的错误 (连接超时、连接被拒绝)：请求没有发出，上游一定没有收到。
+    提交后不可重复的调用 (如图像生成任务) 只对这类错误重试，避免读超时或 5xx 后重复提交、重复计费。
+    """
+    if e.__cause__ is not None and is_connect_error(e.__cause__):
+        return True
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+def is_rate_limited(e):
+    """429 / 请求频率超限：通常只是某个 Key 的配额用尽，不代表上游故障"""
+    if e.__cause__ is not None and is_rate_limited(e.__cause__):
+        return True
+    if _status_code(e) == 429:
+        return True
+    try:
+        from tencentcloud.common.exception.tencent_cloud_sdk_exception import (
+            TencentCloudSDKException,
+        )
+
+        if isinstance(e, TencentCloudSDKException):
+            return (e.get_code() or "").startswith("RequestLimitExceeded")
+    except ImportError:
+        pass
+    return False
+
+
+def _is_failure(e):
+    """
+    计入熔断错误率的异常：暂时性故障 (不含 429)，以及异步任务等待超时。
+    熔断器由所有用户共享，单个 Key 被限流不应导致其他用户的请求被拒绝。
+    """
+    from poller import TaskTimeoutError
+
+    return (is_transient(e) and not is_rate_limited(e)) or isinstance(e, TaskTimeoutError)
+
+
+class CircuitBreaker:
+    def __init__(self, name, slow_seconds, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 error_rate=BREAKER_ERROR_RATE, slow_rate=BREAKER_SLOW_RATE,
+                 open_seconds=BREAKER_OPEN_SECONDS, half_open_probes=BREAKER_HALF_OPEN_PROBES):
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self._window = window
+        self._min_calls = min_calls
+        self._error_rate = error_rate
+        self._slow_rate = slow_rate
+        self._open_seconds = open_seconds
+        self._half_open_probes = half_open_probes
+        self._calls = deque()  # (时间戳, 是否失败, 是否慢调用)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state(time.time())
+
+    def _current_state(self, now):
+        # 进入半开状态；若探测请求迟迟没有结果 (被取消或挂起)，每个冷却周期重新放行探测
+        if self._state != CLOSED and now - self._opened_at >= self._open_seconds:
+            self._state = HALF_OPEN
+            self._opened_at = now
+            self._probes = 0
+        return self._state
+
+    def acquire(self):
+        """请求前调用；熔断中直接抛出 CircuitOpenError"""
+        with self._lock:
+            now = time.time()
+            state = self._current_state(now)
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and self._probes < self._half_open_probes:
+                self._probes += 1
+                metrics.incr(f"breaker.{self.name}.probes")
+                return
+            retry_after = max(0.0, self._opened_at + self._open_seconds - now)
+        metrics.incr(f"breaker.{self.name}.rejected")
+        raise CircuitOpenError(self.name, retry_after)
+
+    def record(self, seconds, failed):
+        """请求结束后调用，记录结果并按阈值切换状态"""
+        slow = seconds >= self.slow_seconds
+        with self._lock:
+            now = time.time()
+            if self._current_state(now) == HALF_OPEN:
+                if failed or slow:
+                    self._trip(now)
+                else:
+                    print(f"Circuit breaker '{self.name}' closed after successful probe.")
+                    self._state = CLOSED
+                    self._calls.clear()
+                return
+
+            self._calls.append((now, failed, slow))
+            while self._calls and self._calls[0][0] < now - self._window:
+                self._calls.popleft()
+            if self._state != CLOSED or len(self._calls) < self._min_calls:
+                return
+            total = len(self._calls)
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            if failures / total >= self._error_rate or slow_calls / total >= self._slow_rate:
+                self._trip(now)
+
+    def _trip(self, now):
+        print(f"Circuit breaker '{self.name}' opened for {self._open_seconds}s.")
+        metrics.incr(f"breaker.{self.name}.opened")
+        self._state = OPEN
+        self._opened_at = now
+        self._calls.clear()
+
+    def snapshot(self):
+        with self._lock:
+            state = self._current_state(time.time())
+            total = len(self._calls)
+            failures = sum(1 for _, f, _ in self._calls if f)
+            return {
+                "state": state,
+                "calls": total,
+                "error_rate": failures / total if total else 0.0,
+            }
+
+
+class RetryBudget:
+    """进程内共享的重试预算 (滑动窗口)"""
+
+    def __init__(self, window=BREAKER_WINDOW, ratio=RETRY_BUDGET_RATIO, minimum=RETRY_BUDGET_MIN):
+        self._window = window
+        self._ratio = ratio
+        self._minimum = minimum
+        self._requests = deque()
+        self._retries = deque()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        for q in (self._requests, self._retries):
+            while q and q[0] < now - self._window:
+                q.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            self._requests.append(now)
+
+    def try_spend(self):
+        """预算充足时登记一次重试并返回 True"""
+        with self._lock:
+            now = time.time()
+            self._prune(now)
+            if len(self._retries) >= self._minimum + len(self._requests) * self._ratio:
+                return False
+            self._retries.append(now)
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            self._prune(time.time())
+            return {"requests": len(self._requests), "retries": len(self._retries)}
+
+
+def backoff_delay(attempt, base=RETRY_BASE_DELAY, cap=RETRY_MAX_DELAY):
+    """指数退避 + 全抖动 (full jitter)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+_breakers = {
+    name: CircuitBreaker(name, slow_seconds=cfg["slow_seconds"]) for name, cfg in UPSTREAMS.items()
+}
+retry_budget = RetryBudget()
+
+metrics.register_source("breakers", lambda: {
+    **{name: b.snapshot() for name, b in _breakers.items()},
+    "retry_budget": retry_budget.snapshot(),
+})
+
+
+def get_breaker(upstream):
+    return _breakers[upstream]
+
+
+class _LimitSlot:
+    """一次尝试占用的限流并发名额；release 只生效一次 (可由执行器在提交任务后提前归还)"""
+
+    __slots__ = ("limiter", "released")
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+_current_slot = contextvars.ContextVar("current_limit_slot", default=None)
+
+
+def release_limit():
+    """
+    异步任务提交成功后调用：提前归还当前调用占用的并发名额，轮询等待结果期间不再占用。
+    这样并发上限约束的是同时进行的提交，而不是所有在途任务。
+    """
+    slot = _current_slot.get()
+    if slot is not None:
+        slot.release()
+
+
+# ==============================================================================
+# === 请求截止时间
+# === 在上下文中设置后，其中 (包括经 submit_in_context 提交到线程池的任务) 的上游调用在截止时间后不再发起，
+# === 排队等待、同步读超时与异步任务轮询也都不会超过截止时间，被放弃的请求不会继续占用线程与配额。
+# ==============================================================================
+
+class DeadlineExceededError(Exception):
+    """请求已超过截止时间，放弃尚未开始的上游调用"""
+
+    pass
+
+
+_deadline = contextvars.ContextVar("request_deadline", default=None)
+
+
+@contextlib.contextmanager
+def request_deadline(at):
+    """在 with 块内设置截止时间 (time.time() 时间戳)；块内提交到线程池的任务沿用该截止时间"""
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _within_deadline(seconds=0.0):
+    at = _deadline.get()
+    return at is None or time.time() + seconds < at
+
+
+def time_left(default):
+    """返回 default 与距截止时间秒数中的较小值 (未设置截止时间时为 default)；已过截止时间时抛出 DeadlineExceededError"""
+    at = _deadline.get()
+    if at is None:
+        return default
+    left = at - time.time()
+    if left <= 0:
+        metrics.incr("deadline.exceeded")
+        raise DeadlineExceededError("请求已超过截止时间。")
+    return min(default, left)
+
+
+def check_deadline():
+    """已过截止时间时抛出 DeadlineExceededError"""
+    time_left(float("inf"))
+
+
+def call_upstream(upstream, fn, *args, retries=RETRY_MAX_ATTEMPTS - 1, limit=None, retry_if=is_transient, **kwargs):
+    """
+    经熔断器调用上游：熔断中快速失败；retry_if 判定可重试的故障在重试预算内按抖动退避重试。
+    retries 为最多重试次数 (不含首次调用)。
+    limit 为 (API Key, 模型 ID)，用于按 Key/模型限流；每次尝试前排队获取配额，
+    尝试结束时归还并发名额 (异步任务执行器在提交后即通过 release_limit 提前归还)。
+    熔断器对每次逻辑调用只记录一次结果 (最后一次尝试)，重试不会放大错误率。
+    设置了请求截止时间时：过期后不再发起调用或重试，排队等待配额也不超过截止时间。
+    """
+    breaker = _breakers[upstream]
+    limiter = get_limiter(upstream, *limit) if limit else None
+    check_deadline()
+    breaker.acquire()
+    retry_budget.record_request()
+    attempt = 0
+    while True:
+        slot = None
+        if limiter is not None:
+            limiter.acquire(max_wait=time_left(limiter.max_wait))
+            slot = _LimitSlot(limiter)
+        token = _current_slot.set(slot)
+        started = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            elapsed = time.time() - started
+            delay = backoff_delay(attempt)
+            # 熔断器已打开 (或正在半开探测)，或退避后已过截止时间时不再重试
+            retry = attempt < retries and retry_if(e) and breaker.state == CLOSED and _within_deadline(delay)
+            if retry and not retry_budget.try_spend():
+                metrics.incr("retry_budget.exhausted")
+                retry = False
+            if not retry:
+                # 因截止时间被缩短的调用 (读超时、轮询超时) 不计入上游错误率
+                breaker.record(elapsed, failed=_is_failure(e) and _within_deadline())
+                raise
+            attempt += 1
+            metrics.incr(f"breaker.{upstream}.retries")
+            print(f"Upstream '{upstream}' transient error ({e}); retry {attempt}/{retries} in {delay:.2f}s.")
+            time.sleep(delay)
+            continue
+        finally:
+            _current_slot.reset(token)
+            if slot is not None:
+                slot.release()
+        breaker.record(time.time() - started, failed=False)
+        return result
+
+
+def _guard_stream(breaker, limiter, gen_fn, *args, **kwargs):
+    """流式调用结束 (或客户端断开) 后记录结果；已输出内容后不再重试"""
+    if limiter is not None:
+        limiter.acquire()
+    started = time.time()
+    failed = False
+    try:
+        yield from gen_fn(*args, **kwargs)
+    except Exception as e:
+        failed = _is_failure(e)
+        raise
+    finally:
+        if limiter is not None:
+            limiter.release()
+        breaker.record(time.time() - started, failed=failed)
+
+
+def upstream(name, retries=RETRY_MAX_ATTEMPTS - 1, limit_by=None, retry_if=is_transient):
+    """
+    执行器装饰器：普通函数经 call_upstream 调用，生成器函数只做熔断保护与限流。
+    limit_by(**参数) 返回 (API Key, 模型 ID)，用于按 Key/模型限流。
+    retry_if(异常) 判定是否重试，提交后不可重复的调用应传入 is_connect_error。
+    """
+
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        def _limit(args, kwargs):
+            if limit_by is None:
+                return None
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            return limit_by(**bound.arguments)
+
+        if inspect.isgeneratorfunction(fn):
+            @functools.wraps(fn)
+            def stream_wrapper(*args, **kwargs):
+                # 在返回生成器之前检查熔断，使路由可以直接返回 503 而不是开始 SSE
+                breaker = _breakers[name]
+                breaker.acquire()
+                retry_budget.record_request()
+                limit = _limit(args, kwargs)
+                limiter = get_limiter(name, *limit) if limit else None
+                return _guard_stream(breaker, limiter, fn, *args, **kwargs)
+
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return call_upstream(
+                name, fn, *args, retries=retries, limit=_limit(args, kwargs), retry_if=retry_if, **kwargs
+            )
+
+        return wrapper
+
+    return decorator
@@ -1,20 +1,22 @@
 import os
 import json
-import boto3
-import uuid
-import base64
-from io import BytesIO
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import requests
-from PIL import Image
 from flask import current_app
 
 from pydub import AudioSegment
 from dashscope.audio.asr import Recognition, RecognitionResult, RecognitionCallback
 
 from prompt import PROMPTS
-from utils import calculate_adaptive_size, ApiKeyMissingError
-import api as executors
+import http_pool
+import metrics
+from providers import get_provider, MOCK_PROVIDER_ENABLED
+from resilience import call_upstream, request_deadline
+from jobs import report_progress
+from pipeline import submit_in_context
+from cache import TieredCache, make_key
 
 # 导入腾讯云 SDK
 from tencentcloud.common import credential
@@ -22,88 +24,123 @@ from tencentcloud.common.profile.client_profile import ClientProfile
 from tencentcloud.common.profile.http_profile import HttpProfile
 from tencentcloud.tmt.v20180321 import tmt_client, models
 
-# --- R2 S3 客户端配置 ---
-R2_ENDPOINT_URL = os.getenv("R2_ENDPOINT_URL")
-R2_ACCOUNT_ID = os.getenv("R2_ACCOUNT_ID")
-R2_ACCESS_KEY_ID = os.getenv("R2_ACCESS_KEY_ID")
-R2_SECRET_ACCESS_KEY = os.getenv("R2_SECRET_ACCESS_KEY")
-R2_BUCKET_NAME = os.getenv("R2_BUCKET_NAME")
-R2_PUBLIC_URL_BASE = os.getenv("R2_PUBLIC_URL_BASE")
-
-s3_client = boto3.client(
-    "s3",
-    endpoint_url=R2_ENDPOINT_URL,
-    aws_access_key_id=R2_ACCESS_KEY_ID,
-    aws_secret_access_key=R2_SECRET_ACCESS_KEY,
-    region_name="auto",
-)
-
 # ---  腾讯云翻译配置  ---
 TENCENT_SECRET_ID = os.getenv("Tencent_SecretId")
 TENCENT_SECRET_KEY = os.getenv("Tencent_Secretkey")
 TENCENT_REGION = "ap-guangzhou"
+TENCENT_REQ_TIMEOUT = int(os.getenv("TENCENT_REQ_TIMEOUT", "10"))
+# TextTranslateBatch 单次请求的文本总长度需低于 6000 字符，超出时拆分为多次请求
+TMT_BATCH_MAX_CHARS = int(os.getenv("TMT_BATCH_MAX_CHARS", "5000"))
+TMT_BATCH_MAX_ITEMS = int(os.getenv("TMT_BATCH_MAX_ITEMS", "100"))
+# 译文缓存：(原文, 目标语言) -> 译文，画作标题/艺术家/媒介大量重复，命中后不再请求翻译接口
+TMT_CACHE_TTL = int(os.getenv("TMT_CACHE_TTL", str(90 * 24 * 3600)))
+_translation_cache = TieredCache("tmt_translation", ttl=TMT_CACHE_TTL, memory_size=8192, disk_size=200000)
+
+# --- 创意灵感：并发生图配置 ---
+IDEA_IMAGE_WORKERS = int(os.getenv("IDEA_IMAGE_WORKERS", "8"))
+IDEA_DEADLINE_SECONDS = float(os.getenv("IDEA_DEADLINE_SECONDS", "90"))
+_idea_executor = ThreadPoolExecutor(max_workers=IDEA_IMAGE_WORKERS, thread_name_prefix="idea-image")
 
 # ==============================================================================
 # === 0. 平台无关的辅助工具
 # ==============================================================================
 
-def upload_to_r2(base64_string):
-    """将 base64 图像字符串上传到 R2 并返回公共 URL 和尺寸。"""
-    try:
-        header, encoded = base64_string.split(",", 1)
-        data = base64.b64decode(encoded)
-        image_bytes = BytesIO(data)
-        with Image.open(image_bytes) as img:
-            width, height = img.size
-        image_bytes.seek(0)
-        mime_type = header.split(";")[0].split(":")[-1]
-        extension = mime_type.split("/")[-1]
-        file_name = f"uploads/{uuid.uuid4()}.{extension}"
-
-        s3_client.upload_fileobj(
-            image_bytes,
-            R2_BUCKET_NAME,
-            file_name,
-            ExtraArgs={"ContentType": mime_type, "ACL": "public-read"},
-        )
-        public_url = f"{R2_PUBLIC_URL_BASE}/{file_name}"
-        return public_url, width, height
-    except Exception as e:
-        print(f"R2 Upload Error: {e}")
-        raise Exception(f"Failed to upload image to R2 OSS: {e}")
+_tmt_client = None
+_tmt_client_lock = threading.Lock()
+
+
+def _get_tmt_client():
+    """复用同一个 TmtClient (及其 HTTP 连接)，避免每次翻译都重新创建客户端"""
+    global _tmt_client
+    with _tmt_client_lock:
+        if _tmt_client is None:
+            cred = credential.Credential(TENCENT_SECRET_ID, TENCENT_SECRET_KEY)
+            httpProfile = HttpProfile()
+            httpProfile.endpoint = "tmt.tencentcloudapi.com"
+            httpProfile.reqTimeout = TENCENT_REQ_TIMEOUT
+            clientProfile = ClientProfile()
+            clientProfile.httpProfile = httpProfile
+            _tmt_client = tmt_client.TmtClient(cred, TENCENT_REGION, clientProfile)
+        return _tmt_client
+
+
+def _tmt_chunks(texts):
+    """按 TextTranslateBatch 的长度限制把待翻译文本分组"""
+    chunk, chars = [], 0
+    for text in texts:
+        if chunk and (chars + len(text) > TMT_BATCH_MAX_CHARS or len(chunk) >= TMT_BATCH_MAX_ITEMS):
+            yield chunk
+            chunk, chars = [], 0
+        chunk.append(text)
+        chars += len(text)
+    if chunk:
+        yield chunk
+
+
+def _translate_batch_tencent(client, text_list, target_lang):
+    req = models.TextTranslateBatchRequest()
+    params = {
+        "Source": "auto", "Target": target_lang, "ProjectId": 0, "SourceTextList": text_list
+    }
+    req.from_json_string(json.dumps(params))
+    resp = call_upstream("tencent_tmt", client.TextTranslateBatch, req, limit=(TENCENT_SECRET_ID, None))
+    translated_list = resp.TargetTextList
+    if len(translated_list) != len(text_list):
+        print(f"Warning: Tencent translation returned {len(translated_list)} results for {len(text_list)} inputs. Returning originals.")
+        return None
+    return translated_list
+
 
 def translate_text_tencent(text_list, target_lang="zh"):
-    """使用腾讯云API批量翻译文本列表 (用于 MET 画廊)"""
+    """
+    使用腾讯云API批量翻译文本列表 (用于 MET 画廊)，返回与输入等长的列表。
+    重复文本只翻译一次；已缓存的文本不再请求接口；其余文本按长度限制分批请求。
+    某一批翻译失败时该批返回原文 (不写入缓存)。
+    """
     if not TENCENT_SECRET_ID or not TENCENT_SECRET_KEY:
         print("Warning: Tencent Cloud API keys not configured. Skipping translation.")
         return text_list
-    try:
-        cred = credential.Credential(TENCENT_SECRET_ID, TENCENT_SECRET_KEY)
-        httpProfile = HttpProfile()
-        httpProfile.endpoint = "tmt.tencentcloudapi.com"
-        clientProfile = ClientProfile()
-        clientProfile.httpProfile = httpProfile
-        client = tmt_client.TmtClient(cred, TENCENT_REGION, clientProfile)
-        req = models.TextTranslateBatchRequest()
-        params = {
-            "Source": "auto", "Target": target_lang, "ProjectId": 0, "SourceTextList": text_list
-        }
-        req.from_json_string(json.dumps(params))
-        resp = client.TextTranslateBatch(req)
-        translated_list = resp.TargetTextList
-        # 添加长度检查，如果翻译失败则返回原文
-        if len(translated_list) == len(text_list):
-            return translated_list
+
+    translations = {}
+    missing = []
+    hits = 0
+    for text in dict.fromkeys(text_list):
+        if not text or not text.strip():
+            translations[text] = text
+            continue
+        cached = _translation_cache.get(make_key(text, target_lang))
+        if cached is not None:
+            translations[text] = cached
+            hits += 1
         else:
-            print(f"Warning: Tencent translation returned {len(translated_list)} results for {len(text_list)} inputs. Returning originals.")
-            return text_list
-    except Exception as e:
-        print(f"Tencent Cloud Translation Error: {e}")
-        return text_list
+            missing.append(text)
+    # 命中率只按去重后的非空文本统计
+    metrics.incr("tencent_tmt.cache_hits", hits)
+
+    if missing:
+        metrics.incr("tencent_tmt.cache_misses", len(missing))
+        for chunk in _tmt_chunks(missing):
+            # 每批单独处理异常：某一批失败 (超时、熔断、SDK 错误) 只让该批返回原文，其余批次照常翻译
+            try:
+                translated_list = _translate_batch_tencent(_get_tmt_client(), chunk, target_lang)
+            except Exception as e:
+                print(f"Tencent Cloud Translation Error ({len(chunk)} texts): {e}")
+                metrics.incr("tencent_tmt.chunk_failures")
+                continue
+            if translated_list is None:
+                continue
+            for text, translated in zip(chunk, translated_list):
+                translations[text] = translated
+                _translation_cache.set(make_key(text, target_lang), translated)
+
+    return [translations.get(text, text) for text in text_list]
 
 
 def validate_modelscope_key(api_key):
     """尝试调用 ModelScope 以验证 API Key 的有效性"""
+    if MOCK_PROVIDER_ENABLED:
+        # 模拟模式 (离线压测) 下任何 Key 都视为有效
+        return True
     # 这个函数需要直接调用 API，所以保留在这里
     try:
         from utils import _get_modelscope_headers # 导入内部函数
@@ -113,7 +150,7 @@ def validate_modelscope_key(api_key):
         payload = {
             "model": model_id, "messages": [{"role": "user", "content": "Test"}], "max_tokens": 1
         }
-        response = requests.post(
+        response = http_pool.post(
             f"{base_url}v1/chat/completions", headers=headers, json=payload, timeout=10
         )
         return response.ok and response.status_code != 401
@@ -254,352 +291,81 @@ def transcribe_audio_dashscope(config, audio_file_obj):
         print(f"ASR Failed: {e}")
         raise Exception(f"语音识别失败: {str(e)}")
 
-# ==============================================================================
-# === DashScope 图像尺寸调整辅助函数
-# ==============================================================================
-def _resize_image_for_dashscope(base64_string, min_dim=512, max_dim=4096):
-    """
-    辅助函数：解码Base64图像，检查宽高。
-    如有必要则调整，确保图像的 *两个维度* 都在 [min_dim, max_dim] 范围内，并保持宽高比。
-    """
-    try:
-        header, encoded = base64_string.split(",", 1)
-        mime_type = header.split(";")[0].split(":")[-1]
-
-        data = base64.b64decode(encoded)
-        image_bytes = BytesIO(data)
-
-        with Image.open(image_bytes) as img:
-            width, height = img.size
-
-            new_width = width
-            new_height = height
-
-            needs_resize = False
-
-            # 1. 检查是否过大 (Oversized)
-            if new_width > max_dim or new_height > max_dim:
-                needs_resize = True
-                # 计算缩小比例，确保两个边都小于 max_dim
-                ratio_w = max_dim / new_width
-                ratio_h = max_dim / new_height
-                scale = min(ratio_w, ratio_h) # 取较小的比例，确保都装得下
-                new_width = int(new_width * scale)
-                new_height = int(new_height * scale)
-
-            # 2. 检查是否过小 (Undersized)
-            if new_width < min_dim or new_height < min_dim:
-                needs_resize = True
-                # 计算放大比例，确保两个边都大于 min_dim
-                ratio_w = min_dim / new_width
-                ratio_h = min_dim / new_height
-                scale = max(ratio_w, ratio_h) # 取较大的比例，确保都达标
-                new_width = int(new_width * scale)
-                new_height = int(new_height * scale)
-
-            # 如果不需要调整尺寸
-            if not needs_resize:
-                return base64_string # 尺寸合适，返回原图
-
-            print(f"DashScope Resizer: Original size {width}x{height}. Final size {new_width}x{new_height}.")
-
-            # 使用 LANCZOS 进行高质量缩放
-            img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-            output_bytes = BytesIO()
-            # 尝试保留原始格式
-            pil_format = img.format if img.format else "PNG"
-
-            if pil_format == "JPEG":
-                if img_resized.mode != "RGB":
-                    img_resized = img_resized.convert("RGB")
-
-            img_resized.save(output_bytes, format=pil_format, quality=95)
-            encoded_resized = base64.b64encode(output_bytes.getvalue()).decode('utf-8')
-            return f"{header},{encoded_resized}"
-
-    except Exception as e:
-        print(f"Error during image resize for DashScope: {e}")
-        raise Exception(f"图像调整失败: {e}")
-
 # ==============================================================================
 # === 3. 功能“管理器” (Public) - 由 app.py 调用
 # ==============================================================================
 
 def generate_colorization(config, ms_key, base64_image, chinese_prompt):
     """AI 智能上色“管理器”"""
-    platform = config.get("api_platform", "modelscope")
-
-    doodle_prompt = f"{chinese_prompt}风格。"
-    if config["age_range"] in ["6-8岁", "9-10岁"]:
-        doodle_prompt += " 色彩明亮, 卡通风格。"
-    elif config["age_range"] in ["13-15岁", "16-18岁"]:
-         doodle_prompt += " 细节丰富, 写实光影。"
-
-    if platform == "bailian":
-        print("DashScope Manager: Calling wanx2.1-imageedit (doodle) for colorization.")
-
-        resized_base64_image = _resize_image_for_dashscope(base64_image)
-
-        return executors.run_image_edit_wanx21_dashscope(
-            config=config,
-            function="doodle",
-            base_image_b64=resized_base64_image,
-            prompt=doodle_prompt,
-            is_sketch='false'
-        )
-
-    else:
-        print("ModelScope Manager: Uploading to R2 and calling LLM/ImageGen for colorization.")
-        public_url, w, h = upload_to_r2(base64_image)
-        adaptive_size = calculate_adaptive_size(w, h)
-        full_chinese_prompt_for_translator = PROMPTS["COLORIZE_PROMPT_CN"].format(
-            prompt=chinese_prompt, age_range=config["age_range"]
-        )
-        translator_prompt = PROMPTS["PROMPT_TRANSLATOR"].format(
-            context="Coloring a lineart image.",
-            chinese_description=full_chinese_prompt_for_translator
-        )
-        english_prompt = executors.run_llm_generation_modelscope(
-            config, ms_key, translator_prompt
-        )
-
-        ms_negative_prompt = "text, watermark, signature, blurry, low quality, worst quality, deformed, ugly, grayscale, monochrome, sketch, unfinished, lineart"
-        body = {
-            "model": config["ms_image_model"],
-            "prompt": english_prompt,
-            "negative_prompt": ms_negative_prompt,
-            "image_url": public_url,
-            "size": adaptive_size,
-        }
-        return executors.run_image_gen_modelscope(config, ms_key, body)
+    provider = get_provider(config)
+    return provider.image_edit(config, ms_key, "colorize", base64_image, prompt_cn=chinese_prompt)
 
 
 def generate_creative_workshop(config, ms_key, base64_content_image=None, base64_style_image=None, chinese_prompt=None):
     """创意工坊“管理器” - 处理非人像的风格迁移"""
-    platform = config.get("api_platform", "modelscope")
-
-    if platform == "bailian":
-
-        resized_content_image = _resize_image_for_dashscope(base64_content_image)
-
-        if base64_style_image:
-            # --- 模式二: 图像风格 ---
-            print("DashScope Manager: Simulating style transfer using VL and wanx2.1-imageedit (stylization_all).")
-
-            resized_style_image = _resize_image_for_dashscope(base64_style_image)
-
-            # 1. 调用 VL 分析风格图 (获取文本描述)
-            style_analysis_content = [
-                {"image": resized_style_image},
-                {"text": PROMPTS["STYLE_ANALYSIS_USER"] + " 请用中文描述风格。"}
-            ]
-            style_description_cn = executors.run_vl_chat_dashscope(config, style_analysis_content)
-            # 2. 构造 stylization_all 的 prompt
-            stylization_prompt = f"转换成 [{style_description_cn}] 风格"
-            # 3. 调用 stylization_all
-            return executors.run_image_edit_wanx21_dashscope(
-                config=config,
-                function="stylization_all",
-                base_image_b64=resized_content_image, # 使用调整后的内容图
-                prompt=stylization_prompt,
-                strength=0.6
-            )
-        elif chinese_prompt:
-             # --- 模式一: 文本指令 ---
-             return executors.run_image_edit_wanx21_dashscope(
-                 config=config,
-                 function="stylization_all",
-                 base_image_b64=resized_content_image, # 使用调整后的内容图
-                 prompt=chinese_prompt
-             )
-        else:
-             raise ValueError("Creative workshop requires either a style image or a text prompt.")
-
-    else:
-        print("ModelScope Manager: Calling LLM/VL/ImageGen for creative workshop.")
-
-        public_content_url = None
-        w, h = 0, 0
-
-        if base64_content_image:
-            public_content_url, w, h = upload_to_r2(base64_content_image)
-
-        if base64_style_image:
-            # --- 模式二: 图像风格  ---
-            print("ModelScope Creative Workshop: Image Style Mode")
-            public_style_url, _, _ = upload_to_r2(base64_style_image)
-            style_analysis_content = [
-                {"type": "image_url", "image_url": {"url": public_style_url}},
-                {"type": "text", "text": PROMPTS["STYLE_ANALYSIS_USER"]}
-            ]
-            style_description_en = executors.run_vl_chat_modelscope(
-                config, ms_key, PROMPTS["STYLE_ANALYSIS_SYSTEM"], style_analysis_content
-            )
-            final_english_prompt = PROMPTS["ART_FUSION_PROMPT_EN"].format(style_description=style_description_en)
-
-        elif chinese_prompt:
-            # --- 模式一: 文本指令 ---
-            print("ModelScope Creative Workshop: Text Instruction Mode")
-            translator_prompt = PROMPTS["PROMPT_TRANSLATOR"].format(
-                context=f"Applying creative style based on user instruction.",
-                chinese_description=chinese_prompt
-            )
-            final_english_prompt = executors.run_llm_generation_modelscope(
-                 config, ms_key, translator_prompt
-            )
-        else:
-             raise ValueError("Creative workshop requires either a style image or a text prompt.")
-
-        ms_negative_prompt = "text, watermark, signature, blurry, low quality, worst quality, deformed, ugly, bad anatomy"
-        body = {
-            "model": config["ms_image_model"],
-            "prompt": final_english_prompt,
-            "negative_prompt": ms_negative_prompt,
-        }
-        adaptive_size = calculate_adaptive_size(w, h) if w > 0 else "1024x1024"
-        body["size"] = adaptive_size
-        if public_content_url:
-            body["image_url"] = public_content_url
-            body["strength"] = 0.6
-
-        return executors.run_image_gen_modelscope(config, ms_key, body)
+    if not base64_style_image and not chinese_prompt:
+        raise ValueError("Creative workshop requires either a style image or a text prompt.")
+    provider = get_provider(config)
+    return provider.image_edit(
+        config, ms_key, "stylize", base64_content_image,
+        prompt_cn=chinese_prompt, style_image_b64=base64_style_image
+    )
 
 
 def generate_portrait_workshop(config, base64_portrait_image, base64_style_image=None, preset_style_index=None):
     """人像工坊“管理器”"""
-    platform = config.get("api_platform", "modelscope")
-    ms_key = config.get("modelscope_key")
-
-    if platform == "bailian":
-        print("DashScope Manager: Calling wanx-style-cosplay for portrait workshop.")
-
-        resized_portrait_image = _resize_image_for_dashscope(base64_portrait_image)
-
-        if base64_style_image is not None:
-            # --- 自定义风格模式 ---
-            print("DashScope Manager: Custom style mode selected.")
-
-            resized_style_image = _resize_image_for_dashscope(base64_style_image)
-
-            return executors.run_portrait_stylization_dashscope(
-                config=config,
-                base_image_b64=resized_portrait_image,
-                style_image_b64=resized_style_image,
-                style_index=-1
-            )
-        elif preset_style_index is not None:
-            # --- 预设风格模式 ---
-            print(f"DashScope Manager: Preset style mode selected (Index: {preset_style_index}).")
-            return executors.run_portrait_stylization_dashscope(
-                config=config,
-                base_image_b64=resized_portrait_image,
-                style_image_b64=None,
-                style_index=preset_style_index
-            )
-        else:
-             # 此情况理论上已被 app.py 捕获，但作为防御添加
-             raise ValueError("Portrait workshop requires either a style image or a preset style index.")
-
-    else: # ModelScope 平台逻辑 (保持不变)
-        # ... (省略 ModelScope 的模拟逻辑) ...
-        print("ModelScope Manager: Simulating portrait workshop using LLM/ImageGen.")
-        if not ms_key: raise ApiKeyMissingError("ModelScope Key not found in config for portrait workshop.")
-
-        if preset_style_index is not None:
-             style_map = {
-                0: "复古漫画", 1: "3D童话", 2: "二次元", 3: "小清新", 4: "未来科技",
-                5: "国画古风", 6: "将军百战", 7: "炫彩卡通", 8: "清雅国风",
-                9: "喜迎新年", 14: "国风工笔", 15: "恭贺新禧", 30: "童话世界",
-                31: "黏土世界", 32: "像素世界", 33: "冒险世界", 34: "日漫世界",
-                35: "3D世界", 36: "二次元世界", 37: "手绘世界", 38: "蜡笔世界",
-                39: "冰箱贴世界", 40: "吧唧世界"
-             }
-             style_name = style_map.get(preset_style_index, f"预设风格{preset_style_index}")
-             chinese_prompt = PROMPTS["SELF_PORTRAIT_PROMPT_CN"].format(style_prompt=style_name)
-             context_desc = f"Stylizing a portrait into preset style {style_name}."
-
-             translator_prompt = PROMPTS["PROMPT_TRANSLATOR"].format(
-                 context=context_desc, chinese_description=chinese_prompt
-             )
-             final_english_prompt = executors.run_llm_generation_modelscope(
-                 config, ms_key, translator_prompt
-             )
-
-        elif base64_style_image:
-             public_style_url, _, _ = upload_to_r2(base64_style_image)
-             style_analysis_content = [
-                 {"type": "image_url", "image_url": {"url": public_style_url}},
-                 {"type": "text", "text": PROMPTS["STYLE_ANALYSIS_USER"]}
-             ]
-             style_description_en = executors.run_vl_chat_modelscope(
-                 config, ms_key, PROMPTS["STYLE_ANALYSIS_SYSTEM"], style_analysis_content
-             )
-             final_english_prompt = f"A portrait in the style of [{style_description_en}], masterpiece, best quality. Must preserve face features."
-        else:
-            raise ValueError("Portrait workshop requires either a style image or a preset style index.")
+    if base64_style_image is None and preset_style_index is None:
+        # 此情况理论上已被 app.py 捕获，但作为防御添加
+        raise ValueError("Portrait workshop requires either a style image or a preset style index.")
+    provider = get_provider(config)
+    return provider.image_edit(
+        config, config.get("modelscope_key"), "portrait", base64_portrait_image,
+        style_image_b64=base64_style_image, style_index=preset_style_index
+    )
 
-        return _execute_modelscope_portrait_simulation(
-            config,
-            base64_portrait_image,
-            final_english_prompt
-        )
-
-def _execute_modelscope_portrait_simulation(config, base64_portrait_image, english_prompt):
-    """
-     辅助函数，执行 ModelScope 的人像风格化模拟。
-    从 config 获取 ms_key。
-    """
-    ms_key = config.get("modelscope_key")
-    if not ms_key:
-        raise ApiKeyMissingError("Internal Error: ModelScope Key not found in config for simulation.")
-
-    public_portrait_url, w, h = upload_to_r2(base64_portrait_image)
-    adaptive_size = calculate_adaptive_size(w, h)
-    ms_negative_prompt = "text, watermark, signature, blurry, ugly, deformed, disfigured, worst quality, low quality, multiple heads, bad anatomy, extra limbs, mutation, gender swap"
-
-    body = {
-        "model": config["ms_image_model"],
-        "prompt": english_prompt,
-        "negative_prompt": ms_negative_prompt,
-        "image_url": public_portrait_url,
-        "size": adaptive_size,
-        "strength": 0.65
-    }
-    return executors.run_image_gen_modelscope(config, ms_key, body)
 
 def run_chat_completion(config, ms_key, messages):
     """艺术知识问答“管理器” (多轮对话)"""
-    platform = config.get("api_platform", "modelscope")
+    provider = get_provider(config)
     system_prompt = PROMPTS["ART_QA_USER"].format(age_range=config["age_range"])
-
-    if platform == "bailian":
-        print("DashScope Manager: Running LLM Chat.")
-        message_obj = executors.run_llm_chat_dashscope(config, messages, system_prompt)
-        return { "choices": [{"message": {"role": message_obj.role, "content": message_obj.content}}] }
-    else:
-        print("ModelScope Manager: Running LLM Chat.")
-        return executors.run_llm_chat_modelscope(config, ms_key, messages, system_prompt)
+    print(f"[{provider.name}] Running LLM Chat.")
+    message = provider.chat(config, ms_key, messages, system_prompt)
+    return {"choices": [{"message": message}]}
+
+
+def _record_stream_timing(chunks, platform):
+    """包装增量文本生成器，记录首 token 时间 (TTFT) 与总耗时"""
+    started = time.time()
+    first = True
+    for chunk in chunks:
+        if first:
+            metrics.observe(f"llm_stream.ttft_seconds.{platform}", time.time() - started)
+            first = False
+        yield chunk
+    metrics.observe(f"llm_stream.total_seconds.{platform}", time.time() - started)
+
+
+def stream_chat_completion(config, ms_key, messages):
+    """艺术知识问答“管理器” (流式)，逐段产出回答文本"""
+    provider = get_provider(config)
+    system_prompt = PROMPTS["ART_QA_USER"].format(age_range=config["age_range"])
+    print(f"[{provider.name}] Streaming LLM Chat.")
+    chunks = provider.stream_chat(config, ms_key, messages, system_prompt)
+    return _record_stream_timing(chunks, provider.name)
 
 
 def generate_ideas(config, ms_key, theme):
     """创意灵感生成器“管理器”"""
-    platform = config.get("api_platform", "modelscope")
+    provider = get_provider(config)
 
     # 1. 生成创意文本
     text_prompt = PROMPTS["IDEA_GENERATOR_USER"].format(
         theme=theme,
         age_range=config["age_range"]
     )
-    ideas = []
-    if platform == "bailian":
-        print("DashScope Manager: Generating idea text...")
-        content = executors.run_llm_generation_dashscope(config, text_prompt)
-        ideas = _parse_ideas_from_llm_json(content)
-    else:
-        print("ModelScope Manager: Generating idea text...")
-        content = executors.run_llm_generation_modelscope(config, ms_key, text_prompt)
-        ideas = _parse_ideas_from_llm_json(content)
+    print(f"[{provider.name}] Generating idea text...")
+    content = provider.generate(config, ms_key, text_prompt)
+    ideas = _parse_ideas_from_llm_json(content)
 
     # === 新增：定义年龄与风格的映射逻辑 ===
     age_range = config.get("age_range", "6-8岁")
@@ -624,51 +390,82 @@ def generate_ideas(config, ms_key, theme):
         # 默认回退
         style_instruction = "Simple black and white line art, clear outlines."
 
-    # 2. 并发生成图像
-    processed_ideas = []
-    for idea in ideas:
+    # === 修改：将计算好的 style_instruction 传入模板 ===
+    def build_image_prompt(idea):
+        # LLM 返回的单个创意缺少字段时只影响它自己 (不生成示例图)，不让整个请求失败
         try:
-            # === 修改：将计算好的 style_instruction 传入模板 ===
-            img_prompt_cn = PROMPTS["IDEA_IMAGE_PROMPT_CN"].format(
+            return PROMPTS["IDEA_IMAGE_PROMPT_CN"].format(
                 name=idea['name'],
                 description=idea['description'],
                 elements=idea['elements'],
                 style_instruction=style_instruction # <--- 动态注入风格
             )
-            ms_negative_prompt = "text, watermark, signature, blurry, low quality, ugly, deformed"
-
-            if platform == "bailian":
-                 print(f"DashScope Manager: Generating image for idea '{idea['name']}'...")
-                 idea["exampleImage"] = executors.run_text_to_image_dashscope(
-                     config,
-                     prompt=img_prompt_cn,
-                 )
-            else:
-                print(
-                    f"ModelScope Manager: Generating image for idea '{idea['name']}'..."
-                )
-                translator_prompt = PROMPTS["PROMPT_TRANSLATOR"].format(
-                    context=f"Generating an image for creative idea: {idea['name']}",
-                    chinese_description=img_prompt_cn,
-                )
-                english_prompt = executors.run_llm_generation_modelscope(
-                    config, ms_key, translator_prompt
-                )
-                img_body = {
-                    "model": config["ms_image_model"],
-                    "prompt": english_prompt,
-                    "negative_prompt": ms_negative_prompt,
-                    "size": "1024x1024",
-                }
-                idea["exampleImage"] = executors.run_image_gen_modelscope(
-                    config, ms_key, img_body, sync=True
-                )
-
-        except Exception as img_err:
+        except (KeyError, TypeError) as e:
+            print(f"[{provider.name}] Skipping image for malformed idea {idea!r}: {e!r}")
+            metrics.incr("ideas.malformed")
+            return None
+
+    img_prompts_cn = [build_image_prompt(idea) for idea in ideas]
+    valid = [index for index, prompt in enumerate(img_prompts_cn) if prompt is not None]
+
+    # 2. 一次性批量转换所有图像提示词 (ModelScope: N 次翻译合并为 1 次)
+    batch_prompts = [None] * len(ideas)
+    if valid:
+        prepared = provider.prepare_image_prompts(config, ms_key, [img_prompts_cn[index] for index in valid])
+        for index, prompt in zip(valid, prepared):
+            batch_prompts[index] = prompt
+    fallbacks = sum(1 for index in valid if batch_prompts[index] is None)
+    if fallbacks:
+        metrics.incr("ideas.prompt_fallbacks", fallbacks)
+
+    # 3. 并发生成图像 (每个创意的“生图”流程并行执行，整体受请求截止时间约束)
+    def generate_idea_image(index, idea):
+        ms_negative_prompt = "text, watermark, signature, blurry, low quality, ugly, deformed"
+
+        print(f"[{provider.name}] Generating image for idea '{idea['name']}'...")
+        image_prompt = batch_prompts[index]
+        if image_prompt is None:
+            # 批量结果中该条无效：单独转换
+            image_prompt = provider.prepare_image_prompt(
+                config, ms_key, img_prompts_cn[index],
+                context=f"Generating an image for creative idea: {idea['name']}",
+            )
+        image_url = provider.image_gen(
+            config, ms_key, image_prompt, negative_prompt=ms_negative_prompt
+        )
+        report_progress("idea_image", index=index)
+        return image_url
+
+    deadline = time.time() + IDEA_DEADLINE_SECONDS
+    # 截止时间随上下文传入各任务：超时后其上游调用、排队与轮询随之结束，不会继续占用共享线程池
+    with request_deadline(deadline):
+        futures = [
+            submit_in_context(_idea_executor, generate_idea_image, index, idea) if index in valid else None
+            for index, idea in enumerate(ideas)
+        ]
+    wait([future for future in futures if future is not None], timeout=max(0.0, deadline - time.time()))
+
+    processed_ideas = []
+    for idea, future in zip(ideas, futures):
+        if future is None:
+            # 字段不全的创意：原样返回 (不是对象的条目无法附加图片，直接丢弃)
+            if isinstance(idea, dict):
+                idea["exampleImage"] = None
+                processed_ideas.append(idea)
+            continue
+        if not future.done():
+            # 超过截止时间：返回部分结果，未完成的图像以 None 代替 (后台任务在截止时间后停止等待上游)
+            future.cancel()
+            print(f"[{provider.name}] Image for idea '{idea['name']}' missed the {IDEA_DEADLINE_SECONDS}s deadline.")
+            metrics.incr("ideas.image_timeouts")
+            idea["exampleImage"] = None
+        elif future.exception() is not None:
             print(
-                f"{platform.capitalize()} Manager: Failed to generate image for idea '{idea['name']}': {img_err}"
+                f"[{provider.name}] Failed to generate image for idea '{idea['name']}': {future.exception()}"
             )
             idea["exampleImage"] = None
+        else:
+            idea["exampleImage"] = future.result()
         processed_ideas.append(idea)
 
     return processed_ideas
@@ -676,22 +473,16 @@ def generate_ideas(config, ms_key, theme):
 
 def generate_mood_painting(config, ms_key, mood, theme):
     """心情画板“管理器”"""
-    platform = config.get("api_platform", "modelscope")
+    provider = get_provider(config)
     age_range = config["age_range"]
 
     # 1. 生成创意文本
     text_prompt = PROMPTS["PSYCH_ART_PROMPT"].format(
         mood=mood, theme=theme, age_range=age_range
     )
-
-    if platform == "bailian":
-        print("DashScope Manager: Generating mood painting text...")
-        content = executors.run_llm_generation_dashscope(config, text_prompt)
-        idea = _parse_single_idea_from_llm_json(content)
-    else:
-        print("ModelScope Manager: Generating mood painting text...")
-        content = executors.run_llm_generation_modelscope(config, ms_key, text_prompt)
-        idea = _parse_single_idea_from_llm_json(content)
+    print(f"[{provider.name}] Generating mood painting text...")
+    content = provider.generate(config, ms_key, text_prompt)
+    idea = _parse_single_idea_from_llm_json(content)
 
     # 2. 生成图像
     try:
@@ -703,52 +494,60 @@ def generate_mood_painting(config, ms_key, mood, theme):
         )
         ms_negative_prompt = "text, watermark, signature, blurry, low quality, ugly, deformed, bad anatomy"
 
-        if platform == "bailian":
-             print(f"DashScope Manager: Generating image for mood idea '{idea['name']}'...")
-             idea["exampleImage"] = executors.run_text_to_image_dashscope(
-                 config,
-                 prompt=img_prompt_cn,
-             )
-        else:
-             print(f"ModelScope Manager: Generating image for mood idea '{idea['name']}'...")
-             translator_prompt = PROMPTS["PROMPT_TRANSLATOR"].format(
-                 context=f"Generating an image for creative idea: {idea['name']}",
-                 chinese_description=img_prompt_cn
-             )
-             english_prompt = executors.run_llm_generation_modelscope(config, ms_key, translator_prompt)
-             img_body = {
-                 "model": config["ms_image_model"],
-                 "prompt": english_prompt,
-                 "negative_prompt": ms_negative_prompt,
-                 "size": "1024x1024",
-             }
-             idea["exampleImage"] = executors.run_image_gen_modelscope(config, ms_key, img_body, sync=True)
+        print(f"[{provider.name}] Generating image for mood idea '{idea['name']}'...")
+        image_prompt = provider.prepare_image_prompt(
+            config, ms_key, img_prompt_cn,
+            context=f"Generating an image for creative idea: {idea['name']}"
+        )
+        idea["exampleImage"] = provider.image_gen(
+            config, ms_key, image_prompt, negative_prompt=ms_negative_prompt
+        )
 
     except Exception as img_err:
-        print(f"{platform.capitalize()} Manager: Failed to generate image for mood idea '{idea['name']}': {img_err}")
+        print(f"[{provider.name}] Failed to generate image for mood idea '{idea['name']}': {img_err}")
         idea["exampleImage"] = None
 
     return idea
 
 def generate_artwork_explanation(config, ms_key, art_info_en):
     """名画鉴赏室“管理器” (AI 讲解)"""
-    platform = config.get("api_platform", "modelscope")
+    provider = get_provider(config)
 
     # 1. 获取 AI 讲解 (使用对应平台 LLM)
     ai_user_prompt = PROMPTS["ARTWORK_EXPLAINER"].format(
         age_range=config["age_range"],
         **art_info_en
     )
-    if platform == "bailian":
-        print("DashScope Manager: Generating artwork explanation...")
-        content = executors.run_llm_generation_dashscope(config, ai_user_prompt)
-        ai_explanation = {"role": "assistant", "content": content}
-    else:
-        print("ModelScope Manager: Generating artwork explanation...")
-        response_json = executors.run_llm_chat_modelscope(config, ms_key, [], ai_user_prompt)
-        ai_explanation = response_json["choices"][0]["message"]
+    print(f"[{provider.name}] Generating artwork explanation...")
+    content = provider.generate(config, ms_key, ai_user_prompt)
+    ai_explanation = {"role": "assistant", "content": content}
 
     # 2. 翻译原文信息 (平台无关, 使用腾讯云)
+    original_description_zh = translate_artwork_info(art_info_en)
+
+    # 3. 返回结果
+    return {
+        "ai_explanation": ai_explanation,
+        "original_description_zh": original_description_zh,
+    }
+
+
+def stream_artwork_explanation(config, ms_key, art_info_en):
+    """名画鉴赏室“管理器” (AI 讲解，流式)，逐段产出讲解文本"""
+    provider = get_provider(config)
+    ai_user_prompt = PROMPTS["ARTWORK_EXPLAINER"].format(
+        age_range=config["age_range"],
+        **art_info_en
+    )
+    print(f"[{provider.name}] Streaming artwork explanation...")
+    chunks = provider.stream_chat(
+        config, ms_key, [{"role": "user", "content": ai_user_prompt}], None
+    )
+    return _record_stream_timing(chunks, provider.name)
+
+
+def translate_artwork_info(art_info_en):
+    """将作品原始信息翻译为中文说明 (腾讯云)，失败时回退为英文"""
     try:
         to_translate = [
             f"作品名称: {art_info_en['title']}",
@@ -771,19 +570,14 @@ def generate_artwork_explanation(config, ms_key, art_info_en):
                 f"Date: {art_info_en['date']}",
             ]
         )
-
-    # 3. 返回结果
-    return {
-        "ai_explanation": ai_explanation,
-        "original_description_zh": original_description_zh,
-    }
+    return original_description_zh
 
 
 def critique_student_work(config, ms_key, theme, student_image_b64):
     """
     AI 助教点评：利用 VL 模型进行针对性、分龄化的深度点评
     """
-    platform = config.get("api_platform", "modelscope")
+    provider = get_provider(config)
     age_range = config.get("age_range", "6-8岁")
 
     # === 1. 定义分龄评价标准 (Rubrics) & 语气 (Tone) ===
@@ -824,32 +618,15 @@ def critique_student_work(config, ms_key, theme, student_image_b64):
     )
 
     # === 3. 调用视觉模型 (VL) ===
-    print(f"[{platform}] Starting critique for age {age_range}...")
+    print(f"[{provider.name}] Starting critique for age {age_range}...")
 
     result_json = {}
 
     try:
-        if platform == "bailian":
-            # DashScope 调用
-            resized_image = _resize_image_for_dashscope(student_image_b64)
-            content = [
-                {"image": resized_image},
-                {"text": vl_prompt_text}
-            ]
-            raw_response = executors.run_vl_chat_dashscope(config, content)
-            result_json = _parse_critique_json(raw_response)
-
-        else:
-            # ModelScope 调用
-            public_url, _, _ = upload_to_r2(student_image_b64)
-            content = [
-                {"type": "image_url", "image_url": {"url": public_url}},
-                {"type": "text", "text": vl_prompt_text}
-            ]
-            # 给 ModelScope 的 System Prompt 也可以稍微强化一下
-            system_prompt = "你是一位专业的少儿美术教育专家，擅长从视觉层面分析儿童画作。"
-            raw_response = executors.run_vl_chat_modelscope(config, ms_key, system_prompt, content)
-            result_json = _parse_critique_json(raw_response)
+        # ModelScope 的 System Prompt 也可以稍微强化一下 (DashScope 识图不使用 System Prompt)
+        system_prompt = "你是一位专业的少儿美术教育专家，擅长从视觉层面分析儿童画作。"
+        raw_response = provider.vl_chat(config, ms_key, student_image_b64, vl_prompt_text, system_prompt=system_prompt)
+        result_json = _parse_critique_json(raw_response)
 
     except Exception as e:
         print(f"Critique generation failed: {e}")
@@ -0,0 +1,120 @@
+"""
+百炼执行器并发压力测试：大量线程使用各自不同的 API Key 同时调用识图、图像编辑、文生图，
+请求发往本地模拟的 DashScope 服务。断言每个结果都属于发起调用的 Key，且 dashscope 模块级全局状态未被修改。
+
+    cd backend && pip install pytest && python -m pytest tests
+"""
+import os
+import sys
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+os.environ.setdefault("FLASK_SECRET_KEY", "test")
+os.environ.setdefault("API_KEY_SALT", "test")
+os.environ.setdefault("CACHE_DIR", tempfile.mkdtemp(prefix="artspark-test-cache-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dashscope  # noqa: E402
+
+import api  # noqa: E402
+from app import app  # noqa: E402
+
+THREADS = 64
+CALLS = 240
+
+
+class _DashScopeStandIn(BaseHTTPRequestHandler):
+    """按 Authorization 中的 Key 生成结果：提交任务返回 task_id，查询任务立即返回成功"""
+
+    def log_message(self, *args):
+        pass
+
+    def _key(self):
+        return self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+
+    def _reply(self, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        key = self._key()
+        if "multimodal-generation" in self.path:
+            self._reply({
+                "request_id": "r",
+                "output": {"choices": [{"message": {"role": "assistant", "content": [{"text": f"vl:{key}"}]}}]},
+                "usage": {},
+            })
+        else:
+            self._reply({"request_id": "r", "output": {"task_id": f"task-{key}", "task_status": "PENDING"}})
+
+    def do_GET(self):
+        task_id = self.path.rsplit("/", 1)[-1]
+        key = task_id.removeprefix("task-")
+        self._reply({
+            "request_id": "r",
+            "output": {"task_id": task_id, "task_status": "SUCCEEDED", "results": [{"url": f"http://images/{key}.png"}]},
+        })
+
+
+@pytest.fixture(scope="module")
+def stand_in():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _DashScopeStandIn)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    previous = app.config["DASHSCOPE_API_BASE_URL"]
+    app.config["DASHSCOPE_API_BASE_URL"] = f"http://127.0.0.1:{server.server_port}/api/v1"
+    yield
+    app.config["DASHSCOPE_API_BASE_URL"] = previous
+    server.shutdown()
+
+
+def _call(index):
+    key = f"sk-test-{index}"
+    config = {"bailian_api_key": key, "ds_vl_id": app.config["DS_VL_ID"]}
+    with app.app_context():
+        kind = index % 3
+        if kind == 0:
+            result = api.run_vl_chat_dashscope(config, [{"text": "describe"}])
+            return key, result, f"vl:{key}"
+        if kind == 1:
+            result = api.run_image_edit_wanx21_dashscope(config, "colorization", "http://images/in.png", prompt="p")
+        else:
+            result = api.run_text_to_image_dashscope(config, "p")
+        return key, result, f"http://images/{key}.png"
+
+
+def test_concurrent_bailian_calls_are_request_scoped(stand_in):
+    api_key_before = dashscope.api_key
+    base_url_before = dashscope.base_http_api_url
+    observed = set()
+    stop = threading.Event()
+
+    def watch_globals():
+        while not stop.is_set():
+            observed.add((dashscope.api_key, dashscope.base_http_api_url))
+            stop.wait(0.001)
+
+    watcher = threading.Thread(target=watch_globals, daemon=True)
+    watcher.start()
+    try:
+        with ThreadPoolExecutor(max_workers=THREADS) as executor:
+            results = list(executor.map(_call, range(CALLS)))
+    finally:
+        stop.set()
+        watcher.join()
+
+    mismatched = [(key, result) for key, result, expected in results if result != expected]
+    assert not mismatched, f"{len(mismatched)} calls returned another key's result: {mismatched[:5]}"
+    assert dashscope.api_key == api_key_before
+    assert dashscope.base_http_api_url == base_url_before
+    assert observed == {(api_key_before, base_url_before)}
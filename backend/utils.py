@@ -1,7 +1,20 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
 from flask import request, jsonify, current_app
 from itsdangerous import  SignatureExpired, BadTimeSignature
 from requests.exceptions import HTTPError
-from openai import OpenAI, AuthenticationError, RateLimitError, APIError
+from openai import OpenAI, DefaultHttpxClient, Timeout, AuthenticationError, RateLimitError, APIError
+
+import metrics
+from http_pool import HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+
+OPENAI_CLIENT_CACHE_SIZE = int(os.getenv("OPENAI_CLIENT_CACHE_SIZE", "64"))
+OPENAI_CLIENT_IDLE_TTL = int(os.getenv("OPENAI_CLIENT_IDLE_TTL", "600"))
 
 
 class ApiKeyMissingError(Exception):
@@ -10,6 +23,18 @@ class ApiKeyMissingError(Exception):
     pass
 
 
+class ServiceBusyError(Exception):
+    """服务端暂时无法接收更多任务时引发 (返回 503)"""
+
+    pass
+
+
+class InvalidUploadError(Exception):
+    """上传的图片无效 (类型不支持、对象不存在、过大等) 时引发 (返回 400)"""
+
+    pass
+
+
 def get_serializer():
     """获取 Flask app 上下文中的 ts 序列化器"""
     try:
@@ -30,9 +55,78 @@ def _get_modelscope_headers(modelscope_key):
     }
 
 
+class _ClientCache:
+    """
+    按 (API Key 哈希, base_url) 缓存 OpenAI 兼容客户端的有界 LRU。
+    复用客户端即复用其 httpx 连接池。
+    空闲超时或被挤出的客户端只从缓存中移除而不主动关闭：其他线程可能仍在用它发请求或读取流式响应，
+    最后一个使用者释放引用后由垃圾回收关闭连接。
+    """
+
+    def __init__(self, max_size=OPENAI_CLIENT_CACHE_SIZE, idle_ttl=OPENAI_CLIENT_IDLE_TTL):
+        self._clients = OrderedDict()
+        self._max_size = max_size
+        self._idle_ttl = idle_ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, api_key, base_url, factory):
+        key = (hashlib.sha256(api_key.encode("utf-8")).hexdigest(), base_url)
+        now = time.time()
+        evicted = 0
+        with self._lock:
+            # 先清理空闲过久的客户端
+            for cached_key, (_, last_used) in list(self._clients.items()):
+                if now - last_used > self._idle_ttl:
+                    del self._clients[cached_key]
+                    evicted += 1
+            entry = self._clients.get(key)
+            if entry is not None:
+                self.hits += 1
+                client = entry[0]
+                self._clients[key] = (client, now)
+                self._clients.move_to_end(key)
+            else:
+                self.misses += 1
+                client = factory()
+                self._clients[key] = (client, now)
+                while len(self._clients) > self._max_size:
+                    self._clients.popitem(last=False)
+                    evicted += 1
+            self.evictions += evicted
+        return client
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._clients),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+_openai_clients = _ClientCache()
+metrics.register_source("openai_clients", _openai_clients.stats)
+
+
+def _build_openai_http_client():
+    """安装了 h2 时启用 HTTP/2，否则使用默认的 HTTP/1.1 keep-alive 连接池"""
+    try:
+        import h2  # noqa: F401
+
+        return DefaultHttpxClient(http2=True)
+    except ImportError:
+        return DefaultHttpxClient()
+
+
 def _get_dashscope_openai_client(config):
     """
-    (新增) 内部辅助函数，用于创建 DashScope (OpenAI 兼容) 的 LLM 客户端。
+    (新增) 内部辅助函数，获取 DashScope (OpenAI 兼容) 的 LLM 客户端 (按 Key 复用)。
     """
     api_key = config.get("bailian_api_key")
     if not api_key:
@@ -40,9 +134,17 @@ def _get_dashscope_openai_client(config):
 
     base_url = current_app.config["DASHSCOPE_OPENAI_BASE_URL"]
 
-    return OpenAI(
-        api_key=api_key,
-        base_url=base_url,
+    return _openai_clients.get(
+        api_key,
+        base_url,
+        lambda: OpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=_build_openai_http_client(),
+            # 超时与连接池保持一致；重试由 resilience 的重试预算统一控制
+            timeout=Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            max_retries=0,
+        ),
     )
 
 
@@ -125,6 +227,20 @@ def handle_api_errors(e):
     if isinstance(e, ApiKeyMissingError):
         return jsonify({"error": str(e)}), 401
 
+    # 捕获上传图片无效
+    if isinstance(e, InvalidUploadError):
+        return jsonify({"error": str(e)}), 400
+
+    # 捕获服务繁忙 (任务队列已满等)
+    if isinstance(e, ServiceBusyError):
+        retry_after = getattr(e, "retry_after", None)
+        if retry_after is not None:
+            # 上游熔断：告知客户端大约多久后可以重试
+            response = jsonify({"error": str(e)})
+            response.headers["Retry-After"] = str(int(retry_after) + 1)
+            return response, 503
+        return jsonify({"error": str(e)}), 503
+
     # 捕获 ModelScope (requests) HTTP 异常
     if isinstance(e, HTTPError):
         if e.response.status_code == 401 or e.response.status_code == 403:
@@ -161,6 +277,17 @@ def handle_api_errors(e):
     return jsonify({"error": f"服务器内部错误: {str(e)}"}), 500
 
 
+def format_sse(data, event=None):
+    """(新增) 将数据编码为一条 Server-Sent Events 消息"""
+    message = ""
+    if event:
+        message += f"event: {event}\n"
+    payload = data if isinstance(data, str) else json.dumps(data, ensure_ascii=False)
+    for line in payload.splitlines() or [""]:
+        message += f"data: {line}\n"
+    return message + "\n"
+
+
 def get_ai_config(data):
     """(重构) 从请求数据中提取 AI 配置，并为两个平台提供默认值"""
     config = {
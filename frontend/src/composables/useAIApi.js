@@ -2,6 +2,7 @@ import { ref } from 'vue';
 import { useAuthStore } from '../stores/auth';
 import { useSettingsStore } from '../stores/settings';
 import { useLocaleStore } from '../stores/locale';
+import { useDirectUpload } from './useDirectUpload';
 
 import { useI18n } from 'vue-i18n';
 
@@ -14,6 +15,7 @@ export function useAIApi(endpoint, options = {}) {
   const settingsStore = useSettingsStore();
   const localeStore = useLocaleStore();
   const { t } = useI18n();
+  const { startDirectUpload } = useDirectUpload();
 
   const fileToBase64 = (file) => {
     return new Promise((resolve, reject) => {
@@ -24,6 +26,27 @@ export function useAIApi(endpoint, options = {}) {
     });
   };
 
+  const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+  // 异步 Job 模式：轮询 /api/jobs/<id> 直到任务结束
+  const waitForJob = async (job) => {
+    const interval = options.pollInterval || 1500;
+    while (true) {
+      await sleep(interval);
+      const response = await fetch(`${job.statusUrl}?token=${encodeURIComponent(authStore.token)}`);
+      if (!response.ok) {
+        const errData = await response.json().catch(() => ({}));
+        throw new Error(errData.error || `${t('errors.requestFailed')}: ${response.status}`);
+      }
+      const status = await response.json();
+      if (status.status === 'succeeded') return status.result;
+      if (status.status === 'failed') {
+        if (status.statusCode === 401) authStore.logout();
+        throw new Error(status.error || t('errors.requestFailed'));
+      }
+    }
+  };
+
   const execute = async (body) => {
     isLoading.value = true;
     error.value = '';
@@ -40,15 +63,81 @@ export function useAIApi(endpoint, options = {}) {
       const fullBody = {
         ...body,
         ...settingsStore.aiSettings,
+        ...(options.async ? { async: true } : {}),
       };
 
+      // 已直传到对象存储的文件只发送对象键 ("<字段名>_key")
+      for (const [key, value] of Object.entries(fullBody)) {
+        if (!(value instanceof Blob)) continue;
+        const objectKey = await startDirectUpload(value);
+        if (objectKey) {
+          delete fullBody[key];
+          fullBody[`${key}_key`] = objectKey;
+        }
+      }
+
+      // 含文件 (File/Blob) 时以 multipart/form-data 直接上传二进制，避免 base64 带来的体积膨胀；否则发送 JSON
+      const headers = { 'Accept-Language': localeStore.locale };
+      let requestBody;
+      if (Object.values(fullBody).some((value) => value instanceof Blob)) {
+        requestBody = new FormData();
+        for (const [key, value] of Object.entries(fullBody)) {
+          if (value === null || value === undefined) continue;
+          if (value instanceof Blob) requestBody.append(key, value, value.name || key);
+          else requestBody.append(key, String(value));
+        }
+      } else {
+        headers['Content-Type'] = 'application/json';
+        requestBody = JSON.stringify(fullBody);
+      }
+
       const response = await fetch(`${endpoint}?token=${encodeURIComponent(authStore.token)}`, {
         method: 'POST',
-        headers: { 
+        headers,
+        body: requestBody,
+      });
+
+      if (!response.ok) {
+        if (response.status === 401) {
+          authStore.logout();
+          throw new Error(t('errors.apiKeyInvalid'));
+        }
+        const errData = await response.json();
+        throw new Error(errData.error || `${t('errors.requestFailed')}: ${response.status}`);
+      }
+
+      const data = await response.json();
+      result.value = response.status === 202 ? await waitForJob(data) : data;
+      return result.value;
+    } catch (e) {
+      error.value = `${t('errors.generationFailed')}: ${e.message}`;
+    } finally {
+      isLoading.value = false;
+    }
+  };
+
+  // 流式模式：POST 到 `${endpoint}/stream`，逐段回调 onDelta，结束时返回与 JSON 接口相同结构的结果
+  const executeStream = async (body, onDelta) => {
+    isLoading.value = true;
+    error.value = '';
+    result.value = options.initialResult || null;
+
+    if (!authStore.isLoggedIn) {
+      error.value = t('errors.notLoggedIn');
+      isLoading.value = false;
+      authStore.logout();
+      return;
+    }
+
+    try {
+      const response = await fetch(`${endpoint}/stream?token=${encodeURIComponent(authStore.token)}`, {
+        method: 'POST',
+        headers: {
           'Content-Type': 'application/json',
+          'Accept': 'text/event-stream',
           'Accept-Language': localeStore.locale
         },
-        body: JSON.stringify(fullBody),
+        body: JSON.stringify({ ...body, ...settingsStore.aiSettings }),
       });
 
       if (!response.ok) {
@@ -60,7 +149,33 @@ export function useAIApi(endpoint, options = {}) {
         throw new Error(errData.error || `${t('errors.requestFailed')}: ${response.status}`);
       }
 
-      result.value = await response.json();
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const block = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          let event = 'message';
+          const dataLines = [];
+          for (const line of block.split('\n')) {
+            if (line.startsWith('event:')) event = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+          }
+          if (!dataLines.length) continue;
+          const data = JSON.parse(dataLines.join('\n'));
+          if (event === 'delta' && onDelta) onDelta(data.content);
+          else if (event === 'done') result.value = data;
+          else if (event === 'error') {
+            if (data.status === 401) authStore.logout();
+            throw new Error(data.error || t('errors.requestFailed'));
+          }
+        }
+      }
       return result.value;
     } catch (e) {
       error.value = `${t('errors.generationFailed')}: ${e.message}`;
@@ -74,6 +189,7 @@ export function useAIApi(endpoint, options = {}) {
     error,
     result,
     execute,
+    executeStream,
     fileToBase64,
   };
 }
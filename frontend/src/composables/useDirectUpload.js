@@ -0,0 +1,52 @@
+import { useAuthStore } from '../stores/auth';
+
+// 浏览器直传 R2：先向后端申请预签名 PUT 地址，再把文件直接上传到对象存储，生成接口只传对象键。
+// 同一个 File 只上传一次 (选择图片时即开始上传，提交时等待结果)。
+const uploads = new WeakMap();
+// 后端未配置对象存储 (501) 或存储拒绝浏览器上传 (如 CORS 未配置) 时，本次会话内不再尝试直传
+let directUploadAvailable = true;
+
+async function upload(file, token) {
+  const presign = await fetch(`/api/uploads/presign?token=${encodeURIComponent(token)}`, {
+    method: 'POST',
+    headers: { 'Content-Type': 'application/json' },
+    // 文件大小包含在签名中，超出后端限制时返回 400 (改用 multipart 上传)
+    body: JSON.stringify({ content_type: file.type, size: file.size }),
+  });
+  if (presign.status === 501) {
+    directUploadAvailable = false;
+    return null;
+  }
+  if (!presign.ok) return null;
+
+  const target = await presign.json();
+  const response = await fetch(target.uploadUrl, {
+    method: target.method,
+    headers: target.headers,
+    body: file,
+  });
+  if (!response.ok) return null;
+  return target.key;
+}
+
+export function useDirectUpload() {
+  const authStore = useAuthStore();
+
+  // 返回对象键；直传不可用或失败时返回 null，调用方改用 multipart 上传文件本身
+  const startDirectUpload = (file) => {
+    if (!(file instanceof Blob) || !directUploadAvailable || !authStore.isLoggedIn) {
+      return Promise.resolve(null);
+    }
+    if (!uploads.has(file)) {
+      const pending = upload(file, authStore.token).catch((e) => {
+        console.warn('Direct upload failed, falling back to multipart:', e);
+        directUploadAvailable = false;
+        return null;
+      });
+      uploads.set(file, pending);
+    }
+    return uploads.get(file);
+  };
+
+  return { startDirectUpload };
+}
@@ -1,4 +1,5 @@
 import { ref, computed } from 'vue';
+import { useDirectUpload } from './useDirectUpload';
 
 /**
  * 一个用于处理 Element Plus 'limit=1' 上传组件的 Composable。
@@ -7,11 +8,14 @@ import { ref, computed } from 'vue';
 export function useUploadLimiter() {
   // 1. 内部持有的文件状态 (存储 file.raw)
   const file = ref(null);
+  const { startDirectUpload } = useDirectUpload();
 
   // 2. on-change 事件处理器
   // elFile 是 Element Plus 传递的原始文件对象
   const handleChange = (elFile) => {
     file.value = elFile.raw;
+    // 选择图片后立即开始直传对象存储，与用户填写其他内容并行
+    startDirectUpload(elFile.raw);
   };
 
   // 3. on-remove 事件处理器